@@ -79,6 +79,13 @@ class ThermologAdmin(admin.ModelAdmin):
 
 admin.site.register(models.Thermolog, ThermologAdmin)
 
+class ThermoRollupAdmin(admin.ModelAdmin):
+    list_display = ('sensor', 'resolution', 'time', thermolog_deg_c, 'min_temp',
+        'max_temp', 'num_readings')
+    list_filter = ('sensor', 'resolution', 'time')
+
+admin.site.register(models.ThermoRollup, ThermoRollupAdmin)
+
 class SystemEventAdmin(admin.ModelAdmin):
     list_display = ('id', 'kind', 'time', 'user', 'drink', 'keg', 'session')
     list_filter = ('kind', 'time')
@@ -20,15 +20,23 @@
 
 from __future__ import absolute_import
 
-import datetime
 import logging
+import random
+import time
 
+from django.conf import settings
+from django.db import OperationalError
+from django.db import connection
 from django.db import transaction
 from django.utils import timezone
 from pykeg import notification
 from pykeg.core import defaults
 from pykeg.core import keg_sizes
+from pykeg.core import cache
+from pykeg.core import commit_hooks
+from pykeg.core import hotstate
 from pykeg.core import stats
+from pykeg.core import thermo
 from pykeg.core.cache import KegbotCache
 from . import kb_common
 from . import models
@@ -36,6 +44,11 @@ from . import time_series
 
 from pykeg.web import tasks
 
+# Number of times a pour is attempted when it conflicts with concurrent pours,
+# and the maximum delay before the first retry.
+POUR_ATTEMPTS = 5
+POUR_RETRY_SECONDS = 0.05
+
 class BackendError(Exception):
     """Base backend error exception."""
 
@@ -45,15 +58,22 @@ class NoTokenError(BackendError):
 class KegbotBackend:
     """Provides high-level operations against the Kegbot system."""
 
-    def __init__(self):
+    def __init__(self, cache=None):
+        """Constructor.
+
+        Args:
+            cache: The KegbotCache to invalidate on changes; a new one is
+                used if not given.
+        """
         self._logger = logging.getLogger('backend')
-        self.cache = KegbotCache()
+        self.cache = cache or KegbotCache()
 
     @transaction.atomic
     def create_new_user(self, username):
         """Creates and returns a User for the given username."""
         return models.User.objects.create(username=username)
 
+    @hotstate.transactional
     @transaction.atomic
     def create_tap(self, name, meter_name, relay_name=None, ml_per_tick=None):
         """Creates and returns a new KegTap.
@@ -100,7 +120,6 @@ class KegbotBackend:
         token.save()
         return token
 
-    @transaction.atomic
     def record_drink(self, tap_name, ticks, volume_ml=None, username=None,
         pour_time=None, duration=0, shout='', tick_time_series='',
         do_postprocess=True):
@@ -125,18 +144,90 @@ class KegbotBackend:
             shout: A short comment left by the user about this Drink.  Optional.
             tick_time_series: Vector of flow update data, used for diagnostic
                 purposes.
-            do_postprocess: Set to False during bulk inserts.
+            do_postprocess: Set to False during bulk inserts.  The drink is
+                then left for the next `process_pending_drinks()`.
+
+        When settings.KEGBOT_DEFER_DRINK_PROCESSING is set, only the Drink and
+        keg volume are recorded here; stats, events and plugin tasks are left
+        to the `process_drinks` background task.
 
         Returns:
             The newly-created Drink instance.
         """
+        pour = {
+            'ticks': ticks,
+            'volume_ml': volume_ml,
+            'username': username,
+            'pour_time': pour_time,
+            'duration': duration,
+            'shout': shout,
+            'tick_time_series': tick_time_series,
+        }
+        return self.record_drinks(tap_name, [pour], do_postprocess)[0]
 
-        tap = self._get_tap_from_name(tap_name)
-        if not tap:
-            raise BackendError("Tap unknown")
-        if not tap.is_active or not tap.current_keg:
-            raise BackendError("No active keg at this tap")
+    def record_drinks(self, tap_name, pours, do_postprocess=True):
+        """Records several drinks against a given tap.
 
+        This is equivalent to calling `record_drink()` for each pour, except
+        that the keg is updated once and stats for all drinks are generated in
+        a single pass.  Either all drinks are recorded, or none are.
+
+        Args:
+            tap_name: The tap's meter_name.
+            pours: A list of dictionaries of `record_drink()` keyword arguments
+                (`ticks`, `volume_ml`, `username` and so on), in pour order.
+            do_postprocess: As in `record_drink()`.
+
+        Returns:
+            The list of newly-created Drink instances.
+        """
+        for attempt in range(POUR_ATTEMPTS):
+            try:
+                return self._record_drinks(tap_name, pours, do_postprocess)
+            except OperationalError, e:
+                # Concurrent pours can conflict, for instance when SQLite
+                # cannot upgrade a read lock or PostgreSQL detects a deadlock.
+                # The attempt was rolled back, unless it ran in a caller's
+                # transaction.
+                if connection.in_atomic_block or attempt == POUR_ATTEMPTS - 1:
+                    raise
+                self._logger.warning('Retrying pour after database error: %s' % e)
+                time.sleep(random.uniform(0, POUR_RETRY_SECONDS * (attempt + 1)))
+
+    @commit_hooks.transactional
+    @hotstate.transactional
+    def _record_drinks(self, tap_name, pours, do_postprocess):
+        deferred = getattr(settings, 'KEGBOT_DEFER_DRINK_PROCESSING', False)
+        with transaction.atomic():
+            # Processing locks the site row, which must then be locked before
+            # any other row to avoid deadlocks.  Without row locks, the whole
+            # database is locked for writing up front instead.
+            inline = do_postprocess and not deferred
+            if inline or not connection.features.has_select_for_update:
+                models.KegbotSite.get_locked()
+
+            tap = self._get_tap_from_name(tap_name)
+            if not tap:
+                raise BackendError("Tap unknown")
+            if not tap.is_active or not tap.current_keg:
+                raise BackendError("No active keg at this tap")
+
+            drinks = [self._create_drink(tap, **pour) for pour in pours]
+            tap.current_keg.add_volume(sum(d.volume_ml for d in drinks))
+
+            if inline:
+                self._process_pending_drinks(drinks)
+
+        self._invalidate_drinks(drinks)
+
+        if do_postprocess and deferred:
+            tasks.process_drinks.delay()
+
+        return drinks
+
+    def _create_drink(self, tap, ticks, volume_ml=None, username=None,
+            pour_time=None, duration=0, shout='', tick_time_series=''):
+        """Saves a new Drink on `tap` and assigns its session."""
         if volume_ml is None:
             volume_ml = float(ticks) * tap.ml_per_tick
 
@@ -149,8 +240,6 @@ class KegbotBackend:
         if not pour_time:
             pour_time = timezone.now()
 
-        keg = tap.current_keg
-
         if tick_time_series:
             try:
                 # Validate the time series by parsing it; canonicalize it by generating
@@ -160,24 +249,74 @@ class KegbotBackend:
                 self._logger.warning('Time series invalid, ignoring. Error was: %s' % e)
                 tick_time_series = ''
 
-        d = models.Drink(ticks=ticks, keg=keg, user=user,
+        d = models.Drink(ticks=ticks, keg=tap.current_keg, user=user,
             volume_ml=volume_ml, time=pour_time, duration=duration,
             shout=shout, tick_time_series=tick_time_series)
         models.DrinkingSession.AssignSessionForDrink(d)
         d.save()
+        return d
 
-        keg.served_volume_ml += volume_ml
-        keg.save(update_fields=['served_volume_ml'])
-
-        self.cache.update_generation()
-
-        if do_postprocess:
-            stats.generate(d)
-            events = models.SystemEvent.build_events_for_drink(d)
-            tasks.schedule_tasks(events)
+    @commit_hooks.transactional
+    @hotstate.transactional
+    @transaction.atomic
+    def process_pending_drinks(self):
+        """Generates stats and events for all unprocessed drinks, in order.
 
-        return d
+        Returns:
+            The list of processed drinks.
+        """
+        drinks = self._process_pending_drinks()
+        if drinks:
+            self._invalidate_drinks(drinks)
+        return drinks
+
+    def _process_pending_drinks(self, recorded=()):
+        # Locking the site row serializes concurrent processors, so drinks
+        # are always processed in id order.
+        site = models.KegbotSite.get_locked()
+        pending = models.Drink.objects.filter(id__gt=site.last_processed_drink_id)
+        drinks = list(pending.select_related('user', 'session', 'keg').order_by('id'))
+        stats.generate_many(drinks)
+
+        # Drinks just recorded know whether they started or joined a session.
+        recorded = dict((d.id, d) for d in recorded)
+        for drink in drinks:
+            if drink.id in recorded:
+                drink.started_session = recorded[drink.id].started_session
+                drink.joined_session = recorded[drink.id].joined_session
+
+        # Kegs already include the volume of every pending drink, and of
+        # none after them, so each drink sees the volume left at its pour.
+        keg_volumes = models.SystemEvent.keg_volumes_before(drinks)
+        events = models.SystemEvent.build_events_for_drinks(drinks, keg_volumes)
+        tasks.schedule_tasks(events)
 
+        if drinks:
+            site.last_processed_drink_id = drinks[-1].id
+            site.save(update_fields=['last_processed_drink_id'])
+        return drinks
+
+    def _invalidate_drinks(self, drinks, previous_user_id=None):
+        """Updates the cache namespaces which depend on the given drinks."""
+        namespaces = set([cache.NS_SYSTEM])
+        keg_ids = set(d.keg_id for d in drinks if d.keg_id)
+        user_ids = set(d.user_id for d in drinks if d.user_id)
+        if previous_user_id:
+            user_ids.add(previous_user_id)
+        for keg_id in keg_ids:
+            namespaces.add(cache.namespace(cache.NS_KEG, keg_id))
+        taps = models.KegTap.objects.filter(current_keg__in=keg_ids)
+        for meter_name in taps.values_list('meter_name', flat=True):
+            namespaces.add(cache.namespace(cache.NS_TAP, meter_name))
+        users = models.User.objects.filter(id__in=user_ids)
+        for username in users.values_list('username', flat=True):
+            namespaces.add(cache.namespace(cache.NS_USER, username))
+        for drink in drinks:
+            if drink.session_id:
+                namespaces.add(cache.namespace(cache.NS_SESSION, drink.session_id))
+        self.cache.update_namespaces(namespaces)
+
+    @hotstate.transactional
     @transaction.atomic
     def cancel_drink(self, drink, spilled=False):
         """Permanently deletes a Drink from the system.
@@ -204,32 +343,30 @@ class KegbotBackend:
         keg = drink.keg
         volume_ml = drink.volume_ml
 
-        keg_update_fields = ['served_volume_ml']
-        keg.served_volume_ml -= volume_ml
-
         # Transfer volume to spillage if requested.
+        spilled_ml = 0
         if spilled and volume_ml and drink.keg:
-            keg.spilled_ml += volume_ml
-            keg_update_fields.append('spilled_ml')
+            spilled_ml = volume_ml
 
-        keg.save(update_fields=keg_update_fields)
+        keg.add_volume(-volume_ml, spilled_ml)
 
-        # Invalidate all statistics.
-        stats.invalidate(drink)
+        # Only the drink's own scopes depend on it.
+        scopes = stats.scopes_for_drink(drink)
+        before = stats.contribution(drink)
 
         # Delete the drink, including any objects related to it.
         drink.delete()
 
         session.Rebuild()
 
-        # Regenerate stats for any drinks following the just-deleted one.
-        for drink in models.Drink.objects.filter(id__gt=drink_id).order_by('id'):
-            stats.generate(drink)
+        # Take the drink out of the stats of any drinks following it.
+        stats.correct(before, None, scopes)
 
-        self.cache.update_generation()
+        self._invalidate_drinks([drink])
 
         return drink
 
+    @hotstate.transactional
     @transaction.atomic
     def assign_drink(self, drink, user):
         """Assigns, or re-assigns, a previously-recorded Drink.
@@ -251,24 +388,29 @@ class KegbotBackend:
         if drink.user == user:
             return drink
 
+        previous_user_id = drink.user_id
+        before = stats.contribution(drink)
         drink.user = user
         drink.save()
 
-        stats.invalidate(drink)
-
         for e in drink.events.all():
             e.user = user
             e.save()
-        for p in drink.pictures.all():
-            p.user = user
-            p.save()
+        if drink.picture:
+            drink.picture.user = user
+            drink.picture.save()
 
         drink.session.Rebuild()
-        stats.generate(drink)
 
-        self.cache.update_generation()
+        # Stats of both the new and previous owner depend on this drink.
+        scopes = stats.scopes_for_drink(drink)
+        scopes.append((models.UserStats, {'user_id': previous_user_id}))
+        stats.correct(before, drink, scopes)
+
+        self._invalidate_drinks([drink], previous_user_id=previous_user_id)
         return drink
 
+    @hotstate.transactional
     @transaction.atomic
     def set_drink_volume(self, drink, volume_ml):
         """Updates the drink volume."""
@@ -276,34 +418,30 @@ class KegbotBackend:
             return
 
         difference = volume_ml - drink.volume_ml
+        before = stats.contribution(drink)
         drink.volume_ml = volume_ml
         drink.save(update_fields=['volume_ml'])
 
-        keg = drink.keg
-        keg.served_volume_ml += difference
-        keg.save(update_fields=['served_volume_ml'])
+        drink.keg.add_volume(difference)
 
-        stats.invalidate(drink)
         drink.session.Rebuild()
 
-        # Regenerate stats for this drink and all subsequent.
-        for drink in models.Drink.objects.filter(id__gte=drink.id).order_by('id'):
-            stats.generate(drink)
+        # Correct stats for this drink and all subsequent.
+        stats.correct(before, drink, stats.scopes_for_drink(drink))
 
-        self.cache.update_generation()
+        self._invalidate_drinks([drink])
 
-    @transaction.atomic
     def log_sensor_reading(self, sensor_name, temperature, when=None):
         """Logs a ThermoSensor reading.
 
         To avoid an excessive number of entries, the system limits temperature
         readings to one per minute.  If there is already a recording for the
         given time period, that record will be updated with the current temperature
-        ("last one wins").
+        ("last one wins").  Updates within a minute are buffered and written
+        once the minute is over; see `pykeg.core.thermo`.
 
-        Regardless of this record's timestamp, any records older than
-        `kb_common.THERMO_SENSOR_HISTORY_MINUTES` will be deleted as a side effect
-        of this call.
+        Records older than `kb_common.THERMO_SENSOR_HISTORY_MINUTES` are
+        deleted by a periodic task, not by this call.
 
         Args:
             sensor_name: The name of the sensor, corresponding to
@@ -317,37 +455,40 @@ class KegbotBackend:
         Returns:
             The record for this reading.
         """
-        now = timezone.now()
-        if not when:
-            when = now
-
-        # The maximum resolution of ThermoSensor records is 1 minute.  Round the
-        # time down to the nearest minute; if a record already exists for this time,
-        # replace it.
-        when = when.replace(second=0, microsecond=0)
+        return self.log_sensor_readings([(sensor_name, temperature, when)])[0]
 
-        # If the temperature is out of bounds, reject it.
-        min_val = kb_common.THERMO_SENSOR_RANGE[0]
-        max_val = kb_common.THERMO_SENSOR_RANGE[1]
-        if temperature < min_val or temperature > max_val:
-            raise ValueError('Temperature out of bounds')
+    @hotstate.transactional
+    @transaction.atomic
+    def log_sensor_readings(self, readings):
+        """Logs readings of several ThermoSensors at once.
 
-        sensor = self._get_sensor_form_name(sensor_name)
-        log_defaults = {
-            'temp': temperature,
-        }
-        record, created = models.Thermolog.objects.get_or_create(sensor=sensor,
-          time=when, defaults=log_defaults)
-        record.temp = temperature
-        record.save()
+        This is equivalent to calling `log_sensor_reading()` for each reading,
+        except that sensors are resolved and records written for all readings
+        together.  Either all readings are logged, or none are.
 
-        # Delete old entries.
-        keep_time = now - datetime.timedelta(
-            minutes=kb_common.THERMO_SENSOR_HISTORY_MINUTES)
-        old_entries = models.Thermolog.objects.filter(time__lt=keep_time)
-        old_entries.delete()
+        Args:
+            readings: A list of (sensor_name, temperature, when) tuples, in the
+                order the readings were taken, as arguments to
+                `log_sensor_reading()`.
 
-        return record
+        Returns:
+            A list of the record for each reading.
+        """
+        now = timezone.now()
+        min_val = kb_common.THERMO_SENSOR_RANGE[0]
+        max_val = kb_common.THERMO_SENSOR_RANGE[1]
+        rows = []
+        for sensor_name, temperature, when in readings:
+            # If the temperature is out of bounds, reject it.
+            if temperature < min_val or temperature > max_val:
+                raise ValueError('Temperature out of bounds')
+
+            # The maximum resolution of ThermoSensor records is 1 minute.  Round
+            # the time down to the nearest minute; if a record already exists for
+            # this time, replace it.
+            when = (when or now).replace(second=0, microsecond=0)
+            rows.append((sensor_name, temperature, when))
+        return thermo.record_readings(rows, self.cache)
 
     @transaction.atomic
     def get_auth_token(self, auth_device, token_value):
@@ -372,6 +513,8 @@ class KegbotBackend:
             # TODO(mikey): return None instead of raising.
             raise NoTokenError
 
+    @commit_hooks.transactional
+    @hotstate.transactional
     @transaction.atomic
     def start_keg(self, tap, beverage=None, keg_type=keg_sizes.HALF_BARREL,
             full_volume_ml=None, beverage_name=None, beverage_type=None,
@@ -457,6 +600,8 @@ class KegbotBackend:
 
         return keg
 
+    @commit_hooks.transactional
+    @hotstate.transactional
     @transaction.atomic
     def end_keg(self, tap):
         """Takes the current Keg offline at the given tap.
@@ -491,31 +636,7 @@ class KegbotBackend:
 
     def _get_tap_from_name(self, tap_name):
         """"Returns a KegTap object with meter_name matching tap_name, or None."""
-        try:
-            return models.KegTap.objects.get(meter_name=tap_name)
-        except models.KegTap.DoesNotExist:
-            return None
-
-    def _get_sensor_form_name(self, name, autocreate=True):
-        """Returns the TemperatureSensor with raw_name matching name.
-
-        Args:
-            name: The sensor's raw_name.
-            autocreate: If True, create a new sensor if one does not exist.
-
-        Returns:
-            The TemperatureSensor object, or None if none exists and autocreate was
-            not True.
-        """
-        try:
-            return models.ThermoSensor.objects.get(raw_name=name)
-        except models.ThermoSensor.DoesNotExist:
-            if autocreate:
-                sensor = models.ThermoSensor(raw_name=name, nice_name=name)
-                sensor.save()
-                return sensor
-            else:
-                return None
+        return hotstate.get_tap(tap_name)
 
 def get_user(user_or_username):
     """Returns the User object for the given username, or None."""
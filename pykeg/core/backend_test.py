@@ -18,9 +18,22 @@
 
 """Unittests for backend"""
 
+import os
+import sqlite3
+import tempfile
+
+from django.core.cache import cache as django_cache
+from django.core.management import call_command
+from django.db import OperationalError
+from django.db import connection
+from django.db import connections
+from django.db.models import F
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
 from pykeg.core import models
 from pykeg.core import defaults
+from pykeg.core.management.commands import kb_stress_pours
 
 from . import backend
 
@@ -77,6 +90,31 @@ class BaseApiTestCase(TestCase):
         self.assertIsNotNone(drink)
         self.assertEquals(user, drink.user)
 
+    def test_deferred_processing(self):
+        """Test recording drinks and processing them later."""
+        self.backend.start_keg(TAP_NAME, beverage_name=FAKE_BEER_NAME,
+                beverage_type='beer', producer_name=FAKE_BREWER_NAME,
+                style_name=FAKE_BEER_STYLE)
+
+        drinks = [self.backend.record_drink(TAP_NAME, ticks=100, volume_ml=100,
+            do_postprocess=False) for i in range(2)]
+        self.assertEquals(200, models.Keg.objects.get().served_volume_ml)
+        self.assertFalse(drinks[0].is_processed())
+        self.assertEquals(0, models.SystemStats.objects.count())
+        self.assertEquals(0, models.SystemEvent.objects.filter(kind='drink_poured').count())
+
+        self.assertEquals(drinks, self.backend.process_pending_drinks())
+        self.assertTrue(drinks[1].is_processed())
+        self.assertEquals(2, models.KegbotSite.get().GetStats().total_pours)
+        events = models.SystemEvent.objects.filter(kind='drink_poured').order_by('id')
+        self.assertEquals(drinks, [e.drink for e in events])
+        self.assertEquals([], self.backend.process_pending_drinks())
+
+        with override_settings(KEGBOT_DEFER_DRINK_PROCESSING=True):
+            drink = self.backend.record_drink(TAP_NAME, ticks=100, volume_ml=100)
+        self.assertTrue(drink.is_processed())
+        self.assertEquals(3, models.KegbotSite.get().GetStats().total_pours)
+
     def test_drink_cancel(self):
         """Tests cancelling drinks."""
         keg = self.backend.start_keg(TAP_NAME, beverage_name=FAKE_BEER_NAME,
@@ -190,3 +228,61 @@ class BaseApiTestCase(TestCase):
         self.assertNotEquals(new_keg_3.type.producer, keg.type.producer)
         self.assertEquals(new_keg_3.type.name, keg.type.name)
         self.assertNotEquals(new_keg_3.type, keg.type)
+
+
+class ConcurrentPourTestCase(TransactionTestCase):
+    def setUp(self):
+        self.backend = backend.KegbotBackend()
+        defaults.set_defaults(set_is_setup=True)
+        for tap in models.KegTap.objects.all():
+            tap.ml_per_tick = 1/2.2
+            tap.save()
+            self.backend.start_keg(tap.meter_name, beverage_name=FAKE_BEER_NAME,
+                beverage_type='beer', producer_name=FAKE_BREWER_NAME,
+                style_name=FAKE_BEER_STYLE)
+
+    def test_retry(self):
+        """Pours which conflict with concurrent pours are retried."""
+        attempts = []
+        record_drinks = self.backend._record_drinks
+        def flaky_record_drinks(*args):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise OperationalError('database is locked')
+            return record_drinks(*args)
+        self.backend._record_drinks = flaky_record_drinks
+
+        drink = self.backend.record_drink(TAP_NAME, ticks=2200)
+        self.assertEquals(2, len(attempts))
+        self.assertEquals(1, models.Drink.objects.count())
+        self.assertAlmostEqual(1000.0, drink.keg.served_volume_ml, places=3)
+
+    def test_stress_pours(self):
+        """Pours from concurrent threads lose no updates."""
+        # Each thread has its own connection, which can only share a database
+        # on disk; copy the in-memory test database to a file for the test.
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        db = sqlite3.connect(path)
+        db.executescript('\n'.join(connection.connection.iterdump()))
+        db.close()
+
+        settings_dict = connections.databases['default']
+        test_name = settings_dict['NAME']
+        test_connection = connections['default']
+        settings_dict['NAME'] = path
+        connections['default'] = type(test_connection)(settings_dict, 'default')
+        try:
+            call_command('kb_stress_pours', threads=3, pours=8, users=3)
+            self.assertEquals(24, models.Drink.objects.count())
+            self.assertEquals([], kb_stress_pours.check_invariants())
+
+            models.Keg.objects.filter(id=models.Drink.objects.all()[0].keg_id).update(
+                served_volume_ml=F('served_volume_ml') + 10)
+            self.assertEquals(1, len(kb_stress_pours.check_invariants()))
+        finally:
+            connections['default'].close()
+            settings_dict['NAME'] = test_name
+            connections['default'] = test_connection
+            django_cache.clear()
+            os.remove(path)
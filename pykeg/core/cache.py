@@ -26,6 +26,55 @@ import time
 # Separator
 SEP = ':'
 
+# Invalidation namespaces.  Most are qualified by an object key, for instance
+# `namespace(NS_KEG, 3)`; NS_SYSTEM covers site-wide data such as lists of
+# objects and system stats.
+NS_SYSTEM = 'system'
+NS_KEG = 'keg'
+NS_TAP = 'tap'
+NS_USER = 'user'
+NS_SESSION = 'session'
+NS_SENSOR = 'sensor'
+
+# Key of the global generation in `get_generations()` results.
+GLOBAL_GENERATION = 'global'
+
+# Default lifetime of a KegbotCache's memo of generations.  KegbotCache
+# instances are created per request, so this only saves repeated lookups
+# within a single request.
+GENERATION_MEMO_SECONDS = 1.0
+
+# Cache backends which keep values in the memory of each process, if at all.
+PROCESS_LOCAL_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+def is_shared():
+    """Returns True if the default cache is shared by all processes.
+
+    State which web and Celery workers must agree on, such as `hotstate` and
+    buffered sensor readings, is only kept in the cache if it is.  The guess
+    from the cache backend can be overridden with
+    settings.KEGBOT_SHARED_CACHE.
+    """
+    shared = getattr(settings, 'KEGBOT_SHARED_CACHE', None)
+    if shared is None:
+        backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+        shared = backend not in PROCESS_LOCAL_BACKENDS
+    return shared
+
+def namespace(kind, key=None):
+    """Returns the name of an invalidation namespace.
+
+    Args:
+        kind: One of the NS_* constants.
+        key: The object key within `kind`, such as a keg id or username.
+    """
+    if key is None:
+        return kind
+    return SEP.join((kind, unicode(key)))
+
 class KegbotCache:
     """Wrapper around django cache, supporting Kegbot-specific features.
 
@@ -37,7 +86,8 @@ class KegbotCache:
 
     def __init__(self, prefix=None, cache=django_cache,
             generation_fn=lambda: int(time.time()),
-            generation_key_name='drink_generation'):
+            generation_key_name='drink_generation',
+            memo_seconds=GENERATION_MEMO_SECONDS):
         """Constructor.
 
         Args:
@@ -49,6 +99,8 @@ class KegbotCache:
                 the generation counter.  The function should return an integer.
             generation_key_name: the key name for the "generation", aka
                 the namespace.
+            memo_seconds: How long generations fetched by this instance are
+                reused without asking the cache again.
         """
         global_prefix = getattr(settings, 'KEGBOT_CACHE_PREFIX', 'kb')
         if not prefix:
@@ -58,6 +110,11 @@ class KegbotCache:
         self.cache = cache
         self.generation_key = SEP.join((self.prefix, generation_key_name))
         self.generation_fn = generation_fn
+        self.memo_seconds = memo_seconds
+        # Namespaces updated through this instance, or None if changes have
+        # not been accounted for by namespace.
+        self.updated_namespaces = None
+        self._memo = {}
 
     def keyname(self, *keyparts):
         """Gets the kegbot-prefixed key name for the given base name."""
@@ -91,36 +148,35 @@ class KegbotCache:
         Based on:
           https://code.google.com/p/memcached/wiki/NewProgrammingTricks
         """
-        generation = self.cache.get(self.generation_key)
-        if not generation:
-            generation = self.generation_fn()
-            if not self.cache.add(self.generation_key, generation):
-                # Lost the race.
-                generation = self.cache.get(self.generation_key)
-        if generation is None:
-            raise ValueError('Cache backend returned None')
-        return generation
+        return self.get_generations([])[GLOBAL_GENERATION]
 
     def update_generation(self):
         """Increments the current generation."""
-        self.get_generation()
-        try:
-            self.cache.incr(self.generation_key, 1)
-        except ValueError:
-            # Increment failed! Generation must not exist.
-            self.cache.add(self.generation_key, self.generation_fn())
+        self._update_counter(self.generation_key)
 
     def gen_keyname(self, *keyparts):
         """Like `keyname()`, but returns a key namespaced by the generation."""
         return self.keyname(*(keyparts + (str(self.get_generation()),)))
 
     def gen_get(self, basename, default=None):
-        """Like `get()`, but uses a key namespaced by the generation."""
-        return self.get(self.gen_keyname(basename), default)
+        """Like `get()`, but only returns values set in this generation."""
+        return self.gen_get_many([basename]).get(basename, default)
+
+    def gen_get_many(self, basenames):
+        """Like `gen_get()` for several keys, in a single cache lookup.
+
+        Returns:
+            A dictionary of base name to value, for each key found.
+        """
+        return self.ns_get_many(basenames, [])[0]
 
     def gen_set(self, basename, value, timeout=None):
-        """Like `set()`, but uses a key namespaced by the generation."""
-        self.set(self.gen_keyname(basename), value, timeout)
+        """Like `set()`, but the value expires with the generation."""
+        self.gen_set_many({basename: value}, timeout)
+
+    def gen_set_many(self, data, timeout=None):
+        """Like `gen_set()` for a dictionary of base name to value."""
+        self.ns_set_many(data, self.get_generations([]), timeout)
 
     def gen_add(self, basename, value, timeout=None):
         """Like `add()`, but returns a key namespaced by the generation."""
@@ -133,3 +189,167 @@ class KegbotCache:
     def gen_decr(self, basename, delta=1):
         """Like `decr()`, but returns a key namespaced by the generation."""
         return self.cache.decr(self.gen_keyname(basename), delta)
+
+    ### Namespaced functions.
+    #
+    # Values stored with `ns_set()` depend on the global generation plus a
+    # set of namespaces, each with its own generation counter.  Updating a
+    # namespace only invalidates the values that depend on it, while
+    # `update_generation()` still invalidates everything.  Values are stored
+    # along with their generations, so that the value and all generations
+    # can be fetched in one lookup.
+
+    def ns_keyname(self, name):
+        """Returns the key name of the generation counter for a namespace."""
+        return self.keyname('ns', name)
+
+    def get_generations(self, namespaces):
+        """Returns the current generations of the given namespaces.
+
+        Returns:
+            A dictionary of namespace name to generation, which also includes
+            the global generation as GLOBAL_GENERATION.
+        """
+        return self._get_many([], namespaces)[1]
+
+    def update_namespaces(self, namespaces):
+        """Increments the generations of the given namespaces.
+
+        Even with no namespaces, this records that a change has been
+        accounted for; see `updated_namespaces`.
+        """
+        if self.updated_namespaces is None:
+            self.updated_namespaces = set()
+        for name in namespaces:
+            self.update_namespace(name)
+
+    def update_namespace(self, name):
+        """Increments the generation of a namespace.
+
+        Returns:
+            The new generation.
+        """
+        if self.updated_namespaces is None:
+            self.updated_namespaces = set()
+        self.updated_namespaces.add(name)
+        return self._update_counter(self.ns_keyname(name))
+
+    def ns_get_many(self, basenames, namespaces, stale=None):
+        """Returns values stored with `ns_set()` which are still current.
+
+        The values and the generations of `namespaces` are fetched in a
+        single cache lookup.
+
+        Args:
+            basenames: The key base names.
+            namespaces: The namespaces the values depend on.
+            stale: If given, a dictionary which receives any values found
+                that are no longer current.
+
+        Returns:
+            A tuple of a dictionary of base name to value for each current
+            value found, and the current generations as returned by
+            `get_generations()`.
+        """
+        found, generations = self._get_many(basenames, namespaces)
+        ret = {}
+        for basename in basenames:
+            entry = found.get(self.keyname(basename))
+            if not entry:
+                continue
+            if entry.get('generations') == generations:
+                ret[basename] = entry['value']
+            elif stale is not None:
+                stale[basename] = entry['value']
+        return ret, generations
+
+    def ns_set(self, basename, value, generations, timeout=None):
+        """Stores a value which depends on the given namespace generations.
+
+        Args:
+            basename: The key base name.
+            value: The value.
+            generations: The generations of the namespaces the value depends
+                on, as returned by `get_generations()` *before* the value was
+                computed.
+            timeout: Optional timeout for the value.
+        """
+        self.ns_set_many({basename: value}, generations, timeout)
+
+    def ns_set_many(self, data, generations, timeout=None):
+        """Like `ns_set()` for a dictionary of base name to value."""
+        entries = dict((self.keyname(basename), {'generations': generations, 'value': value})
+            for basename, value in data.iteritems())
+        self.cache.set_many(entries, timeout)
+
+    def lock(self, basename, timeout):
+        """Tries to take a lock, such as for recomputing a value.
+
+        Args:
+            basename: The key base name the lock is for.
+            timeout: Number of seconds after which the lock expires, in
+                case it is never released.
+
+        Returns:
+            True if the lock was taken, False if it is already held.
+        """
+        return self.cache.add(self.keyname(basename, 'lock'), 1, timeout)
+
+    def unlock(self, basename):
+        """Releases a lock taken with `lock()`."""
+        self.cache.delete(self.keyname(basename, 'lock'))
+
+    def _get_many(self, basenames, namespaces):
+        """Fetches keys and namespace generations in one cache lookup.
+
+        Generations memoized within the last `memo_seconds` are not fetched.
+
+        Returns:
+            A tuple of the cache's `get_many()` result for the keys of
+            `basenames`, and the generations of `namespaces`.
+        """
+        counters = {self.generation_key: GLOBAL_GENERATION}
+        for name in namespaces:
+            counters[self.ns_keyname(name)] = name
+
+        generations = {}
+        now = time.time()
+        for key, name in counters.iteritems():
+            memo = self._memo.get(key)
+            if memo and now < memo[1]:
+                generations[name] = memo[0]
+
+        keys = [self.keyname(b) for b in basenames]
+        keys += [k for k, name in counters.iteritems() if name not in generations]
+        found = self.cache.get_many(keys) if keys else {}
+
+        for key, name in counters.iteritems():
+            if name in generations:
+                continue
+            generation = found.get(key)
+            if not generation:
+                generation = self.generation_fn()
+                if not self.cache.add(key, generation):
+                    # Lost the race.
+                    generation = self.cache.get(key)
+            if generation is None:
+                raise ValueError('Cache backend returned None')
+            self._memo[key] = (generation, now + self.memo_seconds)
+            generations[name] = generation
+        return found, generations
+
+    def _update_counter(self, key):
+        """Increments a generation counter, creating it if missing.
+
+        Returns:
+            The new value of the counter.
+        """
+        try:
+            generation = self.cache.incr(key, 1)
+        except ValueError:
+            # Increment failed! Generation must not exist.
+            generation = self.generation_fn()
+            if not self.cache.add(key, generation):
+                generation = self.cache.incr(key, 1)
+        self._memo[key] = (generation, time.time() + self.memo_seconds)
+        return generation
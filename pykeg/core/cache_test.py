@@ -20,6 +20,7 @@ from django.core.cache import cache as django_cache
 from django.test import TransactionTestCase
 from django.test.utils import override_settings
 
+from . import cache as kbcache
 from .cache import KegbotCache
 
 class KegbotCacheTest(TransactionTestCase):
@@ -61,3 +62,70 @@ class KegbotCacheTest(TransactionTestCase):
         """Tests updating the generation succeeds even when missing."""
         cache = KegbotCache(generation_fn=lambda: 100)
         cache.update_generation()
+
+    def test_namespaces(self):
+        cache = KegbotCache(generation_fn=lambda: 100)
+        keg1 = kbcache.namespace(kbcache.NS_KEG, 1)
+        keg2 = kbcache.namespace(kbcache.NS_KEG, 2)
+        self.assertEquals('keg:1', keg1)
+        self.assertEquals('system', kbcache.namespace(kbcache.NS_SYSTEM))
+
+        def get(basename, namespace):
+            return cache.ns_get_many([basename], [namespace])[0].get(basename)
+
+        generations = cache.get_generations([keg1])
+        self.assertEquals({'global': 100, 'keg:1': 100}, generations)
+        cache.ns_set('keg1', 'value1', generations)
+        cache.ns_set('keg2', 'value2', cache.get_generations([keg2]))
+        self.assertEquals('value1', get('keg1', keg1))
+
+        # Updating one namespace leaves the others cached.
+        cache.update_namespaces([keg1])
+        self.assertEquals(set([keg1]), cache.updated_namespaces)
+        self.assertEquals(None, get('keg1', keg1))
+        self.assertEquals('value2', get('keg2', keg2))
+        stale = {}
+        self.assertEquals({}, cache.ns_get_many(['keg1'], [keg1], stale)[0])
+        self.assertEquals({'keg1': 'value1'}, stale)
+
+        # Updating the global generation invalidates everything.
+        cache.update_generation()
+        self.assertEquals(None, get('keg2', keg2))
+
+    def test_get_many(self):
+        """Values and generations are fetched in a single lookup."""
+        lookups = []
+        class CountingCache(object):
+            def __getattr__(self, name):
+                return getattr(django_cache, name)
+            def get_many(self, keys):
+                lookups.append(sorted(keys))
+                return django_cache.get_many(keys)
+
+        cache = KegbotCache(cache=CountingCache(), generation_fn=lambda: 100)
+        cache.gen_set_many({'foo': 1, 'bar': 2})
+        del lookups[:]
+
+        other = KegbotCache(cache=CountingCache(), generation_fn=lambda: 100)
+        self.assertEquals({'foo': 1, 'bar': 2}, other.gen_get_many(['foo', 'bar', 'baz']))
+        self.assertEquals([['kb:bar', 'kb:baz', 'kb:drink_generation', 'kb:foo']], lookups)
+
+        # The generation is memoized for further lookups.
+        self.assertEquals(1, other.gen_get('foo'))
+        self.assertEquals(['kb:foo'], lookups[-1])
+
+        # Other instances see the update once their memo expires.
+        other.update_generation()
+        self.assertEquals(None, other.gen_get('foo'))
+        self.assertEquals(1, cache.gen_get('foo'))
+
+        stale = KegbotCache(cache=CountingCache(), generation_fn=lambda: 100,
+            memo_seconds=0)
+        self.assertEquals(None, stale.gen_get('foo'))
+
+    def test_lock(self):
+        cache = KegbotCache()
+        self.assertTrue(cache.lock('foo', 10))
+        self.assertFalse(cache.lock('foo', 10))
+        cache.unlock('foo')
+        self.assertTrue(cache.lock('foo', 10))
@@ -0,0 +1,74 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Work deferred until the current transaction commits.
+
+Django 1.6 has no commit hooks.  Instead, functions which run a transaction
+are decorated with `transactional`, and functions passed to `on_commit()`
+while they run are called once they return, after their transaction has
+committed.  Other processes and threads, such as task workers and long-poll
+requests, can then see everything the transaction wrote.
+"""
+
+import logging
+import threading
+from functools import wraps
+
+from django.db import connection
+
+_LOGGER = logging.getLogger(__name__)
+
+_local = threading.local()
+
+def on_commit(fn):
+    """Calls `fn()` once the current transaction has committed.
+
+    Outside a transaction, `fn` is called at once.  It is also called at once
+    if no `transactional` function is running, since the commit could not be
+    observed.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is None or not connection.in_atomic_block:
+        fn()
+    else:
+        pending.append(fn)
+
+def transactional(f):
+    """Decorator for functions which may defer work with `on_commit()`.
+
+    Deferred functions are called when the outermost decorated function
+    returns, or dropped if it raises.  Errors they raise are logged rather
+    than passed to the caller, whose changes are already committed.
+    """
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        if getattr(_local, 'pending', None) is not None:
+            return f(*args, **kwargs)
+        _local.pending = []
+        try:
+            ret = f(*args, **kwargs)
+            pending = _local.pending
+        finally:
+            _local.pending = None
+        for fn in pending:
+            try:
+                fn()
+            except Exception, e:
+                _LOGGER.exception('Error running commit hook: %s' % e)
+        return ret
+    return wrapped
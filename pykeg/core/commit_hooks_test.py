@@ -0,0 +1,62 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.core.commit_hooks"""
+
+import mock
+
+from django.db import connection
+from django.db import transaction
+from django.test import TransactionTestCase
+
+from . import backend
+from . import commit_hooks
+from . import event_notifier
+
+class CommitHooksTestCase(TransactionTestCase):
+    def testOnCommit(self):
+        calls = []
+        commit_hooks.on_commit(lambda: calls.append('now'))
+        self.assertEquals(['now'], calls)
+
+        @commit_hooks.transactional
+        @transaction.atomic
+        def work(fail=False):
+            commit_hooks.on_commit(lambda: calls.append('committed'))
+            self.assertEquals(['now'], calls)
+            if fail:
+                raise ValueError('rollback')
+
+        self.assertRaises(ValueError, work, fail=True)
+        self.assertEquals(['now'], calls)
+        work()
+        self.assertEquals(['now', 'committed'], calls)
+
+    def testEventsNotifiedAfterCommit(self):
+        be = backend.KegbotBackend()
+        be.create_tap('tap0', 'kegboard.flow0', ml_per_tick=1/2200.0)
+        in_transaction = []
+        def notify():
+            in_transaction.append(connection.in_atomic_block)
+        with mock.patch.object(event_notifier, 'notify', notify):
+            be.start_keg('kegboard.flow0', beverage_name='Unknown',
+                beverage_type='beer', producer_name='Unknown',
+                style_name='Unknown')
+            be.record_drink('kegboard.flow0', ticks=1, volume_ml=100)
+        self.assertTrue(in_transaction)
+        self.assertEquals([False] * len(in_transaction), in_transaction)
@@ -0,0 +1,83 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process notification of new SystemEvents.
+
+Threads waiting for new events, such as long-poll API requests, block in
+`wait()` until `notify()` is called for a new event, which happens once the
+transaction creating it has committed (see `commit_hooks`).  Notifications
+only reach threads of the same process, so waiters should still check for
+events created elsewhere now and then.
+
+Each waiting thread holds a server thread, so at most
+settings.KEGBOT_MAX_EVENT_WAITERS threads per process may wait at once.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+# Default for settings.KEGBOT_MAX_EVENT_WAITERS.
+MAX_WAITERS = 20
+
+_condition = threading.Condition()
+_generation = 0
+_waiters = 0
+
+def max_waiters():
+    """Returns the maximum number of threads which may wait at once."""
+    return getattr(settings, 'KEGBOT_MAX_EVENT_WAITERS', MAX_WAITERS)
+
+def generation():
+    """Returns a counter which changes whenever `notify()` is called."""
+    return _generation
+
+def notify():
+    """Wakes all threads waiting for new events."""
+    global _generation
+    with _condition:
+        _generation += 1
+        _condition.notify_all()
+
+def wait(last_generation, timeout):
+    """Blocks until there is a notification after `last_generation`.
+
+    Args:
+        last_generation: A value previously returned by `generation()`.
+        timeout: Maximum number of seconds to wait.
+
+    Returns:
+        The current generation, which equals `last_generation` if the wait
+        timed out, or None if `max_waiters()` threads were already waiting.
+    """
+    global _waiters
+    deadline = time.time() + timeout
+    with _condition:
+        if _waiters >= max_waiters():
+            return None
+        _waiters += 1
+        try:
+            while _generation == last_generation:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                _condition.wait(remaining)
+            return _generation
+        finally:
+            _waiters -= 1
@@ -0,0 +1,107 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bulk regeneration of system events."""
+
+import heapq
+
+from django.db import transaction
+
+from pykeg.core import event_notifier
+from pykeg.core import models
+
+# Number of events to write per database query.
+DEFAULT_BATCH_SIZE = 500
+
+# Order of items at the same time: kegs are tapped before drinks are poured
+# from them, and ended after.
+_TAPPED, _POURED, _ENDED = range(3)
+
+def _stream(progress_fn):
+    """Yields all events, unsaved, in time order.
+
+    Drinks and kegs are streamed from the database and merged by time.
+    Remaining keg volumes are tracked in memory from the drinks; spills,
+    whose times are not recorded, are not counted.
+    """
+    drinks = models.Drink.objects.select_related('session', 'keg')
+    drinks = drinks.order_by('time', 'id')
+    total = drinks.count()
+    kegs = models.Keg.objects.all()
+    tapped = kegs.order_by('start_time', 'id').values_list('start_time', 'id')
+    ended = kegs.filter(online=False).order_by('end_time', 'id')
+    ended = ended.values_list('end_time', 'id')
+
+    items = heapq.merge(
+        ((t, _TAPPED, keg_id, None) for t, keg_id in tapped.iterator()),
+        ((d.time, _POURED, d.id, d) for d in drinks.iterator()),
+        ((t, _ENDED, keg_id, None) for t, keg_id in ended.iterator()))
+
+    SystemEvent = models.SystemEvent
+    sessions = set()
+    drinkers = set()
+    keg_volumes = {}
+    pos = 0
+    for t, kind, item_id, drink in items:
+        if kind == _TAPPED:
+            yield SystemEvent(kind=SystemEvent.KEG_TAPPED, time=t, keg_id=item_id)
+        elif kind == _ENDED:
+            yield SystemEvent(kind=SystemEvent.KEG_ENDED, time=t, keg_id=item_id)
+        else:
+            for event in SystemEvent.events_for_drink(drink, sessions,
+                    drinkers, keg_volumes):
+                yield event
+            pos += 1
+            if progress_fn:
+                progress_fn(pos, total)
+
+def regenerate_all(batch_size=DEFAULT_BATCH_SIZE, progress_fn=None):
+    """Deletes and regenerates all system events in one pass.
+
+    Keg tapped and ended events, and the events of each drink, are built
+    in time order and written with `bulk_create` in batches of
+    `batch_size`.  Drink events are built by `SystemEvent.events_for_drink()`,
+    as for new drinks.
+
+    Args:
+        batch_size: Number of events to write per query.
+        progress_fn: If given, called as `progress_fn(pos, total)` after each
+            drink.
+
+    Returns:
+        A tuple of the number of drinks and the number of events.
+    """
+    with transaction.atomic():
+        # A single DELETE: nothing refers to events.
+        models.SystemEvent.objects.all().delete()
+
+        num_drinks = num_events = 0
+        batch = []
+        for event in _stream(progress_fn):
+            if event.kind == models.SystemEvent.DRINK_POURED:
+                num_drinks += 1
+            batch.append(event)
+            if len(batch) >= batch_size:
+                models.SystemEvent.objects.bulk_create(batch)
+                num_events += len(batch)
+                batch = []
+        models.SystemEvent.objects.bulk_create(batch)
+        num_events += len(batch)
+
+    event_notifier.notify()
+    return num_drinks, num_events
@@ -0,0 +1,153 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.core.events"""
+
+import datetime
+
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from . import backend
+from . import defaults
+from . import events
+from . import models
+from .testutils import make_datetime
+
+class EventsTestCase(TransactionTestCase):
+    def setUp(self):
+        self.backend = backend.KegbotBackend()
+        defaults.set_defaults(set_is_setup=True)
+        self.tap = models.KegTap.objects.all().order_by('id')[0]
+        self.base_time = make_datetime(2014, 1, 1, 18, 0)
+        self.keg = self.start_keg(-60)
+        self.users = [self.backend.create_new_user('user%d' % i) for i in range(2)]
+
+    def start_keg(self, minutes):
+        return self.backend.start_keg(self.tap.meter_name, beverage_name='Beer',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown',
+            full_volume_ml=1000,
+            when=self.base_time + datetime.timedelta(minutes=minutes))
+
+    def pour(self, user, minutes, volume_ml=100, **kwargs):
+        return self.backend.record_drink(self.tap.meter_name, ticks=0,
+            volume_ml=volume_ml, username=user.username,
+            pour_time=self.base_time + datetime.timedelta(minutes=minutes),
+            **kwargs)
+
+    def all_events(self):
+        """Returns all events, in order."""
+        return [(e.kind, e.drink_id, e.user_id, e.keg_id, e.session_id, e.time)
+            for e in models.SystemEvent.objects.order_by('id')]
+
+    def drink_events(self):
+        """Returns all drink events, in order."""
+        return [e for e in self.all_events() if e[1]]
+
+    def testPourEvents(self):
+        d0 = self.pour(self.users[0], 0)
+        with CaptureQueriesContext(connection) as ctx:
+            d1 = self.pour(self.users[1], 1)
+        # One insert for all events, and no checks for existing ones.
+        writes = [q['sql'] for q in ctx.captured_queries
+            if 'INSERT INTO "core_systemevent"' in q['sql']]
+        self.assertEquals(1, len(writes))
+        self.assertEquals([], [q['sql'] for q in ctx.captured_queries
+            if 'COUNT(*)' in q['sql'] and 'core_systemevent' in q['sql']])
+
+        d2 = self.pour(self.users[0], 2)
+        session_id = d0.session_id
+        self.assertEquals([
+            ('session_started', d0.id, self.users[0].id, None, session_id, d0.time),
+            ('session_joined', d0.id, self.users[0].id, None, session_id, d0.time),
+            ('drink_poured', d0.id, self.users[0].id, self.keg.id, session_id, d0.time),
+            ('session_joined', d1.id, self.users[1].id, None, session_id, d1.time),
+            ('drink_poured', d1.id, self.users[1].id, self.keg.id, session_id, d1.time),
+            ('drink_poured', d2.id, self.users[0].id, self.keg.id, session_id, d2.time),
+        ], self.drink_events())
+
+    def testVolumeLowInBatch(self):
+        # The keg crosses 15% of its 1000 mL with the second drink only.
+        pours = [{'ticks': 0, 'volume_ml': v,
+            'pour_time': self.base_time + datetime.timedelta(minutes=i)}
+            for i, v in enumerate((400, 450, 50, 50))]
+        drinks = self.backend.record_drinks(self.tap.meter_name, pours)
+        low = models.SystemEvent.objects.filter(
+            kind=models.SystemEvent.KEG_VOLUME_LOW)
+        self.assertEquals([drinks[1].id], [e.drink_id for e in low])
+
+    def testVolumeLowDeferred(self):
+        drinks = [self.pour(self.users[0], i, volume_ml=v, do_postprocess=False)
+            for i, v in enumerate((400, 450, 50, 50))]
+        self.backend.process_pending_drinks()
+        low = models.SystemEvent.objects.filter(
+            kind=models.SystemEvent.KEG_VOLUME_LOW)
+        self.assertEquals([drinks[1].id], [e.drink_id for e in low])
+
+    def testDeferredMatchesInline(self):
+        self.pour(self.users[0], 0)
+        self.pour(self.users[1], 1)
+        self.backend.process_pending_drinks()
+        self.pour(self.users[1], 2, do_postprocess=False)
+        self.pour(self.users[0], 3, do_postprocess=False)
+        self.pour(self.users[0], 1000, do_postprocess=False)
+        self.backend.process_pending_drinks()
+        expected = self.drink_events()
+        self.assertEquals(10, len(expected))
+
+        num_drinks, num_events = events.regenerate_all(batch_size=2)
+        self.assertEquals((5, 11), (num_drinks, num_events))
+        self.assertEquals(sorted(expected),
+            sorted(self.drink_events()))
+
+    def testKegEventsOnce(self):
+        """Keg events are only generated once per keg."""
+        build = models.SystemEvent.build_events_for_keg
+        self.assertEquals([], build(self.keg))
+        tapped = self.keg.events.filter(kind='keg_tapped')
+        self.assertEquals(1, tapped.count())
+
+        keg = self.backend.end_keg(self.tap.meter_name)
+        self.assertEquals([], build(keg))
+        self.assertEquals([], build(keg))
+        self.assertEquals(1, keg.events.filter(kind='keg_ended').count())
+        self.assertEquals(1, tapped.count())
+
+    def testRegenerateAll(self):
+        for i in range(9):
+            self.pour(self.users[i % 2], i * 10)
+        low = models.SystemEvent.objects.filter(kind='keg_volume_low')
+        self.assertEquals(1, low.count())
+        self.backend.end_keg(self.tap.meter_name)
+        keg = self.start_keg(200)
+        self.pour(self.users[0], 210)
+        expected = self.all_events()
+
+        with CaptureQueriesContext(connection) as ctx:
+            num_drinks, num_events = events.regenerate_all(batch_size=4)
+        self.assertEquals((10, len(expected)), (num_drinks, num_events))
+        self.assertLess(len(ctx.captured_queries), 15)
+
+        actual = self.all_events()
+        self.assertEquals(sorted(expected), sorted(actual))
+        self.assertEquals(sorted(actual, key=lambda e: e[-1]), actual)
+        self.assertEquals(('keg_tapped', None, None, self.keg.id, None,
+            self.keg.start_time), actual[0])
+        self.assertEquals(('keg_tapped', None, None, keg.id, None,
+            keg.start_time), actual[-3])
@@ -0,0 +1,318 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Process-local cache of frequently read, rarely written state.
+
+The site and its settings, taps, the active keg on each tap, the current
+session and the ids of temperature sensors are read by every request, pour
+or reading, but change far less often.  This module keeps them in memory,
+tagged with the generation of a cache namespace.  Each read checks
+the generation in the shared cache, and reloads from the database only if
+another process changed it.
+
+Model signal handlers (see models.py) call `update()` or `invalidate()` when
+the underlying rows are saved.  Writers in this process update their copy in
+place, so the next read does not need the database either.
+
+Values read or written inside a transaction may be rolled back, so they are
+only kept if the transaction was started by a function decorated with
+`transactional`, and only once it commits.
+
+Values are only kept if the cache is shared by all processes (see
+`cache.is_shared()`); otherwise changes made by one process could never
+reach the others, and every read goes to the database.
+
+Objects returned by this module are copies, which callers may modify.
+"""
+
+import copy
+import threading
+from functools import wraps
+
+from django.db import connection
+
+from pykeg.core import cache
+
+# Entry names, which are also the names of their cache namespaces.
+SITE = 'hotstate:site'
+TAPS = 'hotstate:taps'
+KEGS = 'hotstate:kegs'
+SESSION = 'hotstate:session'
+SENSORS = 'hotstate:sensors'
+
+class HotState(object):
+    """A set of named values, each valid for one namespace generation."""
+
+    def __init__(self, kbcache=None):
+        # Generations are never memoized: a stale generation would hide
+        # changes made by other processes.
+        self.kbcache = kbcache or cache.KegbotCache(memo_seconds=0)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._local = threading.local()
+
+    def get(self, name, load_fn):
+        """Returns the current value of `name`, loading it if needed.
+
+        Args:
+            name: The entry name.
+            load_fn: Function which loads the value from the database.
+        """
+        if not cache.is_shared():
+            return load_fn()
+        generation = self.kbcache.get_generations([name])[name]
+        entry = self._get_entry(name)
+        if entry and entry[0] == generation:
+            return entry[1]
+        value = load_fn()
+        self._set_entry(name, generation, value, False)
+        return value
+
+    def update(self, name, update_fn):
+        """Records a write to the data behind `name`.
+
+        The namespace generation is incremented, so other processes reload
+        the value.  If this process's value was current before the write, it
+        is replaced with `update_fn(value)` and stays current; otherwise it is
+        dropped.
+        """
+        generation = self.kbcache.update_namespace(name)
+        entry = self._get_entry(name)
+        with self._lock:
+            self._entries.pop(name, None)
+        if entry and entry[0] == generation - 1:
+            self._set_entry(name, generation, update_fn(entry[1]), True)
+
+    def invalidate(self, *names):
+        """Drops the given values in every process."""
+        for name in names:
+            self.kbcache.update_namespace(name)
+        self.clear(*names)
+
+    def clear(self, *names):
+        """Drops values in this process only; by default, all of them."""
+        pending = self._pending()
+        with self._lock:
+            for name in names or self._entries.keys():
+                self._entries.pop(name, None)
+        if pending is not None:
+            for name in names or pending.keys():
+                pending.pop(name, None)
+
+    def begin(self):
+        """Starts holding values read or written in this thread.
+
+        Returns:
+            False if values are already being held, in which case the
+            outermost caller must end with `commit()` or `rollback()`.
+        """
+        if self._pending() is not None:
+            return False
+        self._local.pending = {}
+        return True
+
+    def commit(self):
+        """Keeps the values held since `begin()`.
+
+        Written values are updated once more, since other processes may
+        have reloaded the old rows before the transaction committed.
+        """
+        pending = self._pending()
+        self._local.pending = None
+        if connection.in_atomic_block:
+            # The caller's own transaction may still be rolled back.
+            self.clear(*pending.keys())
+            return
+        for name, (generation, value, written) in pending.iteritems():
+            if written:
+                current = self.kbcache.update_namespace(name) - 1
+            else:
+                current = self.kbcache.get_generations([name])[name]
+            if current == generation:
+                self._set_entry(name, current + int(written), value, False)
+
+    def rollback(self):
+        """Drops the values held since `begin()`."""
+        pending = self._pending()
+        self._local.pending = None
+        self.clear(*pending.keys())
+
+    def _pending(self):
+        return getattr(self._local, 'pending', None)
+
+    def _get_entry(self, name):
+        pending = self._pending()
+        if pending and name in pending:
+            return pending[name][:2]
+        with self._lock:
+            return self._entries.get(name)
+
+    def _set_entry(self, name, generation, value, written):
+        if not connection.in_atomic_block:
+            with self._lock:
+                self._entries[name] = (generation, value)
+            return
+        pending = self._pending()
+        if pending is not None:
+            written = written or pending.get(name, (None, None, False))[2]
+            pending[name] = (generation, value, written)
+
+
+_STATE = HotState()
+
+def get_site():
+    """Returns the default site with its settings attached, or None."""
+    return _get_site()[0]
+
+def get_site_settings():
+    """Returns the default site's settings, or None."""
+    return _get_site()[1]
+
+def get_taps():
+    """Returns all taps, ordered by name, with their current kegs."""
+    taps = _STATE.get(TAPS, _load_taps)
+    kegs = _STATE.get(KEGS, _load_kegs)
+    return [_with_keg(tap, kegs) for tap in sorted(taps.values(), key=lambda t: t.name)]
+
+def get_tap(meter_name):
+    """Returns the tap with the given meter name and its keg, or None."""
+    tap = _STATE.get(TAPS, _load_taps).get(meter_name)
+    if not tap:
+        return None
+    return _with_keg(tap, _STATE.get(KEGS, _load_kegs))
+
+def get_current_session():
+    """Returns the session which ends last, which may no longer be active."""
+    session = _STATE.get(SESSION, _load_session)
+    return copy.copy(session)
+
+def get_sensor_ids():
+    """Returns a dict of the id of each ThermoSensor, by raw name."""
+    return dict(_STATE.get(SENSORS, _load_sensors))
+
+def transactional(f):
+    """Decorator for functions which read or write hot state in a transaction.
+
+    Values read or written by the function are kept only if it returns
+    without raising, and only if no transaction is still open at that point.
+    """
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        if not _STATE.begin():
+            return f(*args, **kwargs)
+        try:
+            ret = f(*args, **kwargs)
+        except Exception:
+            _STATE.rollback()
+            raise
+        _STATE.commit()
+        return ret
+    return wrapped
+
+def site_saved(site):
+    def update_fn(value):
+        if not value or not value[1]:
+            return _load_site()
+        if value[0].id != site.id:
+            return value
+        return (copy.copy(site), value[1])
+    _STATE.update(SITE, update_fn)
+
+def site_settings_saved(settings):
+    def update_fn(value):
+        if not value:
+            return _load_site()
+        if value[0].id != settings.site_id:
+            return value
+        return (value[0], copy.copy(settings))
+    _STATE.update(SITE, update_fn)
+
+def tap_changed():
+    invalidate(TAPS, KEGS)
+
+def sensor_changed():
+    invalidate(SENSORS)
+
+def keg_saved(keg):
+    def update_fn(kegs):
+        if keg.id not in [k.id for k in kegs.values()]:
+            return kegs
+        return dict((tap_id, copy.copy(keg) if k.id == keg.id else k)
+            for tap_id, k in kegs.iteritems())
+    _STATE.update(KEGS, update_fn)
+
+def session_saved(session):
+    def update_fn(current):
+        if current and current.id != session.id and current.end_time > session.end_time:
+            return current
+        return copy.copy(session)
+    _STATE.update(SESSION, update_fn)
+
+def invalidate(*names):
+    _STATE.invalidate(*names)
+
+def clear():
+    _STATE.clear()
+
+def _get_site():
+    value = _STATE.get(SITE, _load_site)
+    if not value:
+        return None, None
+    site = copy.copy(value[0])
+    settings = None
+    if value[1]:
+        settings = copy.copy(value[1])
+        site.settings = settings
+    return site, settings
+
+def _with_keg(tap, kegs):
+    tap = copy.copy(tap)
+    keg = kegs.get(tap.id)
+    if keg:
+        tap.current_keg = copy.copy(keg)
+    return tap
+
+def _load_site():
+    from pykeg.core import models
+    sites = models.KegbotSite.objects.filter(name='default')
+    if not sites:
+        return None
+    site = sites[0]
+    try:
+        settings = site.settings
+    except models.SiteSettings.DoesNotExist:
+        settings = None
+    return (site, settings)
+
+def _load_taps():
+    from pykeg.core import models
+    return dict((t.meter_name, t) for t in models.KegTap.objects.all())
+
+def _load_kegs():
+    from pykeg.core import models
+    taps = models.KegTap.objects.filter(current_keg__isnull=False)
+    return dict((t.id, t.current_keg) for t in taps.select_related('current_keg'))
+
+def _load_session():
+    from pykeg.core import models
+    sessions = models.DrinkingSession.objects.all().order_by('-end_time')[:1]
+    return sessions[0] if sessions else None
+
+def _load_sensors():
+    from pykeg.core import models
+    return dict(models.ThermoSensor.objects.values_list('raw_name', 'id'))
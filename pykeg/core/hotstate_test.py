@@ -0,0 +1,111 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.core.hotstate"""
+
+from django.db import connection
+from django.db import transaction
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+
+from pykeg.core import backend
+from pykeg.core import cache
+from pykeg.core import models
+
+from . import hotstate
+
+TAP_NAME = 'kegboard.flow0'
+
+class HotStateTestCase(TransactionTestCase):
+    def setUp(self):
+        self.backend = backend.KegbotBackend()
+        self.tap = self.backend.create_tap('tap0', TAP_NAME, ml_per_tick=1/2200.0)
+        self.keg = self.backend.start_keg(TAP_NAME, beverage_name='Beer',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+
+    def hot_queries(self, queries):
+        tables = ('"core_kegtap"', '"core_keg"', '"core_drinkingsession"')
+        return [q['sql'] for q in queries if q['sql'].startswith('SELECT')
+            and q['sql'].split(' FROM ')[1].split(' ')[0] in tables]
+
+    def testPourReadsNoHotState(self):
+        self.backend.record_drink(TAP_NAME, ticks=2200, do_postprocess=False)
+        with CaptureQueriesContext(connection) as ctx:
+            drink = self.backend.record_drink(TAP_NAME, ticks=2200,
+                do_postprocess=False)
+        self.assertEquals([], self.hot_queries(ctx.captured_queries))
+
+        tap = hotstate.get_tap(TAP_NAME)
+        self.assertEquals(self.keg.id, tap.current_keg.id)
+        self.assertAlmostEqual(2.0, tap.current_keg.served_volume_ml, places=3)
+        self.assertEquals(drink.session_id, hotstate.get_current_session().id)
+        self.assertIsNone(hotstate.get_tap('kegboard.unknown'))
+
+    def testChangedElsewhere(self):
+        self.assertEquals(['tap0'], [t.name for t in hotstate.get_taps()])
+
+        # Not seen until the namespace is updated, as another process would.
+        models.KegTap.objects.filter(id=self.tap.id).update(name='renamed')
+        self.assertEquals(['tap0'], [t.name for t in hotstate.get_taps()])
+        cache.KegbotCache().update_namespace(hotstate.TAPS)
+        self.assertEquals(['renamed'], [t.name for t in hotstate.get_taps()])
+
+        self.backend.end_keg(TAP_NAME)
+        self.assertIsNone(hotstate.get_tap(TAP_NAME).current_keg)
+
+    @override_settings(KEGBOT_SHARED_CACHE=False)
+    def testUnsharedCache(self):
+        """Nothing is kept if other processes could not see changes."""
+        hotstate.get_taps()
+        models.KegTap.objects.filter(id=self.tap.id).update(name='renamed')
+        self.assertEquals(['renamed'], [t.name for t in hotstate.get_taps()])
+
+    def testRollback(self):
+        try:
+            with transaction.atomic():
+                self.backend.record_drink(TAP_NAME, ticks=2200,
+                    do_postprocess=False)
+                self.assertIsNotNone(hotstate.get_current_session())
+                raise ValueError('rollback')
+        except ValueError:
+            pass
+        self.assertIsNone(hotstate.get_current_session())
+        self.assertEquals(0, hotstate.get_tap(TAP_NAME).current_keg.served_volume_ml)
+
+    def testSiteSettings(self):
+        models.KegbotSite.get()
+        settings = models.SiteSettings.get()
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEquals(settings.site_id, models.KegbotSite.get().id)
+            self.assertEquals(settings.title, models.SiteSettings.get().title)
+        self.assertEquals([], ctx.captured_queries)
+
+        # Returned objects are copies.
+        settings.title = 'Unsaved'
+        self.assertEquals('My Kegbot', models.SiteSettings.get().title)
+
+        settings.save()
+        self.assertEquals('Unsaved', models.SiteSettings.get().title)
+        self.assertEquals('Unsaved', models.KegbotSite.get().settings.title)
+
+        site = models.KegbotSite.get()
+        site.is_setup = True
+        site.save()
+        self.assertTrue(models.KegbotSite.get().is_setup)
+        self.assertEquals('Unsaved', models.KegbotSite.get().settings.title)
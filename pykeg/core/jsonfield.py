@@ -77,8 +77,8 @@ class JSONField(models.TextField):
         if not value:
             return super(JSONField, self).get_db_prep_save("", connection=connection)
         else:
-            return super(JSONField, self).get_db_prep_save(kbjson.dumps(value),
-                connection=connection)
+            return super(JSONField, self).get_db_prep_save(
+                kbjson.dumps(value, indent=None), connection=connection)
 
 try:
     from south.modelsinspector import add_introspection_rules
@@ -41,6 +41,13 @@ THERMO_SENSOR_RANGE = (-20.0, 80.0)
 # Maximum number of readings to keep.
 THERMO_SENSOR_HISTORY_MINUTES = 60 * 24
 
+# Days of thermo sensor rollups to keep, by rollup length in seconds.  Daily
+# rollups are kept forever.
+THERMO_ROLLUP_HISTORY_DAYS = {
+    5 * 60: 14,
+    60 * 60: 366,
+}
+
 # Device names
 AUTH_MODULE_CORE_ONEWIRE = 'core.onewire'
 AUTH_MODULE_CORE_RFID = 'core.rfid'
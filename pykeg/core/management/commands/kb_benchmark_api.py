@@ -0,0 +1,78 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.core.management.base import NoArgsCommand
+from kegbot.api import protoutil
+from kegbot.util import kbjson
+
+from pykeg.core import models
+from pykeg.proto import protolib
+
+# List endpoints, and the objects each one serializes.
+ENDPOINTS = (
+    ('drinks', lambda: models.Drink.objects.all().order_by('-id')),
+    ('events', lambda: models.SystemEvent.objects.all().order_by('-id')),
+    ('kegs', lambda: models.Keg.objects.all().order_by('-start_time')),
+    ('taps', lambda: models.KegTap.objects.all().order_by('name')),
+    ('sessions', lambda: models.DrinkingSession.objects.all()),
+    ('users', lambda: models.User.objects.filter(is_active=True)),
+)
+
+def _proto_path(qs):
+    objs = protolib.ToProtoMany(qs, full=True)
+    return kbjson.dumps([protoutil.ProtoMessageToDict(o) for o in objs])
+
+def _dict_path(qs):
+    return kbjson.dumps(protolib.ToDictMany(qs, full=True))
+
+class Command(NoArgsCommand):
+    help = u'Compare API serialization speed through protobuf and dicts.'
+    args = '<none>'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=1000,
+            help='Maximum number of objects to serialize per endpoint.'),
+        make_option('--iterations', type='int', dest='iterations', default=5,
+            help='Number of times to serialize each endpoint.'),
+    )
+
+    def handle(self, **options):
+        limit = options.get('limit')
+        iterations = options.get('iterations')
+        if limit < 1 or iterations < 1:
+            raise CommandError('--limit and --iterations must be positive')
+
+        print '%-10s %8s %12s %12s %8s' % ('endpoint', 'objects', 'protobuf',
+            'dict', 'speedup')
+        for name, query_fn in ENDPOINTS:
+            objs = list(query_fn()[:limit].values_list('pk', flat=True))
+            results = []
+            for fn in (_proto_path, _dict_path):
+                start = time.time()
+                for i in xrange(iterations):
+                    out = fn(query_fn().filter(pk__in=objs))
+                results.append(((time.time() - start) / iterations, out))
+            (proto_time, proto_out), (dict_time, dict_out) = results
+            if proto_out != dict_out:
+                raise CommandError('Output mismatch for endpoint "%s"' % name)
+            speedup = proto_time / dict_time if dict_time else 0
+            print '%-10s %8d %10.1fms %10.1fms %7.1fx' % (name, len(objs),
+                proto_time * 1000, dict_time * 1000, speedup)
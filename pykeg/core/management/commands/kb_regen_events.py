@@ -16,30 +16,39 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError
 from django.core.management.base import NoArgsCommand
 
-from pykeg.core import models
+from pykeg.core import events
 from pykeg.core.management.commands.common import progbar
 
 class Command(NoArgsCommand):
     help = u'Regenerate all system events.'
     args = '<none>'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=events.DEFAULT_BATCH_SIZE,
+            help='Number of events to write per database insert.'),
+    )
 
     def handle(self, **options):
-        events = models.SystemEvent.objects.all()
-        num_events = len(events)
-        progbar('clear events', 0, num_events)
-        events.delete()
-        progbar('clear events', num_events, num_events)
-        print ''
+        batch_size = options.get('batch_size') or events.DEFAULT_BATCH_SIZE
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
 
-        pos = 0
-        drinks = models.Drink.objects.all()
-        count = drinks.count()
-        for d in drinks.order_by('time'):
-            pos += 1
-            progbar('create new events', pos, count)
-            sess = models.SystemEvent.build_events_for_drink(d)
-        print ''
+        def progress(pos, total):
+            if pos == total or pos % 100 == 0:
+                progbar('create new events', pos, total)
 
+        start = time.time()
+        num_drinks, num_events = events.regenerate_all(
+            batch_size=batch_size, progress_fn=progress)
+        elapsed = time.time() - start
+
+        print ''
+        print 'Regenerated %d events from %d drinks in %.1fs.' % (
+            num_events, num_drinks, elapsed)
         print 'done!'
@@ -16,60 +16,39 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db import connection
+import time
+from optparse import make_option
+
 from django.core.management.base import CommandError
 from django.core.management.base import NoArgsCommand
 
-from pykeg.core import models
+from pykeg.core import sessions
 from pykeg.core.management.commands.common import progbar
 
 class Command(NoArgsCommand):
-    help = u'Regenerate all cached stats.'
+    help = u'Regenerate all drinking sessions.'
     args = '<none>'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=sessions.DEFAULT_BATCH_SIZE,
+            help='Number of sessions to write per database insert.'),
+    )
 
     def handle(self, **options):
-        drinks = models.Drink.objects.all()
-
-        pos = 0
-        count = drinks.count()
-        for d in drinks:
-            pos += 1
-            progbar('clear drink sessions', pos, count)
-            d.session = None
-            d.save()
-        print ''
+        batch_size = options.get('batch_size') or sessions.DEFAULT_BATCH_SIZE
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
 
-        pics = models.Picture.objects.all()
-        count = pics.count()
-        pos = 0
-        for p in pics:
-            pos += 1
-            progbar('clear image sessions', pos, count)
-            p.session = None
-            p.save()
-        print ''
+        def progress(pos, total):
+            if pos == total or pos % 100 == 0:
+                progbar('calc new sessions', pos, total)
 
-        print 'deleting old sessions..',
-        models.DrinkingSession.objects.all().delete()
-        print 'orm delete successful'
+        start = time.time()
+        num_drinks, num_sessions = sessions.regenerate_all(
+            batch_size=batch_size, progress_fn=progress)
+        elapsed = time.time() - start
 
-        pos = 0
-        count = drinks.count()
-        for d in drinks.order_by('time'):
-            pos += 1
-            progbar('calc new sessions', pos, count)
-            sess = models.DrinkingSession.AssignSessionForDrink(d)
         print ''
-
-        pics = models.Picture.objects.all()
-        count = pics.count()
-        pos = 0
-        for p in pics:
-            pos += 1
-            progbar('set image sessions', pos, count)
-            if p.drink:
-                p.session = p.drink.session
-                p.save()
-        print ''
-
+        print 'Regenerated %d sessions from %d drinks in %.1fs.' % (
+            num_sessions, num_drinks, elapsed)
         print 'done!'
@@ -16,29 +16,40 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+from optparse import make_option
+
 from django.core.management.base import CommandError
 from django.core.management.base import NoArgsCommand
-from django.db import transaction
 
-from pykeg.core import models
 from pykeg.core import stats
 from pykeg.core.management.commands.common import progbar
 
 class Command(NoArgsCommand):
     help = u'Regenerate all cached stats.'
     args = '<none>'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=stats.DEFAULT_BATCH_SIZE,
+            help='Number of stats records to write per database insert.'),
+    )
 
-    @transaction.atomic
     def handle(self, **options):
-        stats.invalidate(None)
+        batch_size = options.get('batch_size') or stats.DEFAULT_BATCH_SIZE
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+
+        def progress(pos, total):
+            if pos == total or pos % 100 == 0:
+                progbar('regenerating stats', pos, total)
 
-        drinks = models.Drink.objects.all().order_by('id')
-        num_drinks = len(drinks)
-        pos = 0
-        for d in drinks:
-            pos += 1
-            progbar('regenerating stats', pos, num_drinks)
-            stats.generate(d, invalidate_first=False)
+        start = time.time()
+        num_drinks = stats.generate_all(batch_size=batch_size,
+            progress_fn=progress)
+        elapsed = time.time() - start
 
         print ''
+        rate = num_drinks / elapsed if elapsed else 0
+        print 'Regenerated stats for %d drinks in %.1fs (%.1f drinks/sec).' % (
+            num_drinks, elapsed, rate)
         print 'done!'
@@ -0,0 +1,170 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Records pours in parallel and checks that no update was lost."""
+
+import multiprocessing
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.core.management.base import NoArgsCommand
+from django.db import connections
+from django.db.models import Sum
+
+from pykeg.core import backend
+from pykeg.core import models
+
+# Volumes which differ by less than this are considered equal.
+TOLERANCE_ML = 0.01
+
+def check_invariants():
+    """Checks stored volumes and sessions against the recorded drinks.
+
+    Returns:
+        A list of problems found, empty if there are none.
+    """
+    problems = []
+
+    for keg in models.Keg.objects.annotate(drunk=Sum('drinks__volume_ml')):
+        if abs(keg.served_volume_ml - (keg.drunk or 0)) > TOLERANCE_ML:
+            problems.append('Keg %s: served %s mL, drinks total %s mL' % (
+                keg.id, keg.served_volume_ml, keg.drunk or 0))
+
+    for session in models.DrinkingSession.objects.annotate(drunk=Sum('drinks__volume_ml')):
+        if abs(session.volume_ml - (session.drunk or 0)) > TOLERANCE_ML:
+            problems.append('Session %s: volume %s mL, drinks total %s mL' % (
+                session.id, session.volume_ml, session.drunk or 0))
+
+    for chunk_cls, fields in (
+            (models.SessionChunk, ('session', 'user', 'keg')),
+            (models.UserSessionChunk, ('session', 'user')),
+            (models.KegSessionChunk, ('session', 'keg'))):
+        drunk = models.Drink.objects.order_by().values(*fields).annotate(
+            total=Sum('volume_ml'))
+        expected = dict((tuple(d[f] for f in fields), d['total']) for d in drunk)
+        attnames = tuple('%s_id' % f for f in fields)
+        for chunk in chunk_cls.objects.all():
+            key = tuple(getattr(chunk, f) for f in attnames)
+            total = expected.pop(key, 0)
+            if abs(chunk.volume_ml - total) > TOLERANCE_ML:
+                problems.append('%s %s: volume %s mL, drinks total %s mL' % (
+                    chunk_cls.__name__, chunk.id, chunk.volume_ml, total))
+        for key in expected:
+            problems.append('%s missing for %s' % (chunk_cls.__name__, key))
+
+    previous = None
+    for session in models.DrinkingSession.objects.order_by('start_time'):
+        if previous and session.start_time < previous.end_time:
+            problems.append('Sessions %s and %s overlap' % (previous.id, session.id))
+        previous = session
+
+    return problems
+
+def pour(meter_names, usernames, count, offset):
+    """Records `count` drinks, cycling through taps and users."""
+    b = backend.KegbotBackend()
+    for i in xrange(offset, offset + count):
+        b.record_drink(meter_names[i % len(meter_names)], ticks=0,
+            volume_ml=10, username=usernames[i % len(usernames)])
+
+def run_threads(meter_names, usernames, threads, pours, offset=0):
+    """Runs `threads` concurrent pourers; a single one runs in this thread."""
+    if threads == 1:
+        pour(meter_names, usernames, pours, offset)
+        return
+
+    errors = []
+    def target(offset):
+        try:
+            pour(meter_names, usernames, pours, offset)
+        except Exception, e:
+            errors.append(e)
+        finally:
+            connections['default'].close()
+
+    workers = [threading.Thread(target=target, args=(offset + i * pours,))
+        for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if errors:
+        raise errors[0]
+
+class Command(NoArgsCommand):
+    help = (u'Record drinks from parallel threads and processes, then check '
+        'keg, session and chunk volumes.  Records real drinks on all active '
+        'taps: only run this against a test database.')
+    args = '<none>'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=0,
+            help='Number of processes to pour from, or 0 to pour from '
+                'this process only.'),
+        make_option('--threads', type='int', dest='threads', default=4,
+            help='Number of pouring threads in each process.'),
+        make_option('--pours', type='int', dest='pours', default=50,
+            help='Number of drinks recorded by each thread.'),
+        make_option('--users', type='int', dest='users', default=4,
+            help='Number of drinkers to pour for.'),
+    )
+
+    def handle(self, **options):
+        processes = options.get('processes')
+        threads = options.get('threads')
+        pours = options.get('pours')
+        users = options.get('users')
+        if processes < 0 or threads < 1 or pours < 1 or users < 1:
+            raise CommandError('Invalid --processes, --threads, --pours or --users')
+
+        meter_names = list(models.KegTap.objects.filter(current_keg__isnull=False)
+            .values_list('meter_name', flat=True))
+        if not meter_names:
+            raise CommandError('No taps with active kegs')
+        usernames = ['stress%d' % i for i in range(users)]
+        for username in usernames:
+            models.User.objects.get_or_create(username=username)
+
+        start = time.time()
+        if processes:
+            # Children must not share the parent's database connection.
+            connections['default'].close()
+            workers = [multiprocessing.Process(target=run_threads,
+                args=(meter_names, usernames, threads, pours, i * threads * pours))
+                for i in range(processes)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            if any(w.exitcode for w in workers):
+                raise CommandError('A pouring process failed')
+        else:
+            run_threads(meter_names, usernames, threads, pours)
+        elapsed = time.time() - start
+
+        total = max(processes, 1) * threads * pours
+        print 'Recorded %d drinks on %d taps in %.1fs (%.1f drinks/s)' % (
+            total, len(meter_names), elapsed, total / elapsed)
+
+        problems = check_invariants()
+        for problem in problems:
+            print problem
+        if problems:
+            raise CommandError('%d problems found' % len(problems))
+        print 'All checks passed.'
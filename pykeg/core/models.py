@@ -26,8 +26,13 @@ import re
 from django.contrib.auth.models import AbstractUser
 from django.core.urlresolvers import reverse
 from django.db import IntegrityError
+from django.db import connection
 from django.db import models
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
+from django.db.models.signals import post_syncdb
 from django.db.models.signals import pre_save
 from django.utils import timezone
 
@@ -37,6 +42,9 @@ from imagekit.processors import resize
 
 from pykeg import EPOCH
 
+from pykeg.core import commit_hooks
+from pykeg.core import event_notifier
+from pykeg.core import hotstate
 from pykeg.core import kb_common
 from pykeg.core import keg_sizes
 from pykeg.core import fields
@@ -61,8 +69,8 @@ class User(AbstractUser):
         return reverse('kb-drinker', kwargs={'username': self.username})
 
     def get_stats_record(self):
-        qs = UserStats.objects.filter(user=self).order_by('-id')
-        if len(qs):
+        qs = UserStats.objects.filter(user=self).order_by('-id')[:1]
+        if qs:
             return qs[0]
         return None
 
@@ -93,16 +101,38 @@ class KegbotSite(models.Model):
     serial_number = models.TextField(max_length=128, editable=False,
         blank=True, default='',
         help_text='A unique id for this system.')
+    last_processed_drink_id = models.PositiveIntegerField(default=0,
+        editable=False,
+        help_text='Id of the latest Drink whose stats and events have been generated.')
 
     def __str__(self):
         return self.name
 
     @classmethod
     def get(cls):
-        """Gets the default site settings."""
+        """Gets the default site, creating it if needed."""
+        site = hotstate.get_site()
+        if site:
+            return site
         return KegbotSite.objects.get_or_create(name='default',
             defaults={'is_setup': False})[0]
 
+    @classmethod
+    def get_locked(cls):
+        """Gets the default site, locking its row until the transaction ends.
+
+        The site row serializes work which must not run concurrently, such as
+        processing drinks and starting sessions.  Where both are done in one
+        transaction, the site must be locked before any other row.
+
+        Databases without row locks, such as SQLite, are locked for writing
+        instead.
+        """
+        if not connection.features.has_select_for_update:
+            KegbotSite.objects.filter(name='default').update(name='default')
+        return KegbotSite.objects.select_for_update().get_or_create(
+            name='default', defaults={'is_setup': False})[0]
+
     def GetStatsRecord(self):
         try:
             return SystemStats.objects.latest()
@@ -126,6 +156,14 @@ def _kegbotsite_post_save(sender, instance, **kwargs):
     settings, _ = SiteSettings.objects.get_or_create(site=instance)
 post_save.connect(_kegbotsite_post_save, sender=KegbotSite)
 
+def _kegbotsite_changed(sender, instance, **kwargs):
+    if kwargs.get('created') is False:
+        hotstate.site_saved(instance)
+    else:
+        hotstate.invalidate(hotstate.SITE)
+post_save.connect(_kegbotsite_changed, sender=KegbotSite)
+post_delete.connect(_kegbotsite_changed, sender=KegbotSite)
+
 class SiteSettings(models.Model):
     """General system-wide settings."""
     VOLUME_DISPLAY_UNITS_CHOICES = (
@@ -217,8 +255,19 @@ class SiteSettings(models.Model):
     @classmethod
     def get(cls):
         """Gets the default site settings."""
+        settings = hotstate.get_site_settings()
+        if settings:
+            return settings
         return KegbotSite.get().settings
 
+def _sitesettings_changed(sender, instance, **kwargs):
+    if kwargs.get('created') is False:
+        hotstate.site_settings_saved(instance)
+    else:
+        hotstate.invalidate(hotstate.SITE)
+post_save.connect(_sitesettings_changed, sender=SiteSettings)
+post_delete.connect(_sitesettings_changed, sender=SiteSettings)
+
 
 class ApiKey(models.Model):
     """Grants access to certain API endpoints to a user via a secret key."""
@@ -364,6 +413,10 @@ class KegTap(models.Model):
                 return last_rec[0]
         return None
 
+def _kegtap_changed(sender, instance, **kwargs):
+    hotstate.tap_changed()
+post_save.connect(_kegtap_changed, sender=KegTap)
+post_delete.connect(_kegtap_changed, sender=KegTap)
 
 class Keg(models.Model):
     """Record for each physical Keg."""
@@ -424,6 +477,21 @@ class Keg(models.Model):
     def is_empty(self):
         return float(self.remaining_volume_ml()) <= 0
 
+    def add_volume(self, served_ml=0, spilled_ml=0):
+        """Adds to the served and spilled volumes, saving the change.
+
+        The volumes are incremented with F() expressions, so concurrent
+        changes to the keg are never lost.  This instance is updated too,
+        but does not include other concurrent changes.
+        """
+        Keg.objects.filter(pk=self.pk).update(
+            served_volume_ml=F('served_volume_ml') + served_ml,
+            spilled_ml=F('spilled_ml') + spilled_ml)
+        self.served_volume_ml += served_ml
+        self.spilled_ml += spilled_ml
+        # No post_save signal is sent for the UPDATE.
+        hotstate.keg_saved(self)
+
     def previous(self):
         q = Keg.objects.filter(start_time__lt=self.start_time).order_by('-start_time')
         if q.count():
@@ -437,8 +505,8 @@ class Keg(models.Model):
         return None
 
     def GetStatsRecord(self):
-        qs = KegStats.objects.filter(keg=self).order_by('-id')
-        if len(qs):
+        qs = KegStats.objects.filter(keg=self).order_by('-id')[:1]
+        if qs:
             return qs[0]
         return None
 
@@ -501,6 +569,14 @@ def _keg_pre_save(sender, instance, **kwargs):
 
 pre_save.connect(_keg_pre_save, sender=Keg)
 
+def _keg_post_save(sender, instance, **kwargs):
+    hotstate.keg_saved(instance)
+post_save.connect(_keg_post_save, sender=Keg)
+
+def _keg_post_delete(sender, instance, **kwargs):
+    hotstate.invalidate(hotstate.KEGS)
+post_delete.connect(_keg_post_delete, sender=Keg)
+
 
 class Drink(models.Model):
     """ Table of drinks records """
@@ -534,6 +610,11 @@ class Drink(models.Model):
         on_delete=models.SET_NULL,
         help_text='Picture snapped with this drink.')
 
+    # Set by DrinkingSession.AssignSessionForDrink() when the drink is
+    # recorded, and None for drinks loaded from the database.
+    started_session = None
+    joined_session = None
+
     def get_absolute_url(self):
         return reverse('kb-drink', args=(str(self.id),))
 
@@ -549,6 +630,10 @@ class Drink(models.Model):
         ounces = self.Volume().InOunces()
         return self.keg.type.calories_oz * ounces
 
+    def is_processed(self):
+        """Returns True if stats and events have been generated for this Drink."""
+        return self.id <= KegbotSite.get().last_processed_drink_id
+
     def __str__(self):
         return "Drink %i by %s" % (self.id, self.user)
 
@@ -636,8 +721,72 @@ class _AbstractChunk(models.Model):
         self.volume_ml += drink.volume_ml
 
     def AddDrink(self, drink):
-        self._AddDrinkNoSave(drink)
-        self.save()
+        """Adds a drink to this chunk, saving the change.
+
+        The common case, a drink no earlier than the chunk's start which does
+        not shorten it, is a single UPDATE adding the volume with an F()
+        expression, so concurrent pours are never lost.  Other drinks are
+        added to a locked copy of the row.
+        """
+        if self._AddDrinkToQuery(drink, type(self).objects.filter(pk=self.pk)):
+            self._AddDrinkNoSave(drink)
+            return
+        with transaction.atomic():
+            chunk = type(self).objects.select_for_update().get(pk=self.pk)
+            chunk._AddDrinkNoSave(drink)
+            chunk.save()
+        self.start_time = chunk.start_time
+        self.end_time = chunk.end_time
+        self.volume_ml = chunk.volume_ml
+
+    @classmethod
+    def AddDrinkToChunk(cls, drink, **lookup):
+        """Adds a drink to the chunk matching `lookup`, creating it if needed.
+
+        Like `AddDrink()`, this is usually a single UPDATE.  An existing chunk
+        is only ever changed with F() expression UPDATEs, never rewritten from
+        a copy read earlier, so concurrent pours are never lost.
+
+        Returns:
+            True if the chunk was created.
+        """
+        chunks = cls.objects.filter(**lookup)
+        if cls._AddDrinkToQuery(drink, chunks):
+            return False
+        if not chunks.exists():
+            try:
+                with transaction.atomic():
+                    cls.objects.create(start_time=drink.time,
+                        end_time=drink.time + SiteSettings.get().GetSessionTimeoutDelta(),
+                        volume_ml=drink.volume_ml, **lookup)
+                return True
+            except IntegrityError:
+                # Created by a concurrent pour; add to it instead.
+                if cls._AddDrinkToQuery(drink, chunks):
+                    return False
+        cls._ExtendQuery(drink, chunks)
+        return False
+
+    @classmethod
+    def _AddDrinkToQuery(cls, drink, chunks):
+        """Adds a drink to `chunks` in place, if it falls at their end.
+
+        Returns:
+            The number of chunks updated.
+        """
+        session_end = drink.time + SiteSettings.get().GetSessionTimeoutDelta()
+        chunks = chunks.filter(start_time__lte=drink.time, end_time__lte=session_end)
+        return chunks.update(volume_ml=F('volume_ml') + drink.volume_ml,
+            end_time=session_end)
+
+    @classmethod
+    def _ExtendQuery(cls, drink, chunks):
+        """Adds any drink to `chunks` in place, widening them to include it."""
+        session_end = drink.time + SiteSettings.get().GetSessionTimeoutDelta()
+        with transaction.atomic():
+            chunks.update(volume_ml=F('volume_ml') + drink.volume_ml)
+            chunks.filter(start_time__gt=drink.time).update(start_time=drink.time)
+            chunks.filter(end_time__lt=session_end).update(end_time=session_end)
 
 
 class DrinkingSession(_AbstractChunk):
@@ -682,8 +831,8 @@ class DrinkingSession(_AbstractChunk):
           'pk' : self.pk})
 
     def GetStatsRecord(self):
-        qs = SessionStats.objects.filter(session=self).order_by('-id')
-        if len(qs):
+        qs = SessionStats.objects.filter(session=self).order_by('-id')[:1]
+        if qs:
             return qs[0]
         return None
 
@@ -736,27 +885,16 @@ class DrinkingSession(_AbstractChunk):
 
     def AddDrink(self, drink):
         super(DrinkingSession, self).AddDrink(drink)
-        session_delta = SiteSettings.get().GetSessionTimeoutDelta()
-
-        defaults = {
-          'start_time': drink.time,
-          'end_time': drink.time + session_delta,
-        }
+        # The session row may have been updated without a post_save signal.
+        hotstate.session_saved(self)
+        self._AddDrinkToChunks(drink)
 
-        # Update or create a SessionChunk.
-        chunk, created = SessionChunk.objects.get_or_create(session=self,
-            user=drink.user, keg=drink.keg, defaults=defaults)
-        chunk.AddDrink(drink)
-
-        # Update or create a UserSessionChunk.
-        chunk, created = UserSessionChunk.objects.get_or_create(session=self,
-            user=drink.user, defaults=defaults)
-        chunk.AddDrink(drink)
-
-        # Update or create a KegSessionChunk.
-        chunk, created = KegSessionChunk.objects.get_or_create(session=self,
-            keg=drink.keg, defaults=defaults)
-        chunk.AddDrink(drink)
+    def _AddDrinkToChunks(self, drink):
+        SessionChunk.AddDrinkToChunk(drink, session=self, user=drink.user,
+            keg=drink.keg)
+        drink.joined_session = UserSessionChunk.AddDrinkToChunk(drink,
+            session=self, user=drink.user)
+        KegSessionChunk.AddDrinkToChunk(drink, session=self, keg=drink.keg)
 
     def UserChunksByVolume(self):
         chunks = self.user_chunks.all().order_by('-volume_ml')
@@ -790,7 +928,8 @@ class DrinkingSession(_AbstractChunk):
         min_time = None
         max_time = None
         for d in drinks:
-            self.AddDrink(d)
+            self._AddDrinkNoSave(d)
+            self._AddDrinkToChunks(d)
             if min_time is None or d.time < min_time:
                 min_time = d.time
             if max_time is None or d.time > max_time:
@@ -801,26 +940,59 @@ class DrinkingSession(_AbstractChunk):
 
     @classmethod
     def AssignSessionForDrink(cls, drink):
+        """Adds a drink to the current session, or to a new one.
+
+        Joining the cached current session needs no lock: its end time only
+        grows, so a session which is active for the drink stays active.
+        Otherwise, the site row is locked while the latest session is read
+        and possibly created, so concurrent pours never start two sessions.
+
+        Sets `drink.started_session` and `drink.joined_session`, for
+        `SystemEvent.build_events_for_drinks()`.
+        """
         # Return existing session if already assigned.
         if drink.session:
             return drink.session
 
+        drink.started_session = False
+
         # Return last session if one already exists
-        q = DrinkingSession.objects.all().order_by('-end_time')[:1]
-        if q and q[0].IsActive(drink.time):
-            session = q[0]
-            session.AddDrink(drink)
+        session = hotstate.get_current_session()
+        if session and session.IsActive(drink.time):
+            try:
+                return session._AssignDrink(drink)
+            except DrinkingSession.DoesNotExist:
+                pass  # Deleted since it was cached.
+
+        with transaction.atomic():
+            KegbotSite.get_locked()
+            q = DrinkingSession.objects.all().order_by('-end_time')[:1]
+            if q and q[0].IsActive(drink.time):
+                return q[0]._AssignDrink(drink)
+
+            # Create a new session
+            session = cls(start_time=drink.time, end_time=drink.time)
+            session._AddDrinkNoSave(drink)
+            session.save()
+            session._AddDrinkToChunks(drink)
+            drink.started_session = True
             drink.session = session
             drink.save()
             return session
 
-        # Create a new session
-        session = cls(start_time=drink.time, end_time=drink.time)
-        session.save()
-        session.AddDrink(drink)
-        drink.session = session
+    def _AssignDrink(self, drink):
+        self.AddDrink(drink)
+        drink.session = self
         drink.save()
-        return session
+        return self
+
+def _session_post_save(sender, instance, **kwargs):
+    hotstate.session_saved(instance)
+post_save.connect(_session_post_save, sender=DrinkingSession)
+
+def _session_post_delete(sender, instance, **kwargs):
+    hotstate.invalidate(hotstate.SESSION)
+post_delete.connect(_session_post_delete, sender=DrinkingSession)
 
 
 class SessionChunk(_AbstractChunk):
@@ -886,6 +1058,11 @@ class ThermoSensor(models.Model):
         except Thermolog.DoesNotExist:
             return None
 
+def _thermosensor_changed(sender, instance, **kwargs):
+    hotstate.sensor_changed()
+post_save.connect(_thermosensor_changed, sender=ThermoSensor)
+post_delete.connect(_thermosensor_changed, sender=ThermoSensor)
+
 
 class Thermolog(models.Model):
     """ A log from an ITemperatureSensor device of periodic measurements. """
@@ -908,6 +1085,53 @@ class Thermolog(models.Model):
         return util.CtoF(self.temp)
 
 
+class ThermoRollup(models.Model):
+    """Minimum, maximum and average readings of a sensor over a period.
+
+    Rollups are kept at several resolutions, and for longer than Thermolog
+    records; see `pykeg.core.thermo`.
+    """
+    class Meta:
+        unique_together = ('sensor', 'resolution', 'time')
+        get_latest_by = 'time'
+        ordering = ('-time',)
+
+    FIVE_MINUTES = 5 * 60
+    HOURLY = 60 * 60
+    DAILY = 24 * 60 * 60
+
+    RESOLUTIONS = (
+        (FIVE_MINUTES, '5 minutes'),
+        (HOURLY, 'Hourly'),
+        (DAILY, 'Daily'),
+    )
+
+    sensor = models.ForeignKey(ThermoSensor, related_name='rollups')
+    resolution = models.PositiveIntegerField(choices=RESOLUTIONS,
+        help_text='Length of the period, in seconds.')
+    time = models.DateTimeField(
+        help_text='Start of the period, aligned to its length in UTC.')
+    min_temp = models.FloatField(help_text='Lowest reading.')
+    max_temp = models.FloatField(help_text='Highest reading.')
+    temp_sum = models.FloatField(help_text='Sum of all readings.')
+    num_readings = models.PositiveIntegerField(help_text='Number of readings.')
+
+    def __str__(self):
+        return '%s %.2f C (%.2f-%.2f) [%s, %ss]' % (self.sensor, self.temp,
+            self.min_temp, self.max_temp, self.time, self.resolution)
+
+    @property
+    def temp(self):
+        """The average reading, in celsius degrees."""
+        return self.temp_sum / self.num_readings
+
+    def TempC(self):
+        return self.temp
+
+    def TempF(self):
+        return util.CtoF(self.temp)
+
+
 class _StatsModel(models.Model):
     time = models.DateTimeField(default=timezone.now)
     stats = jsonfield.JSONField()
@@ -1014,68 +1238,138 @@ class SystemEvent(models.Model):
 
     @classmethod
     def build_events_for_keg(cls, keg):
-        '''Generates and returns system events for the keg.'''
-        events = []
+        """Generates and returns system events for a keg just tapped or ended.
+
+        Events the keg already has are not generated again, so nothing is
+        returned for them.
+        """
         if keg.online:
-            q = keg.events.filter(kind=cls.KEG_TAPPED)
-            if q.count() == 0:
-                e = keg.events.create(kind=cls.KEG_TAPPED, time=keg.start_time, keg=keg)
-                e.save()
-                events.append(e)
-
-        if not keg.online:
-            q = keg.events.filter(kind=cls.KEG_ENDED)
-            if q.count() == 0:
-                e = keg.events.create(kind=cls.KEG_ENDED, time=keg.end_time, keg=keg)
-                e.save()
-                events.append(e)
-        
-        return events
+            kind, time = cls.KEG_TAPPED, keg.start_time
+        else:
+            kind, time = cls.KEG_ENDED, keg.end_time
+        if keg.events.filter(kind=kind).exists():
+            return []
+        return [cls.objects.create(kind=kind, time=time, keg=keg)]
 
     @classmethod
     def build_events_for_drink(cls, drink):
-        keg = drink.keg
-        session = drink.session
-        user = drink.user
+        """Generates and returns system events for a single drink."""
+        return cls.build_events_for_drinks([drink])
+
+    @classmethod
+    def build_events_for_drinks(cls, drinks, keg_volumes=None):
+        """Generates and returns system events for drinks, in id order.
+
+        Whether a drink started its session, or was its user's first in the
+        session, is known when the drink was recorded in this process (see
+        `DrinkingSession.AssignSessionForDrink()`).  Otherwise it is worked
+        out with one query for the drinkers already seen in the sessions.
+        All events are written with a single `bulk_create`, and read back
+        for their ids.
+
+        Args:
+            drinks: The drinks.
+            keg_volumes: A dict of keg id to remaining volume before the
+                first of `drinks`, as for `events_for_drink()`.  By default,
+                `keg_volumes_before(drinks)`.
+        """
+        drinks = sorted(drinks, key=lambda d: d.id)
+        if not drinks:
+            return []
+        if keg_volumes is None:
+            keg_volumes = cls.keg_volumes_before(drinks)
+
+        sessions = set()
+        drinkers = set()
+        if any(d.started_session is None for d in drinks):
+            earlier = Drink.objects.filter(id__lt=drinks[0].id,
+                session__in=set(d.session_id for d in drinks if d.session_id))
+            drinkers.update(earlier.order_by().values_list(
+                'session_id', 'user_id').distinct())
+            sessions.update(session_id for session_id, user_id in drinkers)
+
+        events = []
+        for drink in drinks:
+            events.extend(cls.events_for_drink(drink, sessions, drinkers,
+                keg_volumes))
+        cls.objects.bulk_create(events)
+        commit_hooks.on_commit(event_notifier.notify)
+        events = cls.objects.filter(drink__in=[d.id for d in drinks])
+        return list(events.order_by('id'))
+
+    @classmethod
+    def keg_volumes_before(cls, drinks):
+        """Returns a dict of keg id to remaining volume before `drinks`.
+
+        The drinks must be the latest ones poured from their kegs, so that
+        the volume before them is the current one plus theirs.
+        """
+        ret = {}
+        for drink in drinks:
+            if drink.keg_id:
+                if drink.keg_id not in ret:
+                    ret[drink.keg_id] = drink.keg.remaining_volume_ml()
+                ret[drink.keg_id] += drink.volume_ml
+        return ret
+
+    @classmethod
+    def events_for_drink(cls, drink, sessions, drinkers, keg_volumes):
+        """Returns unsaved system events for a drink.
+
+        Args:
+            drink: The Drink.  If its `started_session` and `joined_session`
+                are unset, it starts its session if the session is not in
+                `sessions`, and joins it if its user is not in `drinkers`.
+            sessions: A set of session ids seen so far, updated in place.
+            drinkers: A set of (session id, user id) pairs seen so far,
+                updated in place.
+            keg_volumes: A dict of keg id to remaining volume before the
+                drink, updated in place; kegs not in it start out full.
+        """
+        session_id = drink.session_id
+        drinker = (session_id, drink.user_id)
+        started = drink.started_session
+        joined = drink.joined_session
+        if started is None:
+            started = session_id not in sessions
+            joined = drinker not in drinkers
+        sessions.add(session_id)
+        drinkers.add(drinker)
 
         events = []
+        if session_id and started:
+            events.append(cls(kind=cls.SESSION_STARTED,
+                time=drink.session.start_time, drink_id=drink.id,
+                user_id=drink.user_id, session_id=session_id))
+
+        if drink.user_id and joined:
+            events.append(cls(kind=cls.SESSION_JOINED, time=drink.time,
+                drink_id=drink.id, user_id=drink.user_id, session_id=session_id))
 
-        if session:
-            q = session.events.filter(kind=cls.SESSION_STARTED)
-            if q.count() == 0:
-                e = session.events.create(kind=cls.SESSION_STARTED,
-                    time=session.start_time, drink=drink, user=user)
-                e.save()
-                events.append(e)
-
-        if user:
-            q = user.events.filter(kind=cls.SESSION_JOINED, session=session)
-            if q.count() == 0:
-                e = user.events.create(kind=cls.SESSION_JOINED,
-                    time=drink.time, session=session, drink=drink, user=user)
-                e.save()
-                events.append(e)
-
-        e = drink.events.create(kind=cls.DRINK_POURED,
-            time=drink.time, drink=drink, user=user, keg=keg,
-            session=session)
-        e.save()
-        events.append(e)
+        events.append(cls(kind=cls.DRINK_POURED, time=drink.time,
+            drink_id=drink.id, user_id=drink.user_id, keg_id=drink.keg_id,
+            session_id=session_id))
 
+        keg = drink.keg
         if keg:
-            volume_now = keg.remaining_volume_ml()
-            volume_before = volume_now + drink.volume_ml
+            volume_before = keg_volumes.get(keg.id, keg.full_volume_ml)
+            volume_now = volume_before - drink.volume_ml
+            keg_volumes[keg.id] = volume_now
             threshold = keg.full_volume_ml * kb_common.KEG_VOLUME_LOW_PERCENT
 
             if volume_now <= threshold and volume_before > threshold:
-                e = drink.events.create(kind=cls.KEG_VOLUME_LOW,
-                    time=drink.time, drink=drink, user=user, keg=keg,
-                    session=session)
-                e.save()
-                events.append(e)
+                events.append(cls(kind=cls.KEG_VOLUME_LOW, time=drink.time,
+                    drink_id=drink.id, user_id=drink.user_id, keg_id=keg.id,
+                    session_id=session_id))
 
         return events
 
+def _systemevent_post_save(sender, instance, created, **kwargs):
+    """Wakes threads waiting for new events, once they are committed."""
+    if created:
+        commit_hooks.on_commit(event_notifier.notify)
+post_save.connect(_systemevent_post_save, sender=SystemEvent)
+
 
 def _pics_file_name(instance, filename):
     rand_salt = random.randrange(0xffff)
@@ -1131,3 +1425,10 @@ class Picture(models.Model):
                 return 'An unknown drinker pouring drink %s' % (self.drink.id,)
         return ''
 
+
+def _post_syncdb(sender, **kwargs):
+    # Emitted after `flush`, which empties tables without sending
+    # post_delete.
+    hotstate.invalidate(hotstate.SITE, hotstate.TAPS, hotstate.KEGS,
+        hotstate.SESSION, hotstate.SENSORS)
+post_syncdb.connect(_post_syncdb)
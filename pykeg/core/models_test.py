@@ -19,10 +19,14 @@
 """Unittests for pykeg.core.models"""
 
 import datetime
+import mock
 
 from django.conf import settings
+from django.db import connection
+from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from . import backend
 from . import kb_common
@@ -205,3 +209,74 @@ class CoreModelsTestCase(TestCase):
         self.assertEqual(all_groups[1].start_time, base_time + td_390m)
         self.assertEqual(all_groups[1].end_time, base_time + td_400m + SESSION_DELTA)
         self.assertEqual(all_groups[1].user_chunks.all().count(), 2)
+
+    def testSessionChunkUpdates(self):
+        """Checks chunks updated in place against rebuilt ones."""
+        keg2 = models.Keg.objects.create(type=self.beverage, keg_type='other',
+            start_time=make_datetime(2000, 4, 1), full_volume_ml=2000)
+        tap2 = models.KegTap.objects.create(name='Test Tap 2', meter_name='test2',
+            ml_per_tick=(1000.0/2200.0), current_keg=keg2)
+        base_time = make_datetime(2009, 1, 1, 1, 0, 0)
+        pours = [
+            (self.tap, self.user, 0),
+            (tap2, self.user2, 1),
+            (tap2, self.user, 2),
+            (self.tap, self.user2, 3),
+            (self.tap, self.user2, 4),
+            (tap2, self.user, 1),  # out of order
+        ]
+        for tap, user, minutes in pours:
+            self.backend.record_drink(tap_name=tap.meter_name, ticks=2200,
+                username=user and user.username, do_postprocess=False,
+                pour_time=base_time + datetime.timedelta(minutes=minutes))
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.backend.record_drink(tap_name=tap2.meter_name, ticks=2200,
+                username=self.user.username, do_postprocess=False,
+                pour_time=base_time + datetime.timedelta(minutes=5))
+        heads = [q['sql'].split(' WHERE ')[0] for q in ctx.captured_queries]
+        chunk_queries = [h for h in heads if 'chunk"' in h
+            or 'UPDATE "core_drinkingsession"' in h]
+        self.assertEqual(4, len(chunk_queries))
+        self.assertTrue(all('UPDATE' in h for h in chunk_queries))
+
+        def snapshot():
+            session = models.DrinkingSession.objects.get()
+            return [(c.start_time, c.end_time, c.volume_ml) for c in
+                [session] + list(session.chunks.order_by('user', 'keg')) +
+                list(session.user_chunks.order_by('user')) +
+                list(session.keg_chunks.order_by('keg'))]
+
+        before = snapshot()
+        self.assertEqual(7000, before[0][2])
+        models.DrinkingSession.objects.get().Rebuild()
+        self.assertEqual(before, snapshot())
+
+        models.Drink.objects.all().delete()
+        models.DrinkingSession.objects.all().delete()
+        keg2.delete()
+
+    def testChunkCreatedConcurrently(self):
+        """A chunk created by another pour is updated, not overwritten."""
+        base_time = make_datetime(2009, 1, 1, 1, 0, 0)
+        drink = self.backend.record_drink(tap_name=self.tap.meter_name,
+            ticks=2200, username=self.user.username, do_postprocess=False,
+            pour_time=base_time)
+        session = drink.session
+
+        # An earlier drink, as if another pour created the chunk just after
+        # this one found none.
+        drink.time = base_time - datetime.timedelta(minutes=1)
+        with mock.patch.object(QuerySet, 'exists', return_value=False):
+            with CaptureQueriesContext(connection) as ctx:
+                created = models.UserSessionChunk.AddDrinkToChunk(drink,
+                    session=session, user=self.user)
+        self.assertFalse(created)
+        updates = [q['sql'].split(' WHERE ')[0] for q in ctx.captured_queries
+            if 'UPDATE' in q['sql']]
+        self.assertTrue(updates)
+        self.assertFalse(any('"session_id"' in u for u in updates))
+
+        chunk = models.UserSessionChunk.objects.get(session=session, user=self.user)
+        self.assertEqual(drink.time, chunk.start_time)
+        self.assertEqual(2 * drink.volume_ml, chunk.volume_ml)
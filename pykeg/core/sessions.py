@@ -0,0 +1,157 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bulk regeneration of drinking sessions."""
+
+from django.db import transaction
+
+from pykeg.core import hotstate
+from pykeg.core import models
+
+# Number of sessions, chunks or ids to write per database query.
+DEFAULT_BATCH_SIZE = 500
+
+# The chunk models, with the drink fields each is keyed on.
+CHUNK_FIELDS = (
+    (models.SessionChunk, ('user_id', 'keg_id')),
+    (models.UserSessionChunk, ('user_id',)),
+    (models.KegSessionChunk, ('keg_id',)),
+)
+
+class _PendingSession(object):
+    """A session and its chunks, built in memory before being written."""
+
+    def __init__(self, time, end_time):
+        self.session = models.DrinkingSession(start_time=time,
+            end_time=end_time, volume_ml=0)
+        self.chunks = {}
+        self.drink_ids = []
+        self.picture_ids = []
+
+class BulkSessionBuilder:
+    """Groups drinks into sessions in a single pass over drinks in time order.
+
+    A drink starts a new session if it is poured at or after the end of the
+    previous one, exactly as `DrinkingSession.AssignSessionForDrink()` would
+    for drinks recorded in time order.  Sessions and their chunks are built
+    in memory and written with `bulk_create` in batches of `batch_size`
+    sessions, followed by one UPDATE of drinks and pictures per session.
+    """
+
+    def __init__(self, session_delta, batch_size=DEFAULT_BATCH_SIZE):
+        """Constructor.
+
+        Args:
+            session_delta: The session timeout, as a timedelta.
+            batch_size: Number of objects to write per query.
+        """
+        self.session_delta = session_delta
+        self.batch_size = batch_size
+        self.pending = []
+        self.num_sessions = 0
+
+    def add(self, drink_id, time, user_id, keg_id, volume_ml, picture_id=None):
+        """Adds a drink, which must be no earlier than any drink added so far."""
+        end_time = time + self.session_delta
+        current = self.pending[-1] if self.pending else None
+        if not current or time >= current.session.end_time:
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+            current = _PendingSession(time, end_time)
+            self.pending.append(current)
+
+        current.session.end_time = end_time
+        current.session.volume_ml += volume_ml
+        current.drink_ids.append(drink_id)
+        if picture_id:
+            current.picture_ids.append(picture_id)
+
+        values = {'user_id': user_id, 'keg_id': keg_id}
+        for model, fields in CHUNK_FIELDS:
+            key = (model,) + tuple(values[f] for f in fields)
+            chunk = current.chunks.get(key)
+            if not chunk:
+                chunk = model(start_time=time, volume_ml=0,
+                    **dict((f, values[f]) for f in fields))
+                current.chunks[key] = chunk
+            chunk.end_time = end_time
+            chunk.volume_ml += volume_ml
+
+    def flush(self):
+        """Writes all pending sessions."""
+        if not self.pending:
+            return
+        sessions = [p.session for p in self.pending]
+        models.DrinkingSession.objects.bulk_create(sessions, self.batch_size)
+
+        # bulk_create does not set ids.  Sessions never overlap, and there are
+        # no later sessions, so they are read back in the same order.
+        ids = models.DrinkingSession.objects.filter(
+            start_time__gte=sessions[0].start_time).order_by('start_time', 'id')
+        ids = ids.values_list('id', flat=True)
+
+        chunks = dict((model, []) for model, fields in CHUNK_FIELDS)
+        for pending, session_id in zip(self.pending, ids):
+            for chunk in pending.chunks.values():
+                chunk.session_id = session_id
+                chunks[chunk.__class__].append(chunk)
+            self._update(models.Drink, pending.drink_ids, session_id)
+            self._update(models.Picture, pending.picture_ids, session_id)
+        for model, objs in chunks.iteritems():
+            model.objects.bulk_create(objs, self.batch_size)
+
+        self.num_sessions += len(self.pending)
+        self.pending = []
+
+    def _update(self, model, ids, session_id):
+        for i in range(0, len(ids), self.batch_size):
+            model.objects.filter(id__in=ids[i:i + self.batch_size]).update(
+                session=session_id)
+
+def regenerate_all(batch_size=DEFAULT_BATCH_SIZE, progress_fn=None):
+    """Deletes and regenerates all sessions in a single pass over all drinks.
+
+    Args:
+        batch_size: Number of objects to write per query.
+        progress_fn: If given, called as `progress_fn(pos, total)` after each
+            drink.
+
+    Returns:
+        A tuple of the number of drinks and the number of sessions.
+    """
+    with transaction.atomic():
+        models.Drink.objects.update(session=None)
+        models.Picture.objects.update(session=None)
+        models.DrinkingSession.objects.all().delete()
+
+        drinks = models.Drink.objects.order_by('time', 'id')
+        total = drinks.count()
+        builder = BulkSessionBuilder(
+            models.SiteSettings.get().GetSessionTimeoutDelta(), batch_size)
+        pos = 0
+        for row in drinks.values_list('id', 'time', 'user_id', 'keg_id',
+                'volume_ml', 'picture_id').iterator():
+            builder.add(*row)
+            pos += 1
+            if progress_fn:
+                progress_fn(pos, total)
+        builder.flush()
+
+    # No signals are sent for bulk writes.
+    hotstate.invalidate(hotstate.SESSION)
+    return pos, builder.num_sessions
@@ -0,0 +1,89 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.core.sessions"""
+
+import datetime
+
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from . import backend
+from . import defaults
+from . import models
+from . import sessions
+from .testutils import make_datetime
+
+class SessionsTestCase(TransactionTestCase):
+    def setUp(self):
+        self.backend = backend.KegbotBackend()
+        defaults.set_defaults(set_is_setup=True)
+        self.taps = list(models.KegTap.objects.all().order_by('id'))
+        for tap in self.taps:
+            tap.ml_per_tick = 1/2.2
+            tap.save()
+            self.backend.start_keg(tap.meter_name, beverage_name='Beer',
+                beverage_type='beer', producer_name='Unknown',
+                style_name='Unknown')
+        self.users = [self.backend.create_new_user('user%d' % i) for i in range(3)]
+
+    def snapshot(self):
+        """Returns all sessions and chunks, by position rather than id."""
+        ret = []
+        for session in models.DrinkingSession.objects.order_by('start_time'):
+            drinks = sorted(session.drinks.values_list('id', flat=True))
+            pictures = sorted(session.pictures.values_list('id', flat=True))
+            chunks = []
+            for related in (session.chunks, session.user_chunks, session.keg_chunks):
+                chunks.append(sorted((c.start_time, c.end_time, c.volume_ml,
+                    getattr(c, 'user_id', None), getattr(c, 'keg_id', None))
+                    for c in related.all()))
+            ret.append((session.start_time, session.end_time, session.volume_ml,
+                drinks, pictures, chunks))
+        return ret
+
+    def testRegenerateAll(self):
+        base_time = make_datetime(2014, 1, 1, 18, 0)
+        minutes = [0, 5, 30, 60, 300, 310, 311, 900, 2000, 2001]
+        for i, offset in enumerate(minutes):
+            drink = self.backend.record_drink(self.taps[i % 2].meter_name,
+                ticks=100 * (i + 1), username=self.users[i % 3].username,
+                pour_time=base_time + datetime.timedelta(minutes=offset),
+                do_postprocess=False)
+            if i % 4 == 0:
+                drink.picture = models.Picture.objects.create(
+                    image='pictures/%d.jpg' % i, session=drink.session)
+                drink.save()
+
+        expected = self.snapshot()
+        self.assertEquals(4, len(expected))
+
+        with CaptureQueriesContext(connection) as ctx:
+            num_drinks, num_sessions = sessions.regenerate_all(batch_size=2)
+        self.assertEquals((10, 4), (num_drinks, num_sessions))
+        self.assertEquals(expected, self.snapshot())
+        self.assertLess(len(ctx.captured_queries), 50)
+
+        # The next pour joins the latest regenerated session.
+        drink = self.backend.record_drink(self.taps[0].meter_name, ticks=100,
+            pour_time=base_time + datetime.timedelta(minutes=2002),
+            do_postprocess=False)
+        self.assertEquals(
+            models.DrinkingSession.objects.order_by('-start_time')[0].id,
+            drink.session_id)
@@ -18,11 +18,11 @@
 
 """Methods to generate cached statistics from drinks."""
 
-import copy
 import inspect
 import itertools
 import logging
 
+from django.conf import settings
 from django.db import transaction
 
 from pykeg.core import models
@@ -30,6 +30,9 @@ from kegbot.util import util
 
 STAT_MAP = {}
 
+# Number of stats records to write per INSERT during bulk generation.
+DEFAULT_BATCH_SIZE = 500
+
 def stat(statname):
     def decorate(f):
         setattr(f, 'statname', statname)
@@ -37,21 +40,43 @@ def stat(statname):
     return decorate
 
 class StatsBuilder:
-    def __init__(self, drink, drink_qs, previous=None):
+    """Computes the stats dictionary for a single drink within a scope.
+
+    Each stat method receives the value of that stat as of the previous drink
+    in the scope.  A value of `None` means there is no previous record, and the
+    stat is computed from scratch by scanning `drink_qs`; any other value,
+    including zero or empty values, is updated incrementally in constant time.
+    """
+    _STAT_METHODS = None
+
+    def __init__(self, drink, drink_qs, previous=None, new_session=None):
+        """Constructor.
+
+        Args:
+            drink: The drink to compute stats for.
+            drink_qs: All drinks in the scope, up to and including `drink`.
+                Only used when a stat must be computed from scratch, and
+                may be None when `previous` is complete.
+            previous: The scope's stats as of the previous drink, if any.
+            new_session: Whether `drink` is the first drink of its session
+                within the scope.  If None, determined with a query.
+        """
         self.drink = drink
         self.drinks = drink_qs
-        self.previous = util.AttrDict(copy.deepcopy(previous))
-        self.STAT_MAP = {}
-        for name, fn in inspect.getmembers(self, inspect.ismethod):
-            if hasattr(fn, 'statname'):
-                self.STAT_MAP[fn.statname] = fn
+        self.previous = _copy_stats(previous or {})
+        self.new_session = new_session
+        if StatsBuilder._STAT_METHODS is None:
+            StatsBuilder._STAT_METHODS = [(fn.statname, name) for name, fn in
+                inspect.getmembers(StatsBuilder, inspect.ismethod)
+                if hasattr(fn, 'statname')]
+        self.STAT_MAP = dict((statname, getattr(self, name))
+            for statname, name in StatsBuilder._STAT_METHODS)
 
     def build(self, tag=None):
         stats = util.AttrDict()
         if not self.drink:
             return stats
-        if self.previous:
-            stats = copy.deepcopy(self.previous)
+        stats.update(self.previous)
         for statname, fn in self.STAT_MAP.iteritems():
             previous = self.previous.get(statname, None)
             val = fn(previous)
@@ -60,27 +85,35 @@ class StatsBuilder:
             stats[statname] = val
         return stats
 
+    def is_new_session(self):
+        """Returns True if the drink is its session's first in this scope."""
+        if self.new_session is None:
+            earlier = self.drinks.filter(session_id=self.drink.session_id,
+                id__lt=self.drink.id).order_by()
+            self.new_session = not earlier.exists()
+        return self.new_session
+
     @stat('last_drink_id')
     def LastDrinkId(self, previous):
         return self.drink.id
 
     @stat('total_volume_ml')
     def TotalVolume(self, previous):
-        if not previous:
+        if previous is None:
             return sum(drink.volume_ml for drink in self.drinks)
         else:
             return previous + self.drink.volume_ml
 
     @stat('total_pours')
     def TotalPours(self, previous):
-        if not previous:
+        if previous is None:
             return self.drinks.count()
         else:
             return previous + 1
 
     @stat('average_volume_ml')
     def AverageVolume(self, previous):
-        if not previous:
+        if previous is None:
             count = self.drinks.count()
             average = 0.0
             if count:
@@ -95,7 +128,7 @@ class StatsBuilder:
 
     @stat('greatest_volume_ml')
     def GreatestVolume(self, previous):
-        if not previous:
+        if previous is None:
             res = 0
             drinks = self.drinks.order_by('-volume_ml')
             if drinks.count():
@@ -106,20 +139,20 @@ class StatsBuilder:
 
     @stat('greatest_volume_id')
     def GreatestVolumeId(self, previous):
-        if not previous:
+        if previous is None:
             res = 0
             drinks = self.drinks.order_by('-volume_ml')
             if drinks.count():
                 res = drinks[0].id
             return res
         else:
-            if self.drink.volume_ml > self.previous.greatest_volume_ml:
+            if not previous or self.drink.volume_ml > self.previous.greatest_volume_ml:
                 return self.drink.id
             return previous
 
     @stat('volume_by_day_of_week')
     def VolumeByDayOfweek(self, previous):
-        if not previous:
+        if previous is None:
             # Note: uses the session's start_time, rather than the drink's. This
             # causes late-night sessions to be reported for the day on which they were
             # started.
@@ -152,20 +185,20 @@ class StatsBuilder:
 
     @stat('sessions_count')
     def SessionsCount(self, previous):
-        if not previous:
+        if previous is None:
             all_sessions = set()
             for drink in self.drinks:
                 all_sessions.add(drink.session.id)
             return len(all_sessions)
         else:
-            first_drink = self.drink.session.drinks.order_by('id')[0]
-            if self.drink.id == first_drink.id:
+            # Count the session once, on its first drink within this scope.
+            if self.is_new_session():
                 previous += 1
             return previous
 
     @stat('volume_by_year')
     def VolumeByYear(self, previous):
-        if not previous:
+        if previous is None:
             ret = {}
             for drink in self.drinks:
                 year = str(drink.time.year)
@@ -178,14 +211,14 @@ class StatsBuilder:
 
     @stat('has_guest_pour')
     def HasGuestPour(self, previous):
-        if not previous:
+        if previous is None:
             return self.drinks.filter(user_id=None).count() > 0
         else:
             return bool(previous or self.drink.user is None)
 
     @stat('volume_by_drinker')
     def VolumeByDrinker(self, previous):
-        if not previous:
+        if previous is None:
             volmap = {}
             for drink in self.drinks:
                 if drink.user:
@@ -204,6 +237,42 @@ class StatsBuilder:
             return previous
 
 
+def _copy_stats(stats):
+    """Copies a stats dictionary.
+
+    Stats values are scalars or flat dicts and lists, so copying one level
+    deep is sufficient (and much faster than `copy.deepcopy`).
+    """
+    ret = util.AttrDict()
+    for k, v in stats.iteritems():
+        if isinstance(v, dict):
+            v = util.AttrDict(v)
+        elif isinstance(v, list):
+            v = list(v)
+        ret[k] = v
+    return ret
+
+def empty_stats():
+    """Returns the stats of a scope with no drinks yet.
+
+    Building from this value gives the same result as scanning a scope whose
+    only drink is the current one, without the scan.
+    """
+    return util.AttrDict({
+        'last_drink_id': 0,
+        'total_volume_ml': 0.0,
+        'total_pours': 0,
+        'average_volume_ml': 0.0,
+        'greatest_volume_ml': 0.0,
+        'greatest_volume_id': 0,
+        'volume_by_day_of_week': {},
+        'registered_drinkers': [],
+        'sessions_count': 0,
+        'volume_by_year': {},
+        'has_guest_pour': False,
+        'volume_by_drinker': {},
+    })
+
 def invalidate(drink):
     """Clears all statistics.
 
@@ -223,71 +292,124 @@ def invalidate(drink):
             models.UserStats.objects.all().delete()
             models.SessionStats.objects.all().delete()
 
+def scopes_for_drink(drink):
+    """Returns (stats model, scope field values) for each scope of `drink`."""
+    scopes = [(models.SystemStats, {})]
+    if drink.keg_id:
+        scopes.append((models.KegStats, {'keg_id': drink.keg_id}))
+    scopes.append((models.UserStats, {'user_id': drink.user_id}))
+    if drink.session_id:
+        scopes.append((models.SessionStats, {'session_id': drink.session_id}))
+    return scopes
+
+def checkpoint_interval():
+    """Returns settings.KEGBOT_STATS_CHECKPOINT_INTERVAL, or 0 if disabled."""
+    return getattr(settings, 'KEGBOT_STATS_CHECKPOINT_INTERVAL', 0) or 0
+
+def is_checkpoint(stats, interval):
+    """Returns True if a stats record must be kept when compacting."""
+    return stats.get('total_pours', 0) % interval == 0
+
 def _get_previous(drink, qs):
-    qs = qs.filter(drink_id__lt=drink.id).order_by('-id')[:1]
-    if qs.count():
-        return qs[0].stats
-    return {}
+    """Returns the latest stats record in `qs` before `drink`, or None."""
+    records = list(qs.filter(drink_id__lt=drink.id).order_by('-id')[:1])
+    if records:
+        return records[0]
+    return None
+
+def _get_previous_stats(drink_id, model, scope, historical=False):
+    """Returns the stats of a scope as of the drink before `drink_id`.
+
+    Args:
+        drink_id: Id of the drink.
+        model: The scope's stats model.
+        scope: The scope's field values.
+        historical: True if the scope may have records after `drink_id`.
+
+    Returns:
+        A tuple of the stats dictionary (None if the scope has no earlier
+        record), and the latest earlier record (or None).
+    """
+    previous = _get_previous(models.Drink(id=drink_id), model.objects.filter(**scope))
+    stats = previous.stats if previous else None
+    if checkpoint_interval() or (historical and model is models.SystemStats):
+        # Records between the previous checkpoint and this drink may have
+        # been compacted away (or, for system stats, dropped by `correct()`);
+        # replay the drinks they covered.
+        drinks = models.Drink.objects.filter(**scope)
+        gap = drinks.filter(id__lt=drink_id)
+        if previous:
+            gap = gap.filter(id__gt=previous.drink_id)
+        for d in gap.order_by('id'):
+            stats = StatsBuilder(d, drinks.filter(id__lte=d.id), stats).build()
+    return stats, previous
+
+def _build_scope_stats(drink, model, scope):
+    """Builds (but does not save) the stats dictionary for drink in a scope.
+
+    Returns:
+        A tuple of the new stats dictionary, and the previous record it was
+        built on (or None).
+    """
+    drinks = models.Drink.objects.filter(id__lte=drink.id, **scope)
+    stats, previous = _get_previous_stats(drink.id, model, scope)
+    builder = StatsBuilder(drink, drinks, stats)
+    return builder.build(), previous
+
+def _generate_scope_stats(drink, model, scope):
+    """Builds and saves the stats record for drink in a scope.
+
+    When compaction is enabled, the previous record is deleted unless it is a
+    checkpoint.
+    """
+    stats, previous = _build_scope_stats(drink, model, scope)
+    record = model.objects.create(drink=drink, stats=stats, **scope)
+    interval = checkpoint_interval()
+    if interval and previous and not is_checkpoint(previous.stats, interval):
+        previous.delete()
+    return record
 
 def build_system_stats(drink):
     """Builds (but does not save) system stats dictionary for drink."""
-    qs = models.Drink.objects.filter(id__lte=drink.id)
-    previous = _get_previous(drink, models.SystemStats.objects.all())
-    builder = StatsBuilder(drink, qs, previous)
-    return builder.build('system')
+    return _build_scope_stats(drink, models.SystemStats, {})[0]
 
 def generate_system_stats(drink):
     """Builds and saves system stats record for drink."""
-    stats = build_system_stats(drink)
-    return models.SystemStats.objects.create(drink=drink, stats=stats)
+    return _generate_scope_stats(drink, models.SystemStats, {})
 
 def build_keg_stats(drink):
     """Builds (but does not save) keg stats dictionary for drink."""
-    if drink.keg:
-        qs = models.Drink.objects.filter(id__lte=drink.id, keg_id=drink.keg.id)
-        previous = _get_previous(drink,
-            models.KegStats.objects.filter(keg=drink.keg))
-        builder = StatsBuilder(drink, qs, previous)
-        return builder.build('keg ' + str(drink.keg.id))
+    if drink.keg_id:
+        return _build_scope_stats(drink, models.KegStats,
+            {'keg_id': drink.keg_id})[0]
 
 def generate_keg_stats(drink):
     """Builds and saves keg stats record for drink."""
-    stats = build_keg_stats(drink)
-    if stats:
-        return models.KegStats.objects.create(drink=drink, keg=drink.keg, stats=stats)
+    if drink.keg_id:
+        return _generate_scope_stats(drink, models.KegStats,
+            {'keg_id': drink.keg_id})
 
 def build_user_stats(drink):
     """Builds (but does not save) user stats dictionary for drink."""
-    if drink.user:
-        user_id = drink.user.id
-    else:
-        user_id = None
-    qs = models.Drink.objects.filter(id__lte=drink.id, user_id=user_id)
-    previous = _get_previous(drink,
-        models.UserStats.objects.filter(user=drink.user))
-    builder = StatsBuilder(drink, qs, previous)
-    return builder.build('user ' + str(user_id))
+    return _build_scope_stats(drink, models.UserStats,
+        {'user_id': drink.user_id})[0]
 
 def generate_user_stats(drink):
     """Builds and saves user stats record for drink."""
-    stats = build_user_stats(drink)
-    return models.UserStats.objects.create(drink=drink, user=drink.user, stats=stats)
+    return _generate_scope_stats(drink, models.UserStats,
+        {'user_id': drink.user_id})
 
 def build_session_stats(drink):
     """Builds (but does not save) session stats dictionary for drink."""
-    if drink.session:
-        qs = models.Drink.objects.filter(id__lte=drink.id, session_id=drink.session.id)
-        previous = _get_previous(drink,
-            models.SessionStats.objects.filter(session=drink.session))
-        builder = StatsBuilder(drink, qs, previous)
-        return builder.build('session ' + str(drink.session.id))
+    if drink.session_id:
+        return _build_scope_stats(drink, models.SessionStats,
+            {'session_id': drink.session_id})[0]
 
 def generate_session_stats(drink):
     """Builds and saves session stats record for drink."""
-    stats = build_session_stats(drink)
-    if stats:
-        return models.SessionStats.objects.create(drink=drink,
-            session=drink.session, stats=stats)
+    if drink.session_id:
+        return _generate_scope_stats(drink, models.SessionStats,
+            {'session_id': drink.session_id})
 
 def generate(drink, invalidate_first=True):
     """Generate all stats for this drink.
@@ -301,10 +423,405 @@ def generate(drink, invalidate_first=True):
         if invalidate_first:
             invalidate(drink)
 
-        generate_system_stats(drink)
-        generate_keg_stats(drink)
-        generate_user_stats(drink)
-        generate_session_stats(drink)
+        for model, scope in scopes_for_drink(drink):
+            _generate_scope_stats(drink, model, scope)
+
+def generate_many(drinks, batch_size=DEFAULT_BATCH_SIZE):
+    """Generates stats for several new drinks in a single pass.
+
+    Each scope continues from its latest record.  Whether a drink is the
+    first of its session within a scope is checked with a bounded query
+    (see `StatsBuilder.is_new_session()`), so the cost of a pour does not
+    grow with the number of earlier drinks.
+
+    Args:
+        drinks: The drinks, in id order.  There must be no later drinks, and
+            no stats records for them yet.
+        batch_size: Number of records to write per INSERT.
+    """
+    if not drinks:
+        return
+    with transaction.atomic():
+        generator = BulkStatsGenerator(batch_size)
+        superseded = []
+        for drink in drinks:
+            for model, scope in scopes_for_drink(drink):
+                if not generator.has_scope(model, scope):
+                    previous = _seed(generator, drinks[0].id, model, scope)
+                    if previous:
+                        superseded.append(previous)
+                generator.add_to_scope(drink, model, scope)
+        generator.flush()
+
+        interval = generator.interval
+        for previous in superseded:
+            if interval and not is_checkpoint(previous.stats, interval):
+                previous.delete()
+
+def _seed(generator, start_id, model, scope, historical=False):
+    """Seeds the running stats of a scope with its stats before `start_id`.
+
+    Returns:
+        The scope's latest record before `start_id`, or None.
+    """
+    stats, previous = _get_previous_stats(start_id, model, scope, historical)
+    if stats is not None:
+        generator.seed(model, scope, stats,
+            models.Drink.objects.filter(id__lt=start_id, **scope))
+    return previous
+
+def _scope_key(model, scope):
+    return (model,) + tuple(sorted(scope.items()))
+
+class BulkStatsGenerator:
+    """Generates stats for many drinks in a single in-memory pass.
+
+    Drinks must be added in increasing id order.  The running stats of every
+    scope (system, keg, user and session) are kept in memory, so no previous
+    records are read back, and new records are written with `bulk_create` in
+    batches of `batch_size`.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, interval=None):
+        """Constructor.
+
+        Args:
+            batch_size: Number of records to write per INSERT.
+            interval: Checkpoint interval for compacted storage; defaults to
+                `checkpoint_interval()`.  When non-zero, only checkpoint
+                records and the final record of each scope are written.
+        """
+        self.batch_size = batch_size
+        if interval is None:
+            interval = checkpoint_interval()
+        self.interval = interval
+        self.scopes = {}
+        self.pending = {}
+        self.latest = {}
+
+    def seed(self, model, scope, stats, earlier):
+        """Sets the running stats of a scope that already has drinks.
+
+        Args:
+            model: The scope's stats model.
+            scope: The scope's field values.
+            stats: The scope's stats as of its latest drink so far.
+            earlier: A QuerySet of the scope's drinks so far, probed for
+                earlier drinks of a session with a bounded query.
+        """
+        self.scopes[_scope_key(model, scope)] = (stats, set(), earlier)
+
+    def has_scope(self, model, scope):
+        """Returns True if the scope has been seeded or added to."""
+        return _scope_key(model, scope) in self.scopes
+
+    def add(self, drink):
+        """Builds stats records for `drink` in each of its scopes."""
+        for model, scope in scopes_for_drink(drink):
+            self.add_to_scope(drink, model, scope)
+
+    def add_to_scope(self, drink, model, scope):
+        """Builds the stats record for `drink` in a single scope."""
+        key = _scope_key(model, scope)
+        previous, sessions, earlier = self.scopes.get(key, (None, set(), None))
+        if previous is None:
+            previous = empty_stats()
+        if drink.session_id in sessions:
+            new_session = False
+        elif earlier is None:
+            new_session = True
+        elif 'session_id' in scope:
+            # The scope is the session, which has earlier drinks.
+            new_session = False
+        else:
+            new_session = None
+        stats = StatsBuilder(drink, earlier, previous, new_session).build()
+        sessions.add(drink.session_id)
+        self.scopes[key] = (stats, sessions, earlier)
+
+        record = model(drink=drink, stats=stats, **scope)
+        if self.interval and not is_checkpoint(stats, self.interval):
+            # Only written if no later drink supersedes it.
+            self.latest[key] = record
+            return
+        self.latest.pop(key, None)
+        self._queue(record)
+
+    def flush(self):
+        """Writes any pending records, including each scope's latest record."""
+        for record in self.latest.values():
+            self._queue(record)
+        self.latest = {}
+        for model in self.pending.keys():
+            self._write(model)
+
+    def _queue(self, record):
+        model = record.__class__
+        pending = self.pending.setdefault(model, [])
+        pending.append(record)
+        if len(pending) >= self.batch_size:
+            self._write(model)
+
+    def _write(self, model):
+        records = self.pending.pop(model, [])
+        if records:
+            model.objects.bulk_create(records)
+
+def generate_all(batch_size=DEFAULT_BATCH_SIZE, progress_fn=None,
+        interval=None):
+    """Deletes and regenerates all stats in a single pass over all drinks.
+
+    Args:
+        batch_size: Number of records to write per INSERT.
+        progress_fn: If given, called as `progress_fn(pos, total)` after each
+            drink.
+        interval: Checkpoint interval for compacted storage; defaults to
+            `checkpoint_interval()`.
+
+    Returns:
+        The number of drinks processed.
+    """
+    with transaction.atomic():
+        invalidate(None)
+
+        drinks = models.Drink.objects.all()
+        total = drinks.count()
+        generator = BulkStatsGenerator(batch_size, interval)
+        pos = 0
+        for drink in drinks.select_related('user', 'session').order_by('id').iterator():
+            generator.add(drink)
+            pos += 1
+            if progress_fn:
+                progress_fn(pos, total)
+        generator.flush()
+        return pos
+
+def regenerate(start_id, scopes, batch_size=DEFAULT_BATCH_SIZE):
+    """Regenerates stats of some scopes, for drinks starting at `start_id`.
+
+    This is the fallback of `correct()` for edits which cannot be applied
+    as deltas: only the scopes the drink belongs to depend on it, and within
+    those only the records from the drink onward.  Those records are deleted
+    and rebuilt in one pass from the preceding record, leaving all other
+    records untouched.
+
+    Args:
+        start_id: Id of the first drink whose stats may have changed.  The
+            drink itself need not exist anymore.
+        scopes: A list of (stats model, scope field values), such as returned
+            by `scopes_for_drink()`.
+        batch_size: Number of records to write per INSERT.
+    """
+    with transaction.atomic():
+        generator = BulkStatsGenerator(batch_size)
+        for model, scope in scopes:
+            model.objects.filter(drink_id__gte=start_id, **scope).delete()
+            drinks = models.Drink.objects.filter(**scope)
+            previous = _seed(generator, start_id, model, scope, True)
+
+            num_drinks = 0
+            following = drinks.filter(id__gte=start_id).select_related('user', 'session')
+            for drink in following.order_by('id').iterator():
+                generator.add_to_scope(drink, model, scope)
+                num_drinks += 1
+
+            interval = generator.interval
+            if num_drinks and interval and previous and \
+                    not is_checkpoint(previous.stats, interval):
+                previous.delete()
+            elif not num_drinks:
+                stats = _get_previous_stats(start_id, model, scope, True)[0]
+                _restore_latest(start_id, model, scope, stats, previous)
+        generator.flush()
+
+def _restore_latest(drink_id, model, scope, stats, previous):
+    """Writes a record for the last drink of a scope before `drink_id`.
+
+    Called after the scope's latest drink was removed from it, when the
+    record of the drink before it may have been compacted away.
+
+    Args:
+        drink_id: Id of the removed drink.
+        model: The scope's stats model.
+        scope: The scope's field values.
+        stats: The scope's stats before `drink_id`.
+        previous: The scope's latest record before `drink_id`, or None.
+    """
+    last = models.Drink.objects.filter(id__lt=drink_id, **scope).order_by('-id')
+    last_id = last.values_list('id', flat=True)[:1]
+    if last_id and (not previous or previous.drink_id != last_id[0]):
+        model.objects.create(drink_id=last_id[0], stats=stats, **scope)
+
+def contribution(drink):
+    """Returns the values of `drink` that stats depend on.
+
+    Taken before a drink is edited, this is what `correct()` takes back out
+    of the stats of later drinks.
+    """
+    session = drink.session if drink.session_id else None
+    return util.AttrDict({
+        'id': drink.id,
+        'volume_ml': drink.volume_ml,
+        'keg_id': drink.keg_id,
+        'user_id': drink.user_id,
+        'session_id': drink.session_id,
+        'username': str(drink.user.username) if drink.user else '',
+        'year': str(drink.time.year),
+        'weekday': str(session.start_time.strftime('%w')) if session else None,
+    })
+
+def _row_contribution(row):
+    """Returns the contribution of a row of `_CONTRIBUTION_FIELDS`."""
+    drink_id, volume_ml, username, session_id, time, start_time = row
+    return util.AttrDict({
+        'id': drink_id,
+        'volume_ml': volume_ml,
+        'session_id': session_id,
+        'username': str(username or ''),
+        'year': str(time.year),
+        'weekday': str(start_time.strftime('%w')) if start_time else None,
+    })
+
+_CONTRIBUTION_FIELDS = ('id', 'volume_ml', 'user__username', 'session_id',
+    'time', 'session__start_time')
+
+# Keyed stats, and the contribution value each is keyed by.
+_KEYED_STATS = (
+    ('volume_by_drinker', 'username'),
+    ('volume_by_year', 'year'),
+    ('volume_by_day_of_week', 'weekday'),
+)
+
+def _in_scope(contrib, scope):
+    return all(contrib[k] == v for k, v in scope.iteritems())
+
+def correct(before, after, scopes, batch_size=DEFAULT_BATCH_SIZE):
+    """Corrects stats after a single drink has been edited or cancelled.
+
+    Rather than rebuilding every later record, the drink's old contribution
+    is taken out of, and its new one added to, the additive stats of each
+    later record.  Only stats which cannot be reversed (the greatest drink,
+    registered drinkers and guest pours) are replayed, from a narrow query of
+    the later drinks.  System stats are only ever read at the latest drink,
+    so of the later system records only the latest is rewritten.
+
+    Args:
+        before: The `contribution()` of the drink before the edit.
+        after: The drink after the edit, or None if it was cancelled.
+        scopes: The scopes of the drink, both before and after the edit.
+        batch_size: Number of records to write per INSERT.
+    """
+    with transaction.atomic():
+        if before.session_id:
+            starts = models.DrinkingSession.objects.filter(
+                id=before.session_id).values_list('start_time', flat=True)
+            if starts and str(starts[0].strftime('%w')) != before.weekday:
+                # The session now starts on another day, which moves all of
+                # its drinks to another weekday; rebuild instead.
+                regenerate(before.id, scopes, batch_size)
+                return
+        new = contribution(after) if after else None
+        for model, scope in scopes:
+            _correct_scope(before, new, after, model, scope, batch_size)
+
+def _correct_scope(before, after, drink, model, scope, batch_size):
+    """Corrects the stats of one scope; see `correct()`."""
+    old = before if _in_scope(before, scope) else None
+    new = after if after and _in_scope(after, scope) else None
+    if not old and not new:
+        return
+    drink_id = before.id
+    interval = checkpoint_interval()
+    drinks = models.Drink.objects.filter(**scope)
+    previous, previous_record = _get_previous_stats(drink_id, model, scope, True)
+    if not new and not model.objects.filter(drink_id__gt=drink_id, **scope).exists():
+        # The drink was the scope's latest.
+        model.objects.filter(drink_id__gte=drink_id, **scope).delete()
+        _restore_latest(drink_id, model, scope, previous, previous_record)
+        return
+    previous = previous or empty_stats()
+
+    records = model.objects.filter(drink_id__gte=drink_id, **scope).order_by('id')
+    bounded = model is models.SystemStats and not interval
+    if bounded:
+        records = list(records.filter(drink_id=drink_id)) + \
+            list(records.filter(drink_id__gt=drink_id).reverse()[:1])
+    own = [r for r in records if r.drink_id == drink_id]
+    later = [r for r in records if r.drink_id > drink_id]
+
+    writes = []
+    base = previous
+    if new:
+        base = StatsBuilder(drink, drinks, previous).build()
+        if not later or (not bounded and
+                (not interval or is_checkpoint(base, interval))):
+            record = own[0] if own else model(drink_id=drink_id, **scope)
+            record.stats = base
+            writes.append(record)
+
+    if later:
+        session_change = 0
+        if bool(old) != bool(new):
+            earlier = drinks.filter(session_id=before.session_id,
+                id__lt=drink_id).order_by()
+            if not earlier.exists():
+                session_change = 1 if new else -1
+
+        greatest_ml = base['greatest_volume_ml']
+        greatest_id = base['greatest_volume_id']
+        drinkers = list(base['registered_drinkers'])
+        has_guest = base['has_guest_pour']
+        seen = dict((statname, set()) for statname, _ in _KEYED_STATS)
+        sessions = set()
+        by_drink = dict((r.drink_id, r) for r in later)
+
+        following = drinks.filter(id__gt=drink_id, id__lte=later[-1].drink_id)
+        rows = following.order_by('id').values_list(*_CONTRIBUTION_FIELDS)
+        for row in rows.iterator():
+            c = _row_contribution(row)
+            if not greatest_id or c.volume_ml > greatest_ml:
+                greatest_ml, greatest_id = float(c.volume_ml), c.id
+            if c.username and c.username not in drinkers:
+                drinkers.append(c.username)
+            has_guest = has_guest or not c.username
+            for statname, attr in _KEYED_STATS:
+                seen[statname].add(c[attr])
+            sessions.add(c.session_id)
+
+            record = by_drink.get(c.id)
+            if not record:
+                continue
+            stats = _copy_stats(record.stats)
+            delta_ml = (new.volume_ml if new else 0) - (old.volume_ml if old else 0)
+            stats.total_volume_ml += delta_ml
+            stats.total_pours += bool(new) - bool(old)
+            stats.average_volume_ml = 0.0
+            if stats.total_pours:
+                stats.average_volume_ml = stats.total_volume_ml / float(stats.total_pours)
+            for statname, attr in _KEYED_STATS:
+                volmap = stats[statname]
+                if old:
+                    key = old[attr]
+                    if key in previous[statname] or key in seen[statname]:
+                        volmap[key] = float(volmap.get(key, 0) - old.volume_ml)
+                    else:
+                        volmap.pop(key, None)
+                if new:
+                    key = new[attr]
+                    volmap[key] = float(volmap.get(key, 0) + new.volume_ml)
+            if before.session_id not in sessions:
+                stats.sessions_count += session_change
+            stats.greatest_volume_ml = greatest_ml
+            stats.greatest_volume_id = greatest_id
+            stats.registered_drinkers = list(drinkers)
+            stats.has_guest_pour = has_guest
+            record.stats = stats
+            writes.append(record)
+
+    model.objects.filter(drink_id__gte=drink_id, **scope).delete()
+    for record in writes:
+        record.id = None
+    model.objects.bulk_create(writes, batch_size)
 
 if __name__ == '__main__':
     import cProfile
@@ -16,7 +16,10 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+from django.db import connection
 from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
 
 from kegbot.api import models_pb2
 from kegbot.api.protoutil import ProtoMessageToDict
@@ -27,6 +30,8 @@ from . import models
 from . import stats
 from .testutils import make_datetime
 
+import datetime
+
 class StatsTestCase(TransactionTestCase):
     reset_sequences = True
 
@@ -93,3 +98,176 @@ class StatsTestCase(TransactionTestCase):
         print 'ACTUAL'
         pprint.pprint(stats)
         self.assertDictEqual(expected, stats)
+
+    def testIncrementalCost(self):
+        """Per-pour stats cost must not depend on the number of prior drinks."""
+        now = make_datetime(2012, 1, 2, 12, 00)
+
+        # A zero-volume guest pour leaves several stats with falsy values,
+        # which must still be updated incrementally.
+        self.backend.record_drink('kegboard.flow0', ticks=0, volume_ml=0,
+            pour_time=now)
+
+        drink_queries = []
+        for i in xrange(30):
+            d = self.backend.record_drink('kegboard.flow0', ticks=1,
+                volume_ml=100, username='user1', pour_time=now,
+                do_postprocess=False)
+            with CaptureQueriesContext(connection) as ctx:
+                stats.generate(d)
+            drink_queries.append([q['sql'] for q in ctx.captured_queries
+                if 'FROM "core_drink"' in q['sql']])
+
+        # After the first pour in each scope, drinks are only probed with
+        # bounded lookups, never rescanned.
+        for queries in drink_queries[1:]:
+            self.assertEquals(len(drink_queries[1]), len(queries))
+            for sql in queries:
+                self.assertIn('LIMIT 1', sql)
+
+        system_stats = models.KegbotSite.get().GetStats()
+        self.assertEquals(3000.0, system_stats.total_volume_ml)
+        self.assertEquals(31, system_stats.total_pours)
+        self.assertTrue(system_stats.has_guest_pour)
+        self.assertEquals(1, system_stats.sessions_count)
+
+    def testRecordDrinkCost(self):
+        """Recording a drink must not rescan earlier drinks for stats."""
+        now = make_datetime(2012, 1, 2, 12, 00)
+        counts = []
+        for i in xrange(20):
+            with CaptureQueriesContext(connection) as ctx:
+                self.backend.record_drink('kegboard.flow0', ticks=1,
+                    volume_ml=100, username='user1', pour_time=now)
+            queries = [q['sql'] for q in ctx.captured_queries]
+            counts.append(len(queries))
+            for sql in queries:
+                self.assertNotIn('DISTINCT', sql)
+
+        self.assertEquals([counts[1]] * 19, counts[1:])
+        system_stats = models.KegbotSite.get().GetStats()
+        self.assertEquals(20, system_stats.total_pours)
+        self.assertEquals(1, system_stats.sessions_count)
+
+    def testGenerateAll(self):
+        """Bulk regeneration must match per-drink generation exactly."""
+        now = make_datetime(2012, 1, 2, 12, 00)
+        keg2 = self.backend.start_keg('kegboard.flow1', beverage_name='Other',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+        pours = (
+            ('kegboard.flow0', 0, None, 0),
+            ('kegboard.flow0', 100, 'user1', 10),
+            ('kegboard.flow1', 250, 'user2', 20),
+            ('kegboard.flow0', 50, None, 30),
+            ('kegboard.flow1', 300, 'user1', 60 * 24),
+            ('kegboard.flow0', 120, 'user3', 60 * 24 * 400),
+            ('kegboard.flow1', 80, 'user1', 60 * 24 * 400 + 5),
+        )
+        for tap_name, volume_ml, username, minutes in pours:
+            self.backend.record_drink(tap_name, ticks=1, volume_ml=volume_ml,
+                username=username,
+                pour_time=now + datetime.timedelta(minutes=minutes))
+
+        expected = self.snapshot()
+        self.assertEquals(len(pours) * 4, len(expected))
+
+        num_drinks = stats.generate_all(batch_size=3)
+        self.assertEquals(len(pours), num_drinks)
+        self.assertEquals(expected, self.snapshot())
+
+    def snapshot(self, latest_system=False):
+        """Returns the stats of every record, keyed by record scope.
+
+        If `latest_system` is True, only the latest system record is
+        included.
+        """
+        ret = {}
+        for model in (models.SystemStats, models.KegStats,
+                models.UserStats, models.SessionStats):
+            records = model.objects.all()
+            if latest_system and model is models.SystemStats:
+                records = [records.latest()]
+            for record in records:
+                key = (model.__name__, record.drink_id,
+                    getattr(record, 'keg_id', None),
+                    getattr(record, 'user_id', None),
+                    getattr(record, 'session_id', None))
+                ret[key] = record.stats
+        return ret
+
+    def testDrinkCorrections(self):
+        """Corrections rebuild only the affected scopes."""
+        now = make_datetime(2012, 1, 2, 12, 00)
+        keg2 = self.backend.start_keg('kegboard.flow1', beverage_name='Other',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+        drinks = []
+        for i in xrange(8):
+            tap_name = ('kegboard.flow0', 'kegboard.flow1')[i % 2]
+            drinks.append(self.backend.record_drink(tap_name, ticks=1,
+                volume_ml=10 * (i + 1), username=('user1', 'user2')[i % 2],
+                pour_time=now + datetime.timedelta(minutes=i)))
+
+        # user2's drinks are all on keg2, so its records must be untouched.
+        untouched = list(models.UserStats.objects.filter(
+            user=self.users[1]).values_list('id', flat=True))
+        untouched_keg = list(models.KegStats.objects.filter(
+            keg=keg2).values_list('id', flat=True))
+
+        self.backend.set_drink_volume(drinks[2], 1000)
+        self.backend.cancel_drink(drinks[4])
+        self.backend.assign_drink(drinks[6], 'user3')
+        self.backend.assign_drink(drinks[0], None)
+        self.backend.cancel_drink(drinks[0])
+
+        # Of the later system records, only the latest is rewritten.
+        self.assertEquals(1, models.SystemStats.objects.count())
+
+        self.assertEquals(untouched, list(models.UserStats.objects.filter(
+            user=self.users[1]).values_list('id', flat=True)))
+        self.assertEquals(untouched_keg, list(models.KegStats.objects.filter(
+            keg=keg2).values_list('id', flat=True)))
+
+        corrected = self.snapshot(latest_system=True)
+        stats.generate_all()
+        self.assertEquals(corrected, self.snapshot(latest_system=True))
+        self.assertEquals(['user1', 'user2', 'user3'],
+            sorted(models.KegbotSite.get().GetStats().registered_drinkers))
+
+    def testCompactedStorage(self):
+        """Compacted stats keep few records but identical latest stats."""
+        now = make_datetime(2012, 1, 2, 12, 00)
+        usernames = ('user1', 'user2', None)
+
+        def latest_stats():
+            return (
+                models.KegbotSite.get().GetStats(),
+                self.keg.GetStats(),
+                [u.get_stats() for u in self.users],
+                [s.GetStats() for s in models.DrinkingSession.objects.all()],
+            )
+
+        with override_settings(KEGBOT_STATS_CHECKPOINT_INTERVAL=4):
+            for i in xrange(10):
+                self.backend.record_drink('kegboard.flow0', ticks=1,
+                    volume_ml=10 * (i + 1), username=usernames[i % 3],
+                    pour_time=now + datetime.timedelta(minutes=i))
+
+            # Checkpoints at pours 4 and 8, plus the latest record.
+            self.assertEquals(3, models.SystemStats.objects.count())
+            self.assertEquals(3, models.KegStats.objects.count())
+            compacted = latest_stats()
+
+            # Editing a historical drink rebuilds from the nearest checkpoint.
+            drink = models.Drink.objects.order_by('id')[5]
+            self.backend.set_drink_volume(drink, 500)
+            edited = latest_stats()
+
+        stats.generate_all(interval=0)
+        self.assertEquals(10, models.SystemStats.objects.count())
+        self.assertEquals(edited, latest_stats())
+        self.assertEquals(edited[0].total_volume_ml,
+            compacted[0].total_volume_ml + 500 - 60)
+
+        stats.generate_all(interval=4)
+        self.assertEquals(3, models.SystemStats.objects.count())
+        self.assertEquals(edited, latest_stats())
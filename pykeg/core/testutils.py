@@ -22,9 +22,23 @@ import datetime
 
 from django.conf import settings
 from django.utils import timezone
+from django_nose import NoseTestSuiteRunner
 
 def make_datetime(*args):
     if settings.USE_TZ:
         return datetime.datetime(*args, tzinfo=timezone.utc)
     else:
         return datetime.datetime(*args)
+
+class KegbotTestSuiteRunner(NoseTestSuiteRunner):
+    """Test runner which runs Celery tasks in-process.
+
+    Tasks are executed eagerly when scheduled, so tests need no broker or
+    worker.  The cache is treated as shared; see `cache.is_shared()`.
+    """
+    def setup_test_environment(self, **kwargs):
+        super(KegbotTestSuiteRunner, self).setup_test_environment(**kwargs)
+        settings.CELERY_ALWAYS_EAGER = True
+        # Tests run in a single process, so even the local memory cache is
+        # shared by everything under test.
+        settings.KEGBOT_SHARED_CACHE = True
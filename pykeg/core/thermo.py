@@ -0,0 +1,504 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Buffered ingestion and pruning of temperature sensor readings.
+
+Readings are kept in one Thermolog row per sensor and minute, the last
+reading winning.  The first reading of each minute is written straight
+away, so the latest temperature is always visible; later readings in the
+same minute only replace the sensor's buffered value in the cache, which
+is written once the next minute starts or by `flush_all()`.  Old rows are
+removed by `prune()`, run periodically, rather than on every reading.
+
+Readings are also rolled up into ThermoRollup records of their 5 minute,
+hour and day, which are kept for longer.  The readings of a minute are
+added to the rollups once the minute is over.  `get_history()` picks the
+resolution to read for a window of time.
+
+Buffering needs a cache shared by all processes, including the Celery
+worker running `flush_all()`.  Without one (see `cache.is_shared()`), every
+reading is written and rolled up straight away.
+"""
+
+import calendar
+import datetime
+
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+from django.db.models.signals import post_syncdb
+from django.utils import timezone
+
+from pykeg.core import cache
+from pykeg.core import hotstate
+from pykeg.core import kb_common
+from pykeg.core import models
+
+# Buffered readings expire after this many seconds, long after they should
+# have been written.
+BUFFER_SECONDS = 60 * 60
+
+# Number of rows deleted per query when pruning.
+PRUNE_BATCH_SIZE = 1000
+
+# Maximum number of records returned by `get_history()`, unless the window
+# is longer than even daily rollups allow.
+MAX_HISTORY_POINTS = 360
+
+# Resolution of Thermolog records, in seconds.
+LOG_RESOLUTION = 60
+
+# Cache namespace of buffered readings, updated to drop them all.
+BUFFER_NAMESPACE = 'thermo_buffer'
+
+# Number of buckets updated per statement, which keeps parameters under
+# SQLite's limit of 999.
+UPDATE_BATCH_SIZE = 300
+
+def _buffer_key(sensor_id):
+    return 'thermo_buffer:%s' % sensor_id
+
+def get_sensor_ids(names):
+    """Returns a dict of the ThermoSensor id of each raw name in `names`.
+
+    Ids are read from `hotstate`, so known sensors are resolved without a
+    query.  Sensors which do not exist yet are created.
+    """
+    ids = hotstate.get_sensor_ids()
+    for name in set(names).difference(ids):
+        ids[name] = models.ThermoSensor.objects.create(raw_name=name,
+            nice_name=name).id
+    return dict((name, ids[name]) for name in names)
+
+def _invalidate(kbcache, sensors):
+    """Updates the cache namespaces which depend on readings of `sensors`.
+
+    Args:
+        kbcache: The KegbotCache to update namespaces through.
+        sensors: A dict of raw name by sensor id.
+    """
+    if not sensors:
+        # Records that nothing cached has changed.
+        kbcache.update_namespaces([])
+        return
+    namespaces = set([cache.NS_SYSTEM])
+    for name in sensors.itervalues():
+        namespaces.add(cache.namespace(cache.NS_SENSOR, name))
+    # Taps report the latest temperature of their sensor.
+    for tap in hotstate.get_taps():
+        if tap.temperature_sensor_id in sensors:
+            namespaces.add(cache.namespace(cache.NS_TAP, tap.meter_name))
+    kbcache.update_namespaces(namespaces)
+
+def _new_bucket(sensor_id, when, temperature):
+    """Returns a minute bucket holding a single reading.
+
+    Buckets are also what the cache buffers: the last reading of the minute
+    and its aggregates for rollups, the id of the Thermolog record once there
+    is one, and whether the record is older than the last reading.
+    """
+    return {'sensor_id': sensor_id, 'id': None, 'time': when,
+        'temp': temperature, 'dirty': True, 'min': temperature,
+        'max': temperature, 'sum': temperature, 'count': 1}
+
+def _merge(bucket, later):
+    """Adds the readings of `later`, taken after those of `bucket`, to it."""
+    bucket['temp'] = later['temp']
+    bucket['dirty'] = True
+    bucket['min'] = min(bucket['min'], later['min'])
+    bucket['max'] = max(bucket['max'], later['max'])
+    bucket['sum'] += later['sum']
+    bucket['count'] += later['count']
+
+def _find(buckets):
+    """Returns the ids of existing records for buckets, by sensor and time."""
+    logs = models.Thermolog.objects.filter(
+        sensor__in=set(b['sensor_id'] for b in buckets),
+        time__in=set(b['time'] for b in buckets))
+    return dict(((sensor_id, when), log_id)
+        for sensor_id, when, log_id in logs.values_list('sensor', 'time', 'id'))
+
+def _update(buckets):
+    """Sets the temperature of existing records, returning the number updated.
+
+    The ORM can only set a column to the same value for every row, so all
+    buckets are written with a single UPDATE of the form
+    `SET temp = CASE id WHEN ... THEN ... END`.
+    """
+    if len(buckets) == 1:
+        return models.Thermolog.objects.filter(id=buckets[0]['id']).update(
+            temp=buckets[0]['temp'])
+    qn = connection.ops.quote_name
+    meta = models.Thermolog._meta
+    sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+        qn(meta.db_table), qn(meta.get_field('temp').column), qn(meta.pk.column),
+        ' '.join(['WHEN %s THEN %s'] * len(buckets)), qn(meta.pk.column),
+        ', '.join(['%s'] * len(buckets)))
+    params = []
+    for bucket in buckets:
+        params.extend((bucket['id'], bucket['temp']))
+    params.extend(bucket['id'] for bucket in buckets)
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.rowcount
+
+def _insert(buckets):
+    """Creates records for buckets which have none, and sets their ids."""
+    if len(buckets) == 1:
+        bucket = buckets[0]
+        bucket['id'] = models.Thermolog.objects.create(
+            sensor_id=bucket['sensor_id'], time=bucket['time'],
+            temp=bucket['temp']).id
+        return
+    models.Thermolog.objects.bulk_create([models.Thermolog(
+        sensor_id=b['sensor_id'], time=b['time'], temp=b['temp'])
+        for b in buckets])
+    # bulk_create does not set ids.
+    ids = _find(buckets)
+    for bucket in buckets:
+        bucket['id'] = ids[(bucket['sensor_id'], bucket['time'])]
+
+def _write(buckets, new=()):
+    """Writes the last reading of each bucket to its record.
+
+    Records of buckets without an id are looked up with a single query.  All
+    existing records are then updated in one statement, and the missing ones
+    inserted in another; see `_update()`.  There is no portable upsert
+    statement to do both at once.
+
+    Args:
+        buckets: Buckets which may already have a record.
+        new: Buckets known to have none, such as minutes after a buffer's.
+    """
+    unknown = [b for b in buckets if not b['id']]
+    if unknown:
+        ids = _find(unknown)
+        for bucket in unknown:
+            bucket['id'] = ids.get((bucket['sensor_id'], bucket['time']))
+    existing = [b for b in buckets if b['id']]
+    for i in range(0, len(existing), UPDATE_BATCH_SIZE):
+        batch = existing[i:i + UPDATE_BATCH_SIZE]
+        if _update(batch) < len(batch):
+            # The records of some buffers have been deleted meanwhile.
+            ids = set(models.Thermolog.objects.filter(
+                id__in=[b['id'] for b in batch]).values_list('id', flat=True))
+            for bucket in batch:
+                if bucket['id'] not in ids:
+                    bucket['id'] = None
+    missing = [b for b in buckets if not b['id']] + list(new)
+    if missing:
+        _insert(missing)
+    for bucket in buckets:
+        bucket['dirty'] = False
+    for bucket in new:
+        bucket['dirty'] = False
+
+def period_start(when, resolution):
+    """Returns the start of the period of `resolution` seconds holding `when`."""
+    seconds = calendar.timegm(when.utctimetuple())
+    return datetime.datetime.fromtimestamp(seconds - seconds % resolution,
+        timezone.utc)
+
+def _roll_up(buckets):
+    """Adds the readings of buckets to their rollups of every resolution."""
+    totals = {}
+    for bucket in buckets:
+        for resolution, name in models.ThermoRollup.RESOLUTIONS:
+            key = (bucket['sensor_id'], resolution,
+                period_start(bucket['time'], resolution))
+            total = totals.get(key)
+            if not total:
+                totals[key] = dict(bucket)
+            else:
+                _merge(total, bucket)
+        bucket['count'] = 0
+    if not totals:
+        return
+
+    try:
+        _apply_rollups(totals)
+    except IntegrityError:
+        # Another process created some of the same rollups first.  They
+        # exist now, so the second attempt locks and updates them.
+        _apply_rollups(totals)
+
+def _apply_rollups(totals):
+    """Adds aggregates, by sensor id, resolution and start, to rollups."""
+    with transaction.atomic():
+        rollups = models.ThermoRollup.objects.select_for_update().filter(
+            sensor__in=set(k[0] for k in totals),
+            time__in=set(k[2] for k in totals))
+        existing = dict(((r.sensor_id, r.resolution, r.time), r) for r in rollups)
+        new = []
+        for key, total in totals.iteritems():
+            rollup = existing.get(key)
+            if not rollup:
+                sensor_id, resolution, start = key
+                new.append(models.ThermoRollup(sensor_id=sensor_id,
+                    resolution=resolution, time=start, min_temp=total['min'],
+                    max_temp=total['max'], temp_sum=total['sum'],
+                    num_readings=total['count']))
+                continue
+            rollup.min_temp = min(rollup.min_temp, total['min'])
+            rollup.max_temp = max(rollup.max_temp, total['max'])
+            rollup.temp_sum += total['sum']
+            rollup.num_readings += total['count']
+            rollup.save()
+        models.ThermoRollup.objects.bulk_create(new)
+
+def _claim(kbcache, buffered):
+    """Claims a buffer whose minute is over, for writing and rolling up.
+
+    A cache `add()` succeeds only once, so when a reading and `flush_all()`
+    both close the same buffer, its readings are rolled up only once.
+
+    Returns:
+        True if the claim was taken, False if another caller holds it.
+    """
+    seconds = calendar.timegm(buffered['time'].utctimetuple())
+    return kbcache.add('thermo_closed:%s:%s' % (buffered['sensor_id'], seconds),
+        True, BUFFER_SECONDS)
+
+def record_readings(readings, kbcache=None):
+    """Records readings in the buckets of their sensor and minute.
+
+    The latest minute of each sensor is buffered: its first reading is
+    written, and later ones are kept in the cache.  Readings of earlier
+    minutes are written and rolled up straight away.  Sensors are resolved,
+    and records read and written, with a few queries for all readings.
+
+    Args:
+        readings: A list of (sensor name, temperature, minute) tuples, in the
+            order the readings were taken.  Temperatures are in celsius
+            degrees, and minutes have their seconds cleared.  Sensors which
+            do not exist are created.
+        kbcache: The KegbotCache to buffer readings in, and to update
+            namespaces through.  Only namespaces of sensors whose records
+            were written are updated.
+
+    Returns:
+        A list of the Thermolog for each reading's bucket, which may hold an
+        earlier reading until the buffer is flushed.
+    """
+    sensor_ids = get_sensor_ids([name for name, temperature, when in readings])
+    buckets = {}
+    for name, temperature, when in readings:
+        key = (sensor_ids[name], when)
+        reading = _new_bucket(key[0], when, temperature)
+        if key in buckets:
+            _merge(buckets[key], reading)
+        else:
+            buckets[key] = reading
+    by_sensor = {}
+    for key in sorted(buckets):
+        by_sensor.setdefault(key[0], []).append(buckets[key])
+
+    if not kbcache:
+        kbcache = cache.KegbotCache()
+    names = dict((sensor_id, name) for name, sensor_id in sensor_ids.iteritems())
+    if not cache.is_shared():
+        # Readings merge into rollups the same way, one minute or one batch
+        # at a time.
+        writes = [buckets[key] for key in sorted(buckets)]
+        _write(writes)
+        _roll_up(writes)
+        _invalidate(kbcache, dict((b['sensor_id'], names[b['sensor_id']])
+            for b in writes))
+        return _results(readings, sensor_ids, buckets)
+
+    keys = dict((sensor_id, _buffer_key(sensor_id)) for sensor_id in by_sensor)
+    found, generations = kbcache.ns_get_many(keys.values(), [BUFFER_NAMESPACE])
+
+    writes = []
+    new = []
+    over = []
+    buffers = {}
+    for sensor_id, sensor_buckets in by_sensor.iteritems():
+        buffered = found.get(keys[sensor_id])
+        merged = None
+        newer = []
+        for bucket in sensor_buckets:
+            if not buffered or bucket['time'] > buffered['time']:
+                newer.append(bucket)
+            elif bucket['time'] == buffered['time']:
+                merged = bucket
+                _merge(buffered, bucket)
+                buckets[(sensor_id, bucket['time'])] = buffered
+                buffers[sensor_id] = buffered
+            else:
+                # A late reading for an earlier minute.
+                writes.append(bucket)
+                over.append(bucket)
+        if not newer:
+            continue
+        if buffered:
+            # The buffer's minute is over, so the newer ones are not written.
+            # If `flush_all()` has already closed it, only the readings of
+            # this batch are left to roll up.
+            if buffered['dirty']:
+                writes.append(buffered)
+            if buffered['count'] and _claim(kbcache, buffered):
+                over.append(buffered)
+            elif merged:
+                over.append(merged)
+            new.extend(newer)
+        else:
+            writes.extend(newer)
+        over.extend(newer[:-1])
+        buffers[sensor_id] = newer[-1]
+
+    if writes or new:
+        _write(writes, new)
+        _roll_up(over)
+    _invalidate(kbcache, dict((b['sensor_id'], names[b['sensor_id']])
+        for b in writes + new))
+    if buffers:
+        kbcache.ns_set_many(dict((keys[sensor_id], buffered)
+            for sensor_id, buffered in buffers.iteritems()), generations,
+            BUFFER_SECONDS)
+
+    return _results(readings, sensor_ids, buckets)
+
+def _results(readings, sensor_ids, buckets):
+    """Returns the Thermolog of each reading's bucket."""
+    ret = []
+    for name, temperature, when in readings:
+        bucket = buckets[(sensor_ids[name], when)]
+        ret.append(models.Thermolog(id=bucket['id'],
+            sensor_id=bucket['sensor_id'], time=when, temp=bucket['temp']))
+    return ret
+
+def flush_all(now=None):
+    """Writes the buffered readings of all sensors.
+
+    Buffers of minutes which are over are also added to the rollups.
+
+    Returns:
+        The number of buffers written.
+    """
+    if not now:
+        now = timezone.now()
+    minute = now.replace(second=0, microsecond=0)
+    kbcache = cache.KegbotCache()
+    names = dict((sensor_id, name) for name, sensor_id
+        in hotstate.get_sensor_ids().iteritems())
+    keys = dict((sensor_id, _buffer_key(sensor_id)) for sensor_id in names)
+    found, generations = kbcache.ns_get_many(keys.values(), [BUFFER_NAMESPACE])
+
+    writes = []
+    over = []
+    previous = {}
+    for sensor_id, key in keys.iteritems():
+        buffered = found.get(key)
+        if not buffered:
+            continue
+        done = buffered['time'] < minute and buffered['count']
+        if not buffered['dirty'] and not done:
+            continue
+        if done and not _claim(kbcache, buffered):
+            # A newer reading has closed the buffer.
+            continue
+        previous[sensor_id] = dict(buffered)
+        if buffered['dirty']:
+            writes.append(buffered)
+        if done:
+            over.append(buffered)
+    if not previous:
+        return 0
+
+    with transaction.atomic():
+        _write(writes)
+        _roll_up(over)
+    # Unless a newer reading has arrived meanwhile.
+    current = kbcache.ns_get_many([keys[s] for s in previous],
+        [BUFFER_NAMESPACE])[0]
+    kbcache.ns_set_many(dict((keys[s], found[keys[s]])
+        for s in previous if current.get(keys[s]) == previous[s]),
+        generations, BUFFER_SECONDS)
+    _invalidate(kbcache, dict((s, names[s]) for s in previous))
+    return len(previous)
+
+def get_history(sensor, start, now=None, max_points=MAX_HISTORY_POINTS):
+    """Returns a sensor's records since `start`, at a suitable resolution.
+
+    Thermolog records are used if they are kept for the whole window and
+    there are at most `max_points` of them.  Otherwise the finest rollups
+    which meet the same conditions are used, or daily rollups if none do.
+
+    Returns:
+        A tuple of the resolution in seconds, and a QuerySet of the records,
+        newest first.  Records are missing for periods without readings.
+    """
+    if not now:
+        now = timezone.now()
+    window = (now - start).total_seconds()
+    log_start = now - datetime.timedelta(
+        minutes=kb_common.THERMO_SENSOR_HISTORY_MINUTES)
+    if start >= log_start and window / LOG_RESOLUTION <= max_points:
+        logs = sensor.thermolog_set.filter(
+            time__gte=period_start(start, LOG_RESOLUTION))
+        return LOG_RESOLUTION, logs
+
+    for resolution, name in models.ThermoRollup.RESOLUTIONS:
+        days = kb_common.THERMO_ROLLUP_HISTORY_DAYS.get(resolution)
+        if days and start < now - datetime.timedelta(days=days):
+            continue
+        if window / resolution <= max_points:
+            break
+    rollups = sensor.rollups.filter(resolution=resolution,
+        time__gte=period_start(start, resolution))
+    return resolution, rollups
+
+def prune(now=None, batch_size=PRUNE_BATCH_SIZE):
+    """Deletes readings older than `kb_common.THERMO_SENSOR_HISTORY_MINUTES`.
+
+    Rollups older than `kb_common.THERMO_ROLLUP_HISTORY_DAYS` are deleted
+    too.  Rows are deleted in batches of `batch_size`, each in its own short
+    transaction, so pruning never holds locks for long.
+
+    Returns:
+        The number of rows deleted.
+    """
+    if not now:
+        now = timezone.now()
+    keep_time = now - datetime.timedelta(
+        minutes=kb_common.THERMO_SENSOR_HISTORY_MINUTES)
+    count = _delete(models.Thermolog.objects.filter(time__lt=keep_time),
+        batch_size)
+    for resolution, days in kb_common.THERMO_ROLLUP_HISTORY_DAYS.iteritems():
+        keep_time = now - datetime.timedelta(days=days)
+        count += _delete(models.ThermoRollup.objects.filter(
+            resolution=resolution, time__lt=keep_time), batch_size)
+    return count
+
+def _delete(qs, batch_size):
+    """Deletes the rows of `qs` in batches, returning the number deleted."""
+    qs = qs.order_by('id')
+    count = 0
+    while True:
+        ids = list(qs.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return count
+        with transaction.atomic():
+            qs.model.objects.filter(id__in=ids).delete()
+        count += len(ids)
+
+def _post_syncdb(sender, **kwargs):
+    # Emitted after `flush`, which deletes the rows buffered readings are for.
+    cache.KegbotCache().update_namespace(BUFFER_NAMESPACE)
+post_syncdb.connect(_post_syncdb)
@@ -0,0 +1,261 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.core.thermo"""
+
+import datetime
+import mock
+
+from django.core.cache import cache as django_cache
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from . import backend
+from . import cache
+from . import kb_common
+from . import models
+from . import thermo
+
+SENSOR_NAME = 'thermo0'
+
+class ThermoTestCase(TransactionTestCase):
+    def setUp(self):
+        django_cache.clear()
+        self.backend = backend.KegbotBackend()
+        self.start = timezone.now().replace(second=0, microsecond=0)
+
+    def log(self, temperature, seconds):
+        return self.backend.log_sensor_reading(SENSOR_NAME, temperature,
+            when=self.start + datetime.timedelta(seconds=seconds))
+
+    def temps(self):
+        return [(l.time, l.temp) for l in models.Thermolog.objects.order_by('time')]
+
+    def testCoalescing(self):
+        first = self.log(1.0, 0)
+        self.assertEquals([(self.start, 1.0)], self.temps())
+
+        # Later readings in the same minute are only buffered.
+        with CaptureQueriesContext(connection) as ctx:
+            record = self.log(2.0, 20)
+            self.log(3.0, 40)
+        self.assertEquals([], [q for q in ctx.captured_queries
+            if 'core_thermolog' in q['sql']])
+        self.assertEquals((first.id, 2.0), (record.id, record.temp))
+        self.assertEquals([(self.start, 1.0)], self.temps())
+
+        # The next minute writes the last reading of the previous one.
+        next_minute = self.start + datetime.timedelta(minutes=1)
+        self.log(4.0, 60)
+        self.assertEquals([(self.start, 3.0), (next_minute, 4.0)], self.temps())
+
+        # A late reading for an earlier minute is written directly.
+        self.log(5.0, 30)
+        self.log(6.0, 70)
+        self.assertEquals([(self.start, 5.0), (next_minute, 4.0)], self.temps())
+
+        self.assertEquals(1, thermo.flush_all())
+        self.assertEquals([(self.start, 5.0), (next_minute, 6.0)], self.temps())
+        self.assertEquals(0, thermo.flush_all())
+
+    def testColdBuffer(self):
+        self.log(1.0, 0)
+        django_cache.clear()
+        self.log(2.0, 30)
+        self.assertEquals([(self.start, 2.0)], self.temps())
+
+    def testBatch(self):
+        minute = datetime.timedelta(minutes=1)
+        self.log(1.0, 0)
+        self.backend.log_sensor_reading('thermo1', 0.0, self.start - minute)
+        readings = [
+            (SENSOR_NAME, 2.0, self.start),
+            ('thermo1', 3.0, self.start - minute),
+            ('thermo1', 4.0, self.start),
+            (SENSOR_NAME, 5.0, self.start + minute),
+            ('thermo1', 6.0, self.start - minute),
+            ('thermo2', 7.0, self.start),
+        ]
+        with CaptureQueriesContext(connection) as ctx:
+            records = self.backend.log_sensor_readings(readings)
+        self.assertEquals([2.0, 6.0, 4.0, 5.0, 6.0, 7.0],
+            [r.temp for r in records])
+
+        sensors = dict(models.ThermoSensor.objects.values_list('raw_name', 'id'))
+        logs = models.Thermolog.objects.order_by('sensor', 'time')
+        self.assertEquals([
+            (sensors[SENSOR_NAME], self.start, 2.0),
+            (sensors[SENSOR_NAME], self.start + minute, 5.0),
+            (sensors['thermo1'], self.start - minute, 6.0),
+            (sensors['thermo1'], self.start, 4.0),
+            (sensors['thermo2'], self.start, 7.0),
+        ], [(l.sensor_id, l.time, l.temp) for l in logs])
+        self.assertEquals(dict((r.id, r.temp) for r in records),
+            dict(logs.filter(id__in=[r.id for r in records]).values_list('id', 'temp')))
+
+        # Minutes followed by later ones in the batch are rolled up.
+        hourly = models.ThermoRollup.objects.filter(
+            resolution=models.ThermoRollup.HOURLY)
+        self.assertEquals(sorted([(sensors[SENSOR_NAME], 2), (sensors['thermo1'], 3)]),
+            sorted(hourly.values_list('sensor', 'num_readings')))
+
+        # One query for each new sensor; all records are then written with a
+        # lookup, an update, an insert and a read of the new ids.
+        writes = [q for q in ctx.captured_queries if 'core_thermolog' in q['sql']]
+        self.assertEquals(4, len(writes))
+        self.assertEquals(1, len([q for q in writes if 'CASE' in q['sql']]))
+
+        # Once loaded after sensors change, the name map needs no query.
+        self.backend.log_sensor_readings(readings[-1:])
+        with CaptureQueriesContext(connection) as ctx:
+            self.backend.log_sensor_readings(readings[-1:])
+        self.assertEquals([], [q for q in ctx.captured_queries
+            if 'core_thermosensor' in q['sql']])
+
+    def testPrune(self):
+        history = datetime.timedelta(minutes=kb_common.THERMO_SENSOR_HISTORY_MINUTES)
+        for minutes in range(5):
+            self.log(1.0, -history.total_seconds() - (minutes + 1) * 60)
+        self.log(1.0, 0)
+        self.assertEquals(6, models.Thermolog.objects.count())
+
+        self.assertEquals(5, thermo.prune(now=self.start, batch_size=2))
+        self.assertEquals([(self.start, 1.0)], self.temps())
+        self.assertEquals(0, thermo.prune(now=self.start))
+
+    def rollups(self, resolution):
+        return [(r.time, r.min_temp, r.max_temp, r.temp, r.num_readings)
+            for r in models.ThermoRollup.objects.filter(
+                resolution=resolution).order_by('time')]
+
+    def testRollups(self):
+        # Rollups are aligned in UTC.
+        self.start = datetime.datetime(2014, 1, 1, 23, 58, tzinfo=timezone.utc)
+        self.log(4.0, 0)
+        self.log(2.0, 30)
+        self.assertEquals([], self.rollups(models.ThermoRollup.HOURLY))
+
+        # Each minute is rolled up when the next one starts.
+        self.log(3.0, 60)
+        self.log(7.0, 90)
+        self.log(5.0, 120)
+        self.log(1.0, 30)  # Late, and rolled up straight away.
+        hour = datetime.datetime(2014, 1, 1, 23, 0, tzinfo=timezone.utc)
+        self.assertEquals([(hour, 1.0, 7.0, 3.4, 5)],
+            self.rollups(models.ThermoRollup.HOURLY))
+        five = datetime.datetime(2014, 1, 1, 23, 55, tzinfo=timezone.utc)
+        self.assertEquals([(five, 1.0, 7.0, 3.4, 5)],
+            self.rollups(models.ThermoRollup.FIVE_MINUTES))
+        self.assertEquals([(self.start.replace(hour=0, minute=0), 1.0, 7.0, 3.4, 5)],
+            self.rollups(models.ThermoRollup.DAILY))
+
+        # The periodic flush rolls up minutes which are over.
+        self.assertEquals(1, thermo.flush_all(now=self.start + datetime.timedelta(minutes=3)))
+        day = datetime.datetime(2014, 1, 2, tzinfo=timezone.utc)
+        self.assertEquals([(hour, 1.0, 7.0, 3.4, 5), (day, 5.0, 5.0, 5.0, 1)],
+            self.rollups(models.ThermoRollup.HOURLY))
+        self.assertEquals(0, thermo.flush_all(now=self.start + datetime.timedelta(minutes=3)))
+
+    @override_settings(KEGBOT_SHARED_CACHE=False)
+    def testUnsharedCache(self):
+        """Without a shared cache, every reading is written and rolled up."""
+        self.start = datetime.datetime(2014, 1, 1, 12, 30, tzinfo=timezone.utc)
+        self.log(1.0, 0)
+        self.log(3.0, 20)
+        self.assertEquals([(self.start, 3.0)], self.temps())
+        hour = self.start.replace(minute=0)
+        self.assertEquals([(hour, 1.0, 3.0, 2.0, 2)],
+            self.rollups(models.ThermoRollup.HOURLY))
+        self.assertEquals(0, thermo.flush_all(
+            now=self.start + datetime.timedelta(minutes=1)))
+
+    def testCloseOnce(self):
+        self.start = datetime.datetime(2014, 1, 1, 12, 30, tzinfo=timezone.utc)
+        self.log(1.0, 0)
+        self.log(2.0, 20)
+        sensor_id = models.ThermoSensor.objects.get(raw_name=SENSOR_NAME).id
+        kbcache = cache.KegbotCache()
+        key = thermo._buffer_key(sensor_id)
+        found, generations = kbcache.ns_get_many([key], [thermo.BUFFER_NAMESPACE])
+
+        # The periodic flush closes the minute while readings which close it
+        # too still see the buffer as it was.  Only their own readings of the
+        # minute are rolled up.
+        next_minute = self.start + datetime.timedelta(minutes=1)
+        self.assertEquals(1, thermo.flush_all(now=next_minute))
+        kbcache.ns_set(key, found[key], generations)
+        self.backend.log_sensor_readings([(SENSOR_NAME, 3.0, self.start),
+            (SENSOR_NAME, 4.0, next_minute)])
+        hourly = models.ThermoRollup.objects.get(resolution=models.ThermoRollup.HOURLY)
+        self.assertEquals((1.0, 3.0, 3), (hourly.min_temp, hourly.max_temp,
+            hourly.num_readings))
+        self.assertEquals([(self.start, 3.0), (next_minute, 4.0)], self.temps())
+
+    def testRollupConflict(self):
+        sensor = models.ThermoSensor.objects.create(raw_name=SENSOR_NAME)
+        when = datetime.datetime(2014, 1, 1, 12, 30, tzinfo=timezone.utc)
+        thermo._roll_up([thermo._new_bucket(sensor.id, when, 1.0)])
+
+        # Rollups created by another process after the lookup are updated.
+        select_for_update = models.ThermoRollup.objects.select_for_update
+        calls = []
+        def racing_select_for_update():
+            calls.append(True)
+            if len(calls) == 1:
+                return models.ThermoRollup.objects.none()
+            return select_for_update()
+        with mock.patch.object(models.ThermoRollup.objects, 'select_for_update',
+                racing_select_for_update):
+            thermo._roll_up([thermo._new_bucket(sensor.id, when, 3.0)])
+        self.assertEquals(2, len(calls))
+        self.assertEquals([(2, 4.0)] * 3,
+            list(models.ThermoRollup.objects.values_list('num_readings', 'temp_sum')))
+
+    def testGetHistory(self):
+        self.start = datetime.datetime(2014, 1, 1, 12, 30, tzinfo=timezone.utc)
+        sensor = models.ThermoSensor.objects.create(raw_name=SENSOR_NAME)
+        now = self.start
+        def resolution(**kwargs):
+            return thermo.get_history(sensor, now - datetime.timedelta(**kwargs),
+                now)[0]
+        self.assertEquals(60, resolution(hours=6))
+        self.assertEquals(models.ThermoRollup.FIVE_MINUTES, resolution(hours=7))
+        self.assertEquals(models.ThermoRollup.HOURLY, resolution(days=7))
+        self.assertEquals(models.ThermoRollup.DAILY, resolution(days=30))
+        self.assertEquals(models.ThermoRollup.DAILY, resolution(days=3000))
+
+        self.log(2.0, -3600)
+        self.log(4.0, -3540)
+        self.log(6.0, 0)
+        with CaptureQueriesContext(connection) as ctx:
+            records = list(thermo.get_history(sensor,
+                now - datetime.timedelta(days=7), now)[1])
+        self.assertEquals(1, len(ctx.captured_queries))
+        self.assertEquals([3.0], [r.temp for r in records])
+
+    def testPruneRollups(self):
+        self.start = self.start - datetime.timedelta(days=20)
+        self.log(1.0, 0)
+        self.log(1.0, 60)
+        self.assertEquals(3, models.ThermoRollup.objects.count())
+        thermo.prune(now=self.start + datetime.timedelta(days=20))
+        self.assertEquals([models.ThermoRollup.HOURLY, models.ThermoRollup.DAILY],
+            sorted(models.ThermoRollup.objects.values_list('resolution', flat=True)))
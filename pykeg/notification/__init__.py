@@ -23,13 +23,20 @@ from django.conf import settings
 from django.utils.module_loading import import_by_path
 from pykeg.notification import models
 
-__all__ = ['get_backends', 'handle_new_system_events']
+__all__ = ['get_backend_names', 'get_backend', 'get_backends',
+    'get_recipients', 'handle_new_system_events']
+
+def get_backend_names():
+    """Returns the import paths of the enabled notification backend(s)."""
+    return list(settings.NOTIFICATION_BACKENDS)
+
+def get_backend(name):
+    """Returns an instance of the notification backend at `name`."""
+    return import_by_path(name)()
 
 def get_backends():
     """Returns the enabled notification backend(s)."""
-    backend_names = settings.NOTIFICATION_BACKENDS
-    backends = [import_by_path(n)() for n in backend_names]
-    return backends
+    return [get_backend(n) for n in get_backend_names()]
 
 def handle_new_system_events(events):
     """Processes newly-generated system events.
@@ -47,28 +54,29 @@ def handle_new_system_events(events):
         handle_single_event(event, backends)
 
 def handle_single_event(event, backends):
-    kind = event.kind
     logger.info('Processing event: %s' % event.kind)
-    
     for backend in backends:
-        backend_name = str(backend.__class__)
-        prefs = models.NotificationSettings.objects.filter(backend=backend_name)
+        for user in get_recipients(event, backend):
+            logger.info('Notifying %s for event %s' % (user, event.kind))
+            backend.notify(event, user)
 
-        if kind == event.KEG_TAPPED:
-            prefs = prefs.filter(keg_tapped=True)
-        elif kind == event.SESSION_STARTED:
-            prefs = prefs.filter(session_started=True)
-        elif kind == event.KEG_VOLUME_LOW:
-            prefs = prefs.filter(keg_volume_low=True)
-        elif kind == event.KEG_ENDED:
-            prefs = prefs.filter(keg_ended=True)
-        else:
-            logger.info('Unknown kind: %s' % kind)
-            prefs = []
+def get_recipients(event, backend):
+    """Returns the users to notify of `event` through `backend`."""
+    kind = event.kind
+    backend_name = str(backend.__class__)
+    prefs = models.NotificationSettings.objects.filter(backend=backend_name)
 
-        logger.debug('Matching prefs: %s' % str(prefs))
-        for matching_pref in prefs:
-            user = matching_pref.user
-            logger.info('Notifying %s for event %s' % (user, kind))
-            backend.notify(event, user)
+    if kind == event.KEG_TAPPED:
+        prefs = prefs.filter(keg_tapped=True)
+    elif kind == event.SESSION_STARTED:
+        prefs = prefs.filter(session_started=True)
+    elif kind == event.KEG_VOLUME_LOW:
+        prefs = prefs.filter(keg_volume_low=True)
+    elif kind == event.KEG_ENDED:
+        prefs = prefs.filter(keg_ended=True)
+    else:
+        logger.info('Unknown kind: %s' % kind)
+        return []
 
+    logger.debug('Matching prefs: %s' % str(prefs))
+    return [pref.user for pref in prefs.select_related('user')]
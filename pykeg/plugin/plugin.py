@@ -169,10 +169,11 @@ class Plugin:
         return []
 
     def handle_new_event(self, event):
-        """Called synchronously when a new event is posted.
+        """Called from a background task when a new event is posted.
 
-        Plugins should *quickly* perform any work. Long-running work can be
-        performed by scheduling a background task in this method."""
+        Each plugin handles events in its own task, which is retried if this
+        method raises an exception.  Long-running work can also be performed
+        by scheduling a further background task in this method."""
         pass
 
     ### Helpers
@@ -21,6 +21,8 @@
 import pytz
 
 from django.conf import settings
+from django.db.models import Max
+from django.db.models.query import QuerySet
 
 from kegbot.api import api_pb2
 from kegbot.api import models_pb2
@@ -31,6 +33,8 @@ from pykeg.contrib.soundserver import models as soundserver_models
 from pykeg.core import models
 
 _CONVERSION_MAP = {}
+_DICT_CONVERSION_MAP = {}
+_PREFETCH_MAP = {}
 
 def converts(kind):
     def decorate(f):
@@ -39,6 +43,30 @@ def converts(kind):
         return f
     return decorate
 
+def converts_dict(kind):
+    """Registers a function which converts `kind` directly to a dictionary.
+
+    The result must equal `ProtoMessageToDict()` of the object's `ToProto()`
+    message, key for key and in the same order.
+    """
+    def decorate(f):
+        global _DICT_CONVERSION_MAP
+        _DICT_CONVERSION_MAP[kind] = f
+        return f
+    return decorate
+
+def prefetches(kind):
+    """Registers a function which loads a QuerySet of `kind` for conversion.
+
+    The function is called with the QuerySet and the `full` flag, and returns
+    the objects with the related data used by their conversion already loaded.
+    """
+    def decorate(f):
+        global _PREFETCH_MAP
+        _PREFETCH_MAP[kind] = f
+        return f
+    return decorate
+
 def datestr(dt):
     if settings.USE_TZ:
         return dt.isoformat()
@@ -62,12 +90,41 @@ def ToProto(obj, full=False):
     else:
         raise ValueError, "Unknown object type: %s" % kind
 
+def ToProtoMany(objs, full=False):
+    """Converts a sequence of objects to protocol format.
+
+    Unlike calling `ToProto()` on each object, the related objects used by the
+    conversion are loaded in a fixed number of queries when `objs` is a
+    QuerySet.
+    """
+    return [ToProto(obj, full) for obj in prefetch(objs, full)]
+
 def ToDict(obj, full=False):
-    res = ToProto(obj, full)
-    if hasattr(res, '__iter__'):
-        return [protoutil.ProtoMessageToDict(m) for m in res]
-    else:
-        return protoutil.ProtoMessageToDict(res)
+    """Converts the object to the dictionary form of its protocol message.
+
+    Objects with a registered `converts_dict` function are converted without
+    building the protocol message.
+    """
+    if hasattr(obj, '__iter__'):
+        return [ToDict(item, full) for item in obj]
+    kind = obj.__class__
+    if kind in _DICT_CONVERSION_MAP:
+        return _DICT_CONVERSION_MAP[kind](obj, full)
+    return protoutil.ProtoMessageToDict(ToProto(obj, full))
+
+def ToDictMany(objs, full=False):
+    """Like `ToProtoMany()`, but returns dictionaries as `ToDict()` does."""
+    return [ToDict(obj, full) for obj in prefetch(objs, full)]
+
+def prefetch(objs, full=False):
+    """Returns `objs` with the related data used by their conversion loaded.
+
+    QuerySets are loaded with the function registered by `prefetches`; other
+    sequences are returned unchanged.
+    """
+    if isinstance(objs, QuerySet) and objs.model in _PREFETCH_MAP:
+        return _PREFETCH_MAP[objs.model](objs, full)
+    return objs
 
 ### Model conversions
 
@@ -130,7 +187,7 @@ def BeverageToProto(beverage, full=False):
     if beverage.original_gravity is not None:
         ret.original_gravity = beverage.original_gravity
     if beverage.picture:
-        ret.image.MergeFrom(ToProto(beverage.image))
+        ret.image.MergeFrom(ToProto(beverage.picture))
     return ret
 
 @converts(models.BeverageProducer)
@@ -234,7 +291,7 @@ def KegTapToProto(tap, full=False):
 
     if tap.temperature_sensor:
         ret.thermo_sensor_id = tap.temperature_sensor_id
-        log = tap.temperature_sensor.LastLog()
+        log = _last_log(tap.temperature_sensor)
         if log:
             ret.last_temperature.MergeFrom(ToProto(log))
     return ret
@@ -263,6 +320,16 @@ def ThermoLogToProto(record, full=False):
     ret.time = datestr(record.time)
     return ret
 
+@converts(models.ThermoRollup)
+def ThermoRollupToProto(record, full=False):
+    """Converts a rollup to a ThermoLog of its average temperature."""
+    ret = models_pb2.ThermoLog()
+    ret.id = record.id
+    ret.sensor_id = record.sensor_id
+    ret.temperature_c = record.temp
+    ret.time = datestr(record.time)
+    return ret
+
 @converts(models.ThermoSensor)
 def ThermoSensorToProto(record, full=False):
     ret = models_pb2.ThermoSensor()
@@ -342,6 +409,308 @@ def SoundEventToProto(record, full=False):
         ret.user = record.user.username
     return ret
 
+### Direct dictionary conversions
+#
+# These mirror the protocol message conversions above, adding keys in field
+# number order as `ProtoMessageToDict()` does.  protolib_test checks that
+# both produce identical JSON.
+
+@converts_dict(models.AuthenticationToken)
+def AuthTokenToDict(record, full=False):
+    ret = util.AttrDict()
+    ret.id = record.id
+    ret.auth_device = record.auth_device
+    ret.token_value = record.token_value
+    if record.user_id:
+        ret.username = str(record.user.username)
+    if record.nice_name:
+        ret.nice_name = record.nice_name
+    ret.enabled = record.enabled
+    ret.created_time = datestr(record.created_time)
+    if record.expire_time:
+        ret.expire_time = datestr(record.expire_time)
+    if record.pin:
+        ret.pin = record.pin
+    if record.user_id:
+        ret.user = ToDict(record.user)
+    return ret
+
+@converts_dict(models.Picture)
+def PictureToDict(record, full=False):
+    ret = util.AttrDict()
+    ret.url = record.resized.url
+    if record.time:
+        ret.time = datestr(record.time)
+    if record.caption:
+        ret.caption = record.caption
+    if record.user_id:
+        ret.user_id = record.user.username
+    if record.keg_id:
+        ret.keg_id = record.keg_id
+    if record.session_id:
+        ret.session_id = record.session_id
+    ret.thumbnail_url = record.thumbnail.url
+    ret.original_url = record.image.url
+    return ret
+
+@converts_dict(models.Beverage)
+def BeverageToDict(beverage, full=False):
+    ret = util.AttrDict()
+    ret.id = str(beverage.id)
+    ret.name = beverage.name
+    ret.brewer_id = str(beverage.producer_id)
+    ret.style_id = '0'
+    abv = beverage.abv_percent or 0.0
+    ret.abv = max(min(abv, 100.0), 0.0)
+    if beverage.specific_gravity is not None:
+        ret.specific_gravity = beverage.specific_gravity
+    if beverage.original_gravity is not None:
+        ret.original_gravity = beverage.original_gravity
+    if beverage.picture_id:
+        ret.image = ToDict(beverage.picture)
+    return ret
+
+@converts_dict(models.Drink)
+def DrinkToDict(drink, full=False):
+    ret = util.AttrDict()
+    ret.id = drink.id
+    ret.ticks = drink.ticks
+    ret.volume_ml = drink.volume_ml
+    ret.session_id = drink.session_id
+    ret.time = datestr(drink.time)
+    ret.duration = drink.duration
+    if drink.keg_id:
+        ret.keg_id = drink.keg_id
+    if drink.user_id:
+        ret.user_id = drink.user.username
+    ret.url = drink.get_absolute_url()
+    if drink.shout:
+        ret.shout = drink.shout
+    if full:
+        if drink.user_id:
+            ret.user = ToDict(drink.user)
+        if drink.keg_id:
+            ret.keg = ToDict(drink.keg)
+        if drink.session_id:
+            ret.session = ToDict(drink.session)
+        if drink.picture_id:
+            ret.images = [ToDict(drink.picture)]
+    if drink.tick_time_series:
+        ret.tick_time_series = drink.tick_time_series
+    return ret
+
+@converts_dict(models.Keg)
+def KegToDict(keg, full=False):
+    ret = util.AttrDict()
+    ret.id = keg.id
+    ret.type_id = str(keg.type_id)
+    ret.volume_ml_remain = float(keg.remaining_volume_ml())
+    ret.percent_full = keg.percent_full()
+    ret.start_time = datestr(keg.start_time)
+    ret.end_time = datestr(keg.end_time)
+    ret.online = keg.online
+    if keg.description is not None:
+        ret.description = keg.description
+    ret.spilled_ml = keg.spilled_ml
+    ret.url = keg.get_absolute_url()
+    if full and keg.type_id:
+        ret.type = ToDict(keg.type)
+    ret.size_id = 0
+    if full:
+        # Deprecated.
+        ret.size = util.AttrDict()
+        ret.size.id = 0
+        ret.size.name = keg.keg_type
+        ret.size.volume_ml = keg.full_volume_ml
+    ret.size_name = keg.keg_type
+    ret.size_volume_ml = keg.full_volume_ml
+    return ret
+
+@converts_dict(models.KegTap)
+def KegTapToDict(tap, full=False):
+    ret = util.AttrDict()
+    ret.id = tap.id
+    ret.name = tap.name
+    ret.meter_name = tap.meter_name
+    ret.relay_name = tap.relay_name or ''
+    ret.ml_per_tick = tap.ml_per_tick
+    if tap.description is not None:
+        ret.description = tap.description
+    if tap.temperature_sensor_id:
+        ret.thermo_sensor_id = tap.temperature_sensor_id
+        log = _last_log(tap.temperature_sensor)
+        if log:
+            ret.last_temperature = ToDict(log)
+    if tap.current_keg_id:
+        ret.current_keg_id = tap.current_keg_id
+        if full:
+            ret.current_keg = ToDict(tap.current_keg, full=True)
+    return ret
+
+@converts_dict(models.DrinkingSession)
+def SessionToDict(record, full=False):
+    ret = util.AttrDict()
+    ret.id = record.id
+    ret.start_time = datestr(record.start_time)
+    ret.end_time = datestr(record.end_time)
+    ret.volume_ml = record.volume_ml
+    ret.name = record.name or ''
+    ret.url = record.get_absolute_url()
+    if full:
+        ret.is_active = record.IsActiveNow()
+    return ret
+
+@converts_dict(models.Thermolog)
+def ThermoLogToDict(record, full=False):
+    ret = util.AttrDict()
+    ret.id = record.id
+    ret.sensor_id = record.sensor_id
+    ret.temperature_c = record.temp
+    ret.time = datestr(record.time)
+    return ret
+
+@converts_dict(models.ThermoRollup)
+def ThermoRollupToDict(record, full=False):
+    ret = util.AttrDict()
+    ret.id = record.id
+    ret.sensor_id = record.sensor_id
+    ret.temperature_c = record.temp
+    ret.time = datestr(record.time)
+    return ret
+
+@converts_dict(models.ThermoSensor)
+def ThermoSensorToDict(record, full=False):
+    ret = util.AttrDict()
+    ret.id = record.id
+    ret.sensor_name = record.raw_name
+    ret.nice_name = record.nice_name
+    return ret
+
+@converts_dict(models.User)
+def UserToDict(user, full=False):
+    ret = util.AttrDict()
+    ret.username = user.username
+    if user.mugshot_id:
+        ret.image = ToDict(user.mugshot)
+    ret.is_active = user.is_active
+    if full:
+        ret.first_name = user.first_name
+        ret.last_name = user.last_name
+        ret.email = user.email
+        ret.is_staff = user.is_staff
+        ret.is_superuser = user.is_superuser
+        ret.last_login = datestr(user.last_login)
+        ret.date_joined = datestr(user.date_joined)
+    ret.url = user.get_absolute_url()
+    return ret
+
+@converts_dict(models.SystemEvent)
+def SystemEventToDict(record, full=False):
+    ret = util.AttrDict()
+    ret.id = record.id
+    ret.kind = record.kind
+    ret.time = datestr(record.time)
+    if record.drink_id:
+        ret.drink_id = record.drink_id
+    if record.keg_id:
+        ret.keg_id = record.keg_id
+    if record.session_id:
+        ret.session_id = record.session_id
+    if record.user_id:
+        ret.user_id = str(record.user.username)
+
+    image = None
+    if record.kind in ('drink_poured', 'session_started', 'session_joined') and record.user:
+        image = record.user.mugshot
+    elif record.kind in ('keg_tapped', 'keg_ended'):
+        if record.keg.type and record.keg.type.picture:
+            image = record.keg.type.picture
+    if image:
+        ret.image = ToDict(image)
+
+    if full:
+        if record.user_id:
+            ret.user = ToDict(record.user, full=True)
+        if record.drink_id:
+            ret.drink = ToDict(record.drink, full=True)
+        if record.keg_id:
+            ret.keg = ToDict(record.keg, full=True)
+        if record.session_id:
+            ret.session = ToDict(record.session, full=True)
+    return ret
+
+@converts_dict(soundserver_models.SoundEvent)
+def SoundEventToDict(record, full=False):
+    ret = util.AttrDict()
+    ret.event_name = record.event_name
+    ret.event_predicate = record.event_predicate
+    ret.sound_url = record.soundfile.sound.url
+    if record.user_id:
+        ret.user = record.user.username
+    return ret
+
+### QuerySet prefetches
+
+# Related objects used by each conversion, as select_related() lookups.
+_DRINK_RELATED = ('user__mugshot__user', 'keg__type__picture__user',
+    'session', 'picture__user')
+
+@prefetches(models.Drink)
+def PrefetchDrinks(qs, full=False):
+    return qs.select_related(*_DRINK_RELATED)
+
+@prefetches(models.SystemEvent)
+def PrefetchEvents(qs, full=False):
+    related = ['keg__type__picture__user', 'session', 'user__mugshot__user']
+    if full:
+        related += ['drink__' + r for r in _DRINK_RELATED]
+    return qs.select_related(*related)
+
+@prefetches(models.KegTap)
+def PrefetchTaps(qs, full=False):
+    taps = list(qs.select_related('current_keg__type__picture__user',
+        'temperature_sensor'))
+    sensors = dict((t.temperature_sensor_id, t.temperature_sensor)
+        for t in taps if t.temperature_sensor_id)
+    for sensor in sensors.values():
+        sensor._last_log = None
+    if sensors:
+        latest = models.Thermolog.objects.filter(sensor__in=sensors.keys())
+        latest = latest.order_by().values('sensor').annotate(latest=Max('time'))
+        times = dict((row['sensor'], row['latest']) for row in latest)
+        for log in models.Thermolog.objects.filter(sensor__in=times.keys(),
+                time__in=set(times.values())):
+            sensor = sensors[log.sensor_id]
+            if log.time == times[log.sensor_id] and not sensor._last_log:
+                sensor._last_log = log
+    return taps
+
+@prefetches(models.Keg)
+def PrefetchKegs(qs, full=False):
+    return qs.select_related('type__picture__user')
+
+@prefetches(models.User)
+def PrefetchUsers(qs, full=False):
+    return qs.select_related('mugshot__user')
+
+@prefetches(models.Picture)
+def PrefetchPictures(qs, full=False):
+    return qs.select_related('user')
+
+@prefetches(models.AuthenticationToken)
+def PrefetchAuthTokens(qs, full=False):
+    return qs.select_related('user__mugshot__user')
+
+@prefetches(soundserver_models.SoundEvent)
+def PrefetchSoundEvents(qs, full=False):
+    return qs.select_related('soundfile', 'user')
+
+def _last_log(sensor):
+    """Returns the sensor's latest Thermolog, as loaded by PrefetchTaps()."""
+    if hasattr(sensor, '_last_log'):
+        return sensor._last_log
+    return sensor.LastLog()
+
 # Composite messages
 
 def GetDrinkDetail(drink):
@@ -0,0 +1,198 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.proto.protolib"""
+
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from django.utils import timezone
+from kegbot.api import protoutil
+from kegbot.util import kbjson
+from PIL import Image
+
+from pykeg.contrib.soundserver import models as soundserver_models
+from pykeg.core import backend
+from pykeg.core import models
+from pykeg.core.testutils import make_datetime
+
+from . import protolib
+
+import datetime
+import shutil
+import StringIO
+import tempfile
+
+class ToProtoManyTestCase(TransactionTestCase):
+    def setUp(self):
+        self.backend = backend.KegbotBackend()
+        self.taps = [
+            self.backend.create_tap('tap%s' % i, 'kegboard.flow%s' % i,
+                ml_per_tick=1/2200.0)
+            for i in range(4)]
+        for tap in self.taps:
+            self.backend.start_keg(tap.meter_name, beverage_name='Beer',
+                beverage_type='beer', producer_name='Unknown',
+                style_name='Unknown')
+        self.now = make_datetime(2014, 1, 2, 12, 00)
+
+    def pour(self, count):
+        for i in range(count):
+            user = self.backend.create_new_user('user%s' % models.User.objects.count())
+            self.backend.record_drink(self.taps[i % 2].meter_name, ticks=1,
+                volume_ml=100, username=user.username,
+                pour_time=self.now + datetime.timedelta(minutes=i))
+
+    def convert(self, qs, full=True):
+        """Returns the ToProtoMany() result and number of queries it made."""
+        with CaptureQueriesContext(connection) as ctx:
+            ret = protolib.ToProtoMany(qs, full=full)
+        return ret, len(ctx.captured_queries)
+
+    def testQueryCountIsFlat(self):
+        self.pour(2)
+        num_queries = {}
+        for model in (models.Drink, models.SystemEvent, models.User):
+            num_queries[model] = self.convert(model.objects.all())[1]
+
+        self.pour(6)
+        for model, expected in num_queries.iteritems():
+            objs, actual = self.convert(model.objects.all())
+            self.assertTrue(len(objs) > 6)
+            self.assertEquals(expected, actual,
+                '%s: %s queries, expected %s' % (model.__name__, actual, expected))
+
+    def testSameAsToProto(self):
+        self.pour(4)
+        for model in (models.Drink, models.SystemEvent, models.User,
+                models.Keg, models.KegTap):
+            for full in (False, True):
+                qs = model.objects.all()
+                self.assertEquals([protolib.ToProto(o, full) for o in qs],
+                    protolib.ToProtoMany(qs, full))
+
+    def testTapTemperatures(self):
+        # Readings older than the sensor history are discarded when logged.
+        start = timezone.now() - datetime.timedelta(minutes=30)
+        for i, tap in enumerate(self.taps[:3]):
+            sensor_name = 'thermo%s' % i
+            for minutes in range(3):
+                self.backend.log_sensor_reading(sensor_name, 2.0 + minutes + i,
+                    when=start + datetime.timedelta(minutes=minutes * 5))
+            models.KegTap.objects.filter(id=tap.id).update(
+                temperature_sensor=models.ThermoSensor.objects.get(raw_name=sensor_name))
+
+        qs = models.KegTap.objects.all().order_by('name')
+        expected = [protolib.ToProto(t, full=True) for t in qs]
+        taps, num_queries = self.convert(qs)
+        self.assertEquals(expected, taps)
+        self.assertEquals(3, num_queries)
+        self.assertEquals([4.0, 5.0, 6.0],
+            [t.last_temperature.temperature_c for t in taps[:3]])
+        self.assertFalse(taps[3].HasField('last_temperature'))
+
+
+class ToDictTestCase(TransactionTestCase):
+    """Checks that ToDict() output is byte-identical to the protobuf path."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_settings.enable()
+
+        self.backend = backend.KegbotBackend()
+        site = models.KegbotSite.get()
+        taps = [self.backend.create_tap('tap%s' % i, 'kegboard.flow%s' % i,
+            ml_per_tick=1/2200.0) for i in range(3)]
+        keg = self.backend.start_keg('kegboard.flow0', beverage_name='Beer',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+        keg.description = u'Caf\xe9 keg'
+        keg.save()
+        keg.type.picture = self.make_picture()
+        keg.type.specific_gravity = 1.05
+        keg.type.save()
+        self.backend.start_keg('kegboard.flow1', beverage_name='Other',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+
+        user = self.backend.create_new_user('user1')
+        user.mugshot = self.make_picture(user=user)
+        user.first_name = u'Zo\xeb'
+        user.save()
+        self.backend.create_new_user('user2')
+
+        now = timezone.now()
+        for sensor_name in ('thermo0', 'thermo1'):
+            self.backend.log_sensor_reading(sensor_name, 4.5,
+                when=now - datetime.timedelta(minutes=5))
+        models.KegTap.objects.filter(id=taps[0].id).update(
+            temperature_sensor=models.ThermoSensor.objects.get(raw_name='thermo0'))
+
+        pours = (
+            ('kegboard.flow0', 100.1, 'user1', u'Prost \u2713'),
+            ('kegboard.flow1', 250, 'user2', ''),
+            ('kegboard.flow0', 33.3, None, 'guest'),
+        )
+        for i, (tap_name, volume_ml, username, shout) in enumerate(pours):
+            self.backend.record_drink(tap_name, ticks=10, volume_ml=volume_ml,
+                username=username, shout=shout,
+                pour_time=now - datetime.timedelta(minutes=len(pours) - i))
+        drink = models.Drink.objects.get(user=user)
+        drink.picture = self.make_picture(user=user, session=drink.session,
+            keg=drink.keg, caption='First!')
+        drink.save()
+
+        models.AuthenticationToken.objects.create(auth_device='core.rfid',
+            token_value='deadbeef', user=user, nice_name='Tag', pin='1234',
+            expire_time=now)
+        models.AuthenticationToken.objects.create(auth_device='core.onewire',
+            token_value='cafe')
+        soundfile = soundserver_models.SoundFile(site=site, title='Ding')
+        soundfile.sound.save('ding.wav', ContentFile('RIFF'), save=False)
+        soundfile.save()
+        soundserver_models.SoundEvent.objects.create(site=site,
+            event_name='drink_poured', event_predicate='', soundfile=soundfile,
+            user=user)
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def make_picture(self, **kwargs):
+        data = StringIO.StringIO()
+        Image.new('RGB', (4, 4)).save(data, 'PNG')
+        picture = models.Picture(**kwargs)
+        picture.image.save('test.png', ContentFile(data.getvalue()), save=False)
+        picture.save()
+        return picture
+
+    def testGoldenOutput(self):
+        kinds = (models.AuthenticationToken, models.Picture, models.Beverage,
+            models.Drink, models.Keg, models.KegTap, models.DrinkingSession,
+            models.Thermolog, models.ThermoSensor, models.User,
+            models.SystemEvent, soundserver_models.SoundEvent)
+        for kind in kinds:
+            objs = kind.objects.all()
+            self.assertTrue(objs.exists(), kind.__name__)
+            for full in (False, True):
+                expected = [kbjson.dumps(protoutil.ProtoMessageToDict(
+                    protolib.ToProto(o, full))) for o in objs]
+                actual = [kbjson.dumps(d) for d in protolib.ToDictMany(objs, full)]
+                self.assertEquals(expected, actual,
+                    '%s (full=%s)' % (kind.__name__, full))
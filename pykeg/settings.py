@@ -168,6 +168,27 @@ KEGBOT_PLUGINS = [
     'pykeg.contrib.webhook.plugin.WebhookPlugin',
 ]
 
+# When non-zero, only the latest stats record of each system, keg, user and
+# session is stored, plus a checkpoint record every this many drinks.  Run
+# `kegbot kb_regen_stats` after changing this setting to compact existing data.
+KEGBOT_STATS_CHECKPOINT_INTERVAL = 0
+
+# When True, recording a drink only saves the drink and keg volume; stats,
+# events and plugin tasks are generated by the `process_drinks` Celery task.
+# A Celery worker must be running for drinks to be processed.
+KEGBOT_DEFER_DRINK_PROCESSING = False
+
+# Whether the default cache is shared by all web and Celery processes, such
+# as memcached.  Frequently read state and buffered sensor readings are only
+# kept in the cache if it is.  None guesses from CACHES; the default local
+# memory cache is not shared.
+KEGBOT_SHARED_CACHE = None
+
+# Maximum number of /api/events/wait requests which may block at once in
+# each server process.  Requests only block under servers which handle
+# several requests per process, such as gunicorn with gevent workers.
+KEGBOT_MAX_EVENT_WAITERS = 20
+
 # You probably don't want to turn this on.
 DEMO_MODE = False
 
@@ -193,6 +214,18 @@ CELERYBEAT_SCHEDULE = {
         'task': 'pykeg.web.tasks.ping',
         'schedule': timedelta(seconds=60),
     },
+    'process-drinks-every-60-seconds': {
+        'task': 'pykeg.web.tasks.process_drinks',
+        'schedule': timedelta(seconds=60),
+    },
+    'flush-sensor-readings-every-60-seconds': {
+        'task': 'pykeg.web.tasks.flush_sensor_readings',
+        'schedule': timedelta(seconds=60),
+    },
+    'prune-sensor-readings-every-10-minutes': {
+        'task': 'pykeg.web.tasks.prune_sensor_readings',
+        'schedule': timedelta(minutes=10),
+    },
 }
 
 ### logging
@@ -321,7 +354,7 @@ UNTAPPD_CLIENT_SECRET = ''
 ### Imagekit
 IMAGEKIT_DEFAULT_IMAGE_CACHE_BACKEND = 'imagekit.imagecache.NonValidatingImageCacheBackend'
 
-TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
+TEST_RUNNER = 'pykeg.core.testutils.KegbotTestSuiteRunner'
 NOSE_ARGS = ['--exe']
 SKIP_SOUTH_TESTS = True
 SOUTH_TESTS_MIGRATE = False
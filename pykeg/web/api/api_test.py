@@ -18,22 +18,44 @@
 
 """Unittests for pykeg.web.api"""
 
+from django.core.cache import cache as django_cache
+from django.db import connections
 from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from pykeg.core import backend
+from pykeg.core import cache
 from pykeg.core import models
 from pykeg.core import defaults
+from pykeg.contrib.soundserver import models as soundserver_models
+from pykeg.web.api import util
+from pykeg.web.api import views
 from kegbot.util import kbjson
 
+import datetime
+import mock
+import threading
+import time
+
 ### Helper methods
 
 def create_site():
     return defaults.set_defaults(set_is_setup=True)
 
 class BaseApiTestCase(TransactionTestCase):
+    def setUp(self):
+        django_cache.clear()
+
     def get(self, subpath, data={}, follow=False, **extra):
         response = self.client.get('/api/%s' % subpath, data=data, follow=follow,
             **extra)
         return response, kbjson.loads(response.content)
 
+    def post(self, subpath, data={}, follow=False, **extra):
+        response = self.client.post('/api/%s' % subpath, data=data, follow=follow,
+            **extra)
+        return response, kbjson.loads(response.content)
+
 class ApiClientTestCase(BaseApiTestCase):
     def testNotSetUp(self):
         '''Api endpoints should all error out prior to site setup.'''
@@ -128,3 +150,329 @@ class ApiClientTestCase(BaseApiTestCase):
         response, data = self.get(endpoint)
         self.assertEquals(data.meta.result, 'error')
         self.assertEquals(data.error.code, 'NoAuthTokenError')
+
+    def testDrinkBatch(self):
+        create_site()
+        user = models.User.objects.create(username='testuser', is_staff=True)
+        models.ApiKey.objects.create(user=user, key='123')
+        keg = backend.KegbotBackend().start_keg('kegboard.flow0',
+            beverage_name='Unknown', beverage_type='beer',
+            producer_name='Unknown', style_name='Unknown')
+        endpoint = 'taps/kegboard.flow0/drinks/batch'
+
+        pours = [
+            {'ticks': 100, 'volume_ml': 100, 'pour_time': 1000, 'now': 2000},
+            {'ticks': 200, 'volume_ml': 200, 'username': 'testuser'},
+            {'ticks': 'bogus'},
+        ]
+        response, data = self.post(endpoint, {'drinks': kbjson.dumps(pours)},
+            HTTP_X_KEGBOT_API_KEY='123')
+        self.assertEquals(data.meta.result, 'error')
+        self.assertEquals(data.error.code, 'BadRequestError')
+        self.assertEquals(0, models.Drink.objects.count())
+
+        response, data = self.post(endpoint, {'drinks': kbjson.dumps(pours[:2])},
+            HTTP_X_KEGBOT_API_KEY='123')
+        self.assertEquals(data.meta.result, 'ok')
+        self.assertEquals([100, 200], [d.volume_ml for d in data.objects])
+        self.assertEquals([True, True], [d.processed for d in data.objects])
+        self.assertEquals('testuser', data.objects[1].user_id)
+
+        self.assertEquals(300, models.Keg.objects.get(id=keg.id).served_volume_ml)
+        stats = models.KegbotSite.get().GetStats()
+        self.assertEquals(2, stats.total_pours)
+        self.assertEquals(300, stats.total_volume_ml)
+
+    def testThermoSensorLogs(self):
+        create_site()
+        b = backend.KegbotBackend()
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        for minutes, temp in ((-60 * 48, 2.0), (-60 * 48 + 1, 4.0), (0, 5.0)):
+            b.log_sensor_reading('thermo0', temp,
+                when=hour + datetime.timedelta(minutes=minutes))
+
+        response, data = self.get('thermo-sensors/thermo0/logs')
+        self.assertEquals([5.0, 4.0, 2.0], [l.temperature_c for l in data.objects])
+
+        # Long windows are read from rollups.
+        response, data = self.get('thermo-sensors/thermo0/logs', {'hours': 72})
+        self.assertEquals([3.0], [l.temperature_c for l in data.objects])
+
+        response, data = self.get('thermo-sensors/thermo0/logs', {'hours': 0})
+        self.assertEquals(data.error.code, 'BadRequestError')
+
+    def testThermoBatch(self):
+        create_site()
+        user = models.User.objects.create(username='testuser', is_staff=True)
+        models.ApiKey.objects.create(user=user, key='123')
+        endpoint = 'thermo-sensors/readings/batch'
+
+        readings = [
+            {'sensor': 'thermo0', 'temp_c': 4.0, 'when': 1000, 'now': 1120},
+            {'sensor': 'thermo1', 'temp_c': 6.0},
+            {'sensor': 'thermo0', 'temp_c': 'bogus'},
+        ]
+        response, data = self.post(endpoint, {'readings': kbjson.dumps(readings)},
+            HTTP_X_KEGBOT_API_KEY='123')
+        self.assertEquals(data.meta.result, 'error')
+        self.assertEquals(data.error.code, 'BadRequestError')
+        self.assertEquals(0, models.Thermolog.objects.count())
+
+        response, data = self.post(endpoint, {'readings': kbjson.dumps(readings[:2])},
+            HTTP_X_KEGBOT_API_KEY='123')
+        self.assertEquals(data.meta.result, 'ok')
+        self.assertEquals([4.0, 6.0], [l.temperature_c for l in data.objects])
+        sensors = dict(models.ThermoSensor.objects.values_list('raw_name', 'id'))
+        self.assertEquals([sensors['thermo0'], sensors['thermo1']],
+            [l.sensor_id for l in data.objects])
+        self.assertEquals(2, models.Thermolog.objects.count())
+
+        readings = [{'sensor': 'thermo0', 'temp_c': 1000.0}]
+        response, data = self.post(endpoint, {'readings': kbjson.dumps(readings)},
+            HTTP_X_KEGBOT_API_KEY='123')
+        self.assertEquals(data.error.code, 'BadRequestError')
+
+    def testThermoCacheNamespaces(self):
+        """Readings only update the cache namespaces of written sensors."""
+        create_site()
+        user = models.User.objects.create(username='testuser', is_staff=True)
+        models.ApiKey.objects.create(user=user, key='123')
+        kbcache = cache.KegbotCache()
+        sensor_ns = cache.namespace(cache.NS_SENSOR, 'thermo0')
+        generations = kbcache.get_generations([sensor_ns])
+
+        minute = timezone.now().replace(second=0, microsecond=0)
+        with mock.patch.object(timezone, 'now', return_value=minute):
+            # The first reading of the minute is written.
+            self.post('thermo-sensors/thermo0', {'temp_c': 4.0},
+                HTTP_X_KEGBOT_API_KEY='123')
+            current = cache.KegbotCache().get_generations([sensor_ns])
+            self.assertNotEquals(generations[sensor_ns], current[sensor_ns])
+            self.assertEquals(generations[cache.GLOBAL_GENERATION],
+                current[cache.GLOBAL_GENERATION])
+
+            # Later ones are only buffered.
+            self.post('thermo-sensors/thermo0', {'temp_c': 5.0},
+                HTTP_X_KEGBOT_API_KEY='123')
+            self.assertEquals(current,
+                cache.KegbotCache().get_generations([sensor_ns]))
+
+    def testPagination(self):
+        create_site()
+        response, data = self.get('drinks/')
+        self.assertEquals(data.meta.result, 'ok')
+        self.assertEquals([], data.objects)
+
+        be = backend.KegbotBackend()
+        keg = be.start_keg('kegboard.flow0', beverage_name='Unknown',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+        drinks = [be.record_drink('kegboard.flow0', ticks=1, volume_ml=100)
+            for i in range(5)]
+        ids = [d.id for d in drinks]
+
+        # Pages are newest first, each linking to the next.
+        response, data = self.get('kegs/%s/drinks/' % keg.id, {'limit': 2})
+        self.assertEquals(ids[4:2:-1], [d.id for d in data.objects])
+        response, data = self.get(data.meta.next[len('/api/'):])
+        self.assertEquals(ids[2:0:-1], [d.id for d in data.objects])
+        response, data = self.get(data.meta.next[len('/api/'):])
+        self.assertEquals(ids[:1], [d.id for d in data.objects])
+        self.assertFalse('next' in data.meta)
+
+        # Pages after a cursor continue towards newer drinks.
+        response, data = self.get('drinks/', {'limit': 2, 'after': ids[0]})
+        self.assertEquals(ids[2:0:-1], [d.id for d in data.objects])
+        response, data = self.get(data.meta.next[len('/api/'):])
+        self.assertEquals(ids[4:2:-1], [d.id for d in data.objects])
+
+        # Other lists ordered by id are paged too.
+        response, data = self.get('kegs/%s/events/' % keg.id, {'limit': 2})
+        self.assertEquals(2, len(data.objects))
+        self.assertTrue(data.objects[0].id > data.objects[1].id)
+        self.assertTrue('next' in data.meta)
+
+        # Sessions, kegs and sound events are paged newest first.
+        now = timezone.now()
+        for days in (1, 2, 3):
+            be.record_drink('kegboard.flow0', ticks=1, volume_ml=100,
+                pour_time=now + datetime.timedelta(days=days))
+        session_ids = sorted(models.DrinkingSession.objects.values_list('id',
+            flat=True), reverse=True)
+        self.assertEquals(4, len(session_ids))
+        for path in ('sessions/', 'kegs/%s/sessions/' % keg.id):
+            response, data = self.get(path, {'limit': 3})
+            self.assertEquals(session_ids[:3], [s.id for s in data.objects])
+            response, data = self.get(data.meta.next[len('/api/'):])
+            self.assertEquals(session_ids[3:], [s.id for s in data.objects])
+
+        for i in range(2):
+            be.end_keg('kegboard.flow0')
+            be.start_keg('kegboard.flow0', beverage_name='Unknown',
+                beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+        keg_ids = sorted(models.Keg.objects.values_list('id', flat=True),
+            reverse=True)
+        self.assertEquals(3, len(keg_ids))
+        response, data = self.get('kegs/', {'limit': 2})
+        self.assertEquals(keg_ids[:2], [k.id for k in data.objects])
+        response, data = self.get(data.meta.next[len('/api/'):])
+        self.assertEquals(keg_ids[2:], [k.id for k in data.objects])
+
+        site = models.KegbotSite.get()
+        sound = soundserver_models.SoundFile.objects.create(site=site,
+            sound='sounds/test.mp3', title='Test')
+        names = ['event%d' % i for i in range(3)]
+        for name in names:
+            soundserver_models.SoundEvent.objects.create(site=site,
+                event_name=name, soundfile=sound)
+        user = models.User.objects.create(username='admin', is_staff=True)
+        models.ApiKey.objects.create(user=user, key='123')
+        response, data = self.get('sound-events/', {'limit': 2},
+            HTTP_X_KEGBOT_API_KEY='123')
+        self.assertEquals(names[:0:-1], [e.event_name for e in data.objects])
+        response, data = self.get(data.meta.next[len('/api/'):],
+            HTTP_X_KEGBOT_API_KEY='123')
+        self.assertEquals(names[:1], [e.event_name for e in data.objects])
+        self.assertFalse('next' in data.meta)
+
+        response, data = self.get('drinks/', {'limit': 'bogus'})
+        self.assertEquals(data.meta.result, 'error')
+        self.assertEquals(data.error.code, 'BadRequestError')
+
+    def testListOrder(self):
+        create_site()
+        models.KegTap.objects.create(name='Another Tap', meter_name='kegboard.flow2')
+        for username in ('zed', 'amy', 'moe'):
+            models.User.objects.create(username=username)
+        user = models.User.objects.create(username='admin', is_staff=True)
+        models.ApiKey.objects.create(user=user, key='123')
+
+        # Lists not ordered by id keep their order, and are not paged.
+        response, data = self.get('taps/', {'limit': 1})
+        self.assertEquals(['Another Tap', 'Main Tap', 'Second Tap'],
+            [t.name for t in data.objects])
+        self.assertFalse('next' in data.meta)
+        response, data = self.get('users/', {'limit': 1},
+            HTTP_X_KEGBOT_API_KEY='123')
+        self.assertEquals(['admin', 'amy', 'moe', 'zed'],
+            [u.username for u in data.objects
+                if u.username in ('admin', 'amy', 'moe', 'zed')])
+        self.assertEquals(sorted(u.username for u in data.objects),
+            [u.username for u in data.objects])
+
+    def testStreaming(self):
+        create_site()
+        be = backend.KegbotBackend()
+        be.start_keg('kegboard.flow0', beverage_name='Unknown',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+        for i in range(5):
+            be.record_drink('kegboard.flow0', ticks=1, volume_ml=100)
+
+        response, expected = self.get('drinks/', {'limit': 1})
+        self.assertFalse('\n' in response.content)
+        response, expected = self.get('drinks/', {'pretty': 1})
+        self.assertTrue('\n' in response.content)
+
+        old_chunk_size = util.STREAM_CHUNK_SIZE
+        util.STREAM_CHUNK_SIZE = 2
+        try:
+            response = self.client.get('/api/drinks/', {'stream': 1, 'limit': 1})
+            self.assertTrue(response.streaming)
+            data = kbjson.loads(''.join(response.streaming_content))
+        finally:
+            util.STREAM_CHUNK_SIZE = old_chunk_size
+        self.assertEquals('ok', data.meta.result)
+        self.assertEquals(5, len(data.objects))
+        self.assertEquals(expected.objects, data.objects)
+
+    def testWaitForEvents(self):
+        create_site()
+        be = backend.KegbotBackend()
+        be.start_keg('kegboard.flow0', beverage_name='Unknown',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+
+        response, data = self.get('events/wait', {'since': 0})
+        self.assertEquals(['keg_tapped'], [e.kind for e in data.objects])
+        last_id = data.objects[0].id
+        response, data = self.get('events/wait', {'since': last_id, 'timeout': 0})
+        self.assertEquals([], data.objects)
+
+        # A pour in another thread wakes the waiting request.
+        conn = connections['default']
+        conn.allow_thread_sharing = True
+        def pour():
+            connections['default'] = conn
+            time.sleep(0.5)
+            be.record_drink('kegboard.flow0', ticks=1, volume_ml=100)
+        thread = threading.Thread(target=pour)
+        try:
+            thread.start()
+            start = time.time()
+            response, data = self.get('events/wait', {'timeout': 30},
+                **{'wsgi.multithread': True})
+            elapsed = time.time() - start
+            thread.join()
+        finally:
+            conn.allow_thread_sharing = False
+        # Woken once the pour has committed, not by the periodic recheck.
+        self.assertEquals('session_started', data.objects[0].kind)
+        self.assertTrue(data.objects[0].id > last_id)
+        self.assertTrue(elapsed < views.EVENT_RECHECK_SECONDS,
+            'Waited %.1fs' % elapsed)
+
+        # Requests which would hold a whole server process do not wait, and
+        # neither do requests beyond the limit of waiters.
+        last_id = data.objects[-1].id
+        for multithread, max_waiters in ((False, 20), (True, 0)):
+            with override_settings(KEGBOT_MAX_EVENT_WAITERS=max_waiters):
+                start = time.time()
+                response, data = self.get('events/wait',
+                    {'since': last_id, 'timeout': 30},
+                    **{'wsgi.multithread': multithread})
+            self.assertEquals([], data.objects)
+            self.assertTrue(time.time() - start < 5)
+
+    def testCacheNamespaces(self):
+        create_site()
+        be = backend.KegbotBackend()
+        kegs = [be.start_keg(meter_name, beverage_name='Unknown',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+            for meter_name in ('kegboard.flow0', 'kegboard.flow1')]
+
+        for keg in kegs:
+            response, data = self.get('kegs/%s' % keg.id)
+            self.assertFalse(getattr(response, 'is_from_cache', False))
+        response, data = self.get('kegs/%s' % kegs[1].id)
+        self.assertTrue(response.is_from_cache)
+
+        # A pour on the first keg leaves the second keg cached.
+        volume_ml_remain = data.object.volume_ml_remain
+        be.record_drink('kegboard.flow0', ticks=100, volume_ml=100)
+        response, data = self.get('kegs/%s' % kegs[0].id)
+        self.assertFalse(getattr(response, 'is_from_cache', False))
+        self.assertEquals(volume_ml_remain - 100, data.object.volume_ml_remain)
+        response, data = self.get('kegs/%s' % kegs[1].id)
+        self.assertTrue(response.is_from_cache)
+
+    def testCacheStaleWhileRevalidate(self):
+        create_site()
+        be = backend.KegbotBackend()
+        keg = be.start_keg('kegboard.flow0', beverage_name='Unknown',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+        endpoint = 'kegs/%s' % keg.id
+        response, data = self.get(endpoint)
+        volume_ml_remain = data.object.volume_ml_remain
+
+        # While another request holds the lock to recompute the response, the
+        # stale response is served.
+        be.record_drink('kegboard.flow0', ticks=100, volume_ml=100)
+        key = 'api:/api/%s' % endpoint
+        self.assertTrue(be.cache.lock(key, 10))
+        response, data = self.get(endpoint)
+        self.assertTrue(response.is_from_cache)
+        self.assertEquals(volume_ml_remain, data.object.volume_ml_remain)
+
+        be.cache.unlock(key)
+        response, data = self.get(endpoint)
+        self.assertFalse(getattr(response, 'is_from_cache', False))
+        self.assertEquals(volume_ml_remain - 100, data.object.volume_ml_remain)
+        self.assertTrue(be.cache.lock(key, 10))
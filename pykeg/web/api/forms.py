@@ -42,6 +42,10 @@ class ThermoPostForm(forms.Form):
     when = forms.IntegerField(required=False)
     now = forms.IntegerField(required=False)
 
+class ThermoBatchPostForm(ThermoPostForm):
+    """Handles one reading of a batch posted to /thermo-sensors/readings/batch/"""
+    sensor = forms.CharField(max_length=256)
+
 class CreateKegTapForm(forms.ModelForm):
     class Meta:
         model = models.KegTap
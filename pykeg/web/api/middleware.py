@@ -17,12 +17,15 @@
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.conf import settings
+from django.db.models.query import QuerySet
 from django.http import HttpResponse
+from pykeg.core import cache
 
 from . import util
 
 import logging
 import sys
+import time
 
 LOGGER = logging.getLogger(__name__)
 
@@ -55,8 +58,9 @@ class ApiRequestMiddleware:
             if need_auth:
                 util.check_api_key(request)
 
-            if request.method == 'GET':
-                cached = request.kbcache.gen_get(cache_key(request))
+            if (request.method == 'GET' and util.is_cacheable(view_func)
+                    and not util.is_streaming_request(request)):
+                cached = self._get_cached(request, view_kwargs)
                 if cached:
                     response = util.build_response(request, cached, 200)
                     response.is_from_cache = True
@@ -67,6 +71,36 @@ class ApiRequestMiddleware:
         except Exception, e:
             return util.wrap_exception(request, e)
 
+    def _get_cached(self, request, view_kwargs):
+        """Returns cached data for the request, or None to run the view.
+
+        When the cached data is missing or stale, only one request at a time
+        recomputes it.  Concurrent requests are served the stale data if
+        there is any, or else wait briefly for the recomputed data.
+        """
+        kbcache = request.kbcache
+        key = cache_key(request)
+        namespaces = cache_namespaces(view_kwargs)
+        stale = {}
+        found, request.kbcache_generations = kbcache.ns_get_many([key],
+            namespaces, stale)
+        if key in found:
+            return found[key]
+
+        if kbcache.lock(key, CACHE_LOCK_SECONDS):
+            request.kbcache_lock = key
+            return None
+        if key in stale:
+            return stale[key]
+
+        deadline = time.time() + CACHE_WAIT_SECONDS
+        while time.time() < deadline:
+            time.sleep(CACHE_POLL_SECONDS)
+            found, generations = kbcache.ns_get_many([key], namespaces)
+            if key in found:
+                return found[key]
+        return None
+
 
 class ApiResponseMiddleware:
     def process_exception(self, request, exception):
@@ -79,19 +113,61 @@ class ApiResponseMiddleware:
         if not util.is_api_request(request):
             return response
 
-        if not isinstance(response, HttpResponse):
-            data = util.prepare_data(response)
-            data['meta'] = {
-              'result': 'ok'
-            }
-            response = util.build_response(request, data, 200)
+        if isinstance(response, QuerySet) and util.is_streaming_request(request):
+            response = util.build_streaming_response(request, response)
+        elif not isinstance(response, HttpResponse):
+            try:
+                data = util.prepare_data(response, request)
+            except ValueError, e:
+                # Invalid list parameters, such as `limit`.
+                response = util.wrap_exception(request, e)
+                if response is None:
+                    raise
+            else:
+                data.setdefault('meta', {})['result'] = 'ok'
+                response = util.build_response(request, data, 200)
+
+                if request.method == 'GET' and response.status_code == 200:
+                    generations = getattr(request, 'kbcache_generations', None)
+                    if generations and not getattr(response, 'is_from_cache', False):
+                        request.kbcache.ns_set(cache_key(request), data, generations)
 
-            if request.method == 'GET' and response.status_code == 200:
-                if not getattr(response, 'is_from_cache', False):
-                    request.kbcache.gen_set(cache_key(request), data)
+        lock = getattr(request, 'kbcache_lock', None)
+        if lock:
+            request.kbcache.unlock(lock)
         response['Cache-Control'] = 'max-age=0'
         return response
 
 
+# Maximum time a request may spend recomputing a cached response before
+# other requests stop waiting on it.
+CACHE_LOCK_SECONDS = 10
+
+# How long, and how often, to check for a response being recomputed by
+# another request when there is no stale response to serve instead.
+CACHE_WAIT_SECONDS = 1.0
+CACHE_POLL_SECONDS = 0.05
+
+# View arguments which identify the cache namespace of a response.
+NAMESPACE_VIEW_KWARGS = (
+    ('keg_id', cache.NS_KEG),
+    ('tap_id', cache.NS_TAP),
+    ('username', cache.NS_USER),
+    ('session_id', cache.NS_SESSION),
+    ('sensor_name', cache.NS_SENSOR),
+)
+
 def cache_key(request):
     return 'api:%s' % request.get_full_path()
+
+def cache_namespaces(view_kwargs):
+    """Returns the cache namespaces a view's response depends on.
+
+    Views of a single keg, tap, user, session or sensor depend only on that
+    object; all other views depend on the system namespace.
+    """
+    ret = []
+    for arg, kind in NAMESPACE_VIEW_KWARGS:
+        if arg in view_kwargs:
+            ret.append(cache.namespace(kind, view_kwargs[arg]))
+    return ret or [cache.NS_SYSTEM]
@@ -34,6 +34,7 @@ urlpatterns = patterns('pykeg.web.api.views',
     url(r'^sessions/(?P<session_id>\d+)/?$', 'get_session'),
     url(r'^sessions/(?P<session_id>\d+)/stats/?$', 'get_session_stats'),
     url(r'^events/?$', 'all_events'),
+    url(r'^events/wait/?$', 'wait_for_events'),
     url(r'^sound-events/?$', 'all_sound_events'),
     url(r'^kegs/?$', 'all_kegs'),
     url(r'^kegs/(?P<keg_id>\d+)/?$', 'get_keg'),
@@ -49,8 +50,10 @@ urlpatterns = patterns('pykeg.web.api.views',
     url(r'^taps/(?P<tap_id>[\w\.]+)/activate/?$', 'tap_activate'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/spill/?$', 'tap_spill'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/calibrate/?$', 'tap_calibrate'),
+    url(r'^taps/(?P<tap_id>[\w\.]+)/drinks/batch/?$', 'tap_drinks_batch'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/?$', 'tap_detail'),
     url(r'^thermo-sensors/?$', 'all_thermo_sensors'),
+    url(r'^thermo-sensors/readings/batch/?$', 'thermo_sensors_batch'),
     url(r'^thermo-sensors/(?P<sensor_name>[^/]+)/?$', 'get_thermo_sensor'),
     url(r'^thermo-sensors/(?P<sensor_name>[^/]+)/logs/?$', 'get_thermo_sensor_logs'),
     url(r'^new-user/?$', 'register'),
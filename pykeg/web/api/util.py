@@ -21,6 +21,7 @@
 from django.conf import settings
 from django.http import Http404
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.db.models.query import QuerySet
 from pykeg.proto import protolib
 from kegbot.api import protoutil
@@ -41,6 +42,14 @@ import types
 LOGGER = logging.getLogger(__name__)
 
 ATTR_NEED_AUTH = 'api_auth_required'
+ATTR_NO_CACHE = 'api_no_cache'
+
+# Default and maximum number of objects in a page of a list response.
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+# Number of objects encoded at a time by streaming responses.
+STREAM_CHUNK_SIZE = 100
 
 def is_api_request(request):
     return request.path.startswith('/api')
@@ -51,6 +60,12 @@ def needs_auth(viewfunc):
 def set_needs_auth(viewfunc):
     setattr(viewfunc, ATTR_NEED_AUTH, True)
 
+def is_cacheable(viewfunc):
+    return not getattr(viewfunc, ATTR_NO_CACHE, False)
+
+def set_no_cache(viewfunc):
+    setattr(viewfunc, ATTR_NO_CACHE, True)
+
 def check_api_key(request):
     """Check a request for an API key."""
     keystr = request.META.get('HTTP_X_KEGBOT_API_KEY')
@@ -108,22 +123,72 @@ def build_response(request, result_data, response_code=200):
     callback = request.GET.get('callback')
     format = request.GET.get('format', None)
     debug = request.GET.get('debug', False)
-    indent = 2
+    html = format == 'html' or (settings.DEBUG and debug)
+    indent = 2 if html or get_flag_param(request, 'pretty') else None
 
     json_str = kbjson.dumps(result_data, indent=indent)
     if callback and validate_jsonp.is_valid_jsonp_callback_value(callback):
         json_str = '%s(%s);' % (callback, json_str)
 
-    if format == 'html' or (settings.DEBUG and debug):
+    if html:
         html = '<html><body><pre>%s</pre></body></html>' % json_str
         return HttpResponse(html, mimetype='text/html', status=response_code)
     else:
         return HttpResponse(json_str, mimetype='application/json', status=response_code)
 
+def is_streaming_request(request):
+    """Returns True if list responses should be streamed in full."""
+    return request.method == 'GET' and get_flag_param(request, 'stream')
+
+def build_streaming_response(request, qs):
+    """Builds an HTTP response which streams every object of a QuerySet.
+
+    The objects are read with `QuerySet.iterator()` and encoded a chunk at a
+    time, so memory use does not grow with the number of objects.  The
+    response is not paginated.
+    """
+    callback = request.GET.get('callback')
+    if not (callback and validate_jsonp.is_valid_jsonp_callback_value(callback)):
+        callback = None
+    return StreamingHttpResponse(_stream_objects(qs, callback),
+        content_type='application/json')
+
+def _stream_objects(qs, callback):
+    if callback:
+        yield '%s(' % callback
+    yield '{"objects": ['
+
+    objs = protolib.prefetch(qs, full=True)
+    if isinstance(objs, QuerySet):
+        objs = objs.iterator()
+    chunk = []
+    sep = ''
+    for obj in objs:
+        chunk.append(kbjson.dumps(protolib.ToDict(obj, full=True), indent=None))
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield sep + ', '.join(chunk)
+            chunk = []
+            sep = ', '
+    if chunk:
+        yield sep + ', '.join(chunk)
 
-def prepare_data(data, inner=False):
-    if isinstance(data, QuerySet) or type(data) == types.ListType:
-        result = [prepare_data(d, True) for d in data]
+    yield '], "meta": %s}' % kbjson.dumps({'result': 'ok'}, indent=None)
+    if callback:
+        yield ');'
+
+def prepare_data(data, request=None, inner=False):
+    meta = {}
+    if isinstance(data, QuerySet):
+        # Only lists ordered by id can be paged by id; others, such as taps
+        # by name, are short and returned whole in their own order.
+        if request and data.query.can_filter() and _is_descending(data) is not None:
+            data, next_path = paginate(data, request)
+            if next_path:
+                meta['next'] = next_path
+        result = protolib.ToDictMany(data, full=True)
+        container = 'objects'
+    elif type(data) == types.ListType:
+        result = [prepare_data(d, inner=True) for d in data]
         container = 'objects'
     elif isinstance(data, dict):
         result = data
@@ -134,15 +199,80 @@ def prepare_data(data, inner=False):
 
     if inner:
         return result
-    else:
-        return {
-          container: result
-        }
+    ret = {
+      container: result
+    }
+    if meta:
+        ret['meta'] = meta
+    return ret
+
+def paginate(qs, request):
+    """Returns a page of a QuerySet ordered by id, using keyset pagination.
+
+    The page holds up to `limit` objects (a request parameter), with ids below
+    the `before` parameter and/or above the `after` parameter.  Objects are
+    listed in the direction of the QuerySet's ordering: newest first if it is
+    descending, oldest first otherwise.
+
+    Returns:
+        A tuple of the list of objects in the page, and the path of the next
+        page, or None if there are no more objects.
+    """
+    limit = min(get_int_param(request, 'limit', DEFAULT_PAGE_LIMIT), MAX_PAGE_LIMIT)
+    if limit < 1:
+        raise ValueError('Parameter "limit" must be positive')
+    before = get_int_param(request, 'before')
+    after = get_int_param(request, 'after')
+
+    descending = _is_descending(qs)
+    scan_descending = descending
+    if before is not None:
+        qs = qs.filter(pk__lt=before)
+        scan_descending = True
+    if after is not None:
+        qs = qs.filter(pk__gt=after)
+        scan_descending = descending if before is not None else False
+
+    qs = qs.order_by('-pk' if scan_descending else 'pk')
+    objs = list(protolib.prefetch(qs[:limit + 1], full=True))
+    next_path = None
+    if len(objs) > limit:
+        objs = objs[:limit]
+        params = request.GET.copy()
+        params['before' if scan_descending else 'after'] = objs[-1].pk
+        next_path = '%s?%s' % (request.path, params.urlencode())
+    if scan_descending != descending:
+        objs.reverse()
+    return objs, next_path
+
+def _is_descending(qs):
+    """Returns whether a QuerySet is ordered by descending id, or None if it
+    is not ordered by id alone."""
+    ordering = qs.query.order_by
+    if not ordering and qs.query.default_ordering:
+        ordering = qs.model._meta.ordering
+    if len(ordering) != 1 or ordering[0].lstrip('-') not in ('id', 'pk'):
+        return None
+    return ordering[0].startswith('-')
+
+def get_flag_param(request, name):
+    """Returns True if a boolean request parameter is set, such as `?pretty=1`."""
+    return request.GET.get(name, '').lower() in ('1', 'true', 'yes')
+
+def get_int_param(request, name, default=None):
+    """Returns an integer request parameter, raising ValueError if invalid."""
+    value = request.GET.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('Parameter "%s" must be an integer' % name)
 
 def to_dict(data):
-    if not isinstance(data, Message):
-        data = protolib.ToProto(data, full=True)
-    return protoutil.ProtoMessageToDict(data)
+    if isinstance(data, Message):
+        return protoutil.ProtoMessageToDict(data)
+    return protolib.ToDict(data, full=True)
 
 def wrap_exception(request, exception):
     """Returns a HttpResponse with the exception in JSON form."""
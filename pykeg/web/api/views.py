@@ -20,11 +20,13 @@
 
 import datetime
 import logging
+import time
 from functools import wraps
 
 from django.contrib.auth import login as auth_login
 from django.contrib.auth import logout as auth_logout
 from django.contrib.auth.forms import AuthenticationForm
+from django.db.models import Max
 from django.db.utils import IntegrityError
 from django.utils import timezone
 
@@ -34,11 +36,14 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
 from kegbot.api import kbapi
+from kegbot.util import kbjson
 
 from pykeg.contrib.soundserver import models as soundserver_models
 from pykeg.core import backend
+from pykeg.core import event_notifier
 from pykeg.core import keg_sizes
 from pykeg.core import models
+from pykeg.core import thermo
 from pykeg.core import util as core_util
 from pykeg.proto import protolib
 from pykeg.web.api import forms
@@ -49,6 +54,14 @@ from pykeg.web import tasks
 
 _LOGGER = logging.getLogger(__name__)
 
+# Default and maximum time a `wait_for_events` request may block.
+EVENT_WAIT_SECONDS = 30
+EVENT_WAIT_MAX_SECONDS = 120
+
+# While waiting for events, how often to check for events created by other
+# processes, which do not wake waiting requests.
+EVENT_RECHECK_SECONDS = 10
+
 ### Decorators
 
 def auth_required(view_func):
@@ -57,8 +70,19 @@ def auth_required(view_func):
     util.set_needs_auth(wrapped_view)
     return wraps(view_func)(wrapped_view)
 
+def no_cache(view_func):
+    def wrapped_view(*args, **kwargs):
+        return view_func(*args, **kwargs)
+    util.set_no_cache(wrapped_view)
+    return wraps(view_func)(wrapped_view)
+
 ### Helpers
 
+def _drink_detail(drink):
+    ret = util.to_dict(drink)
+    ret['processed'] = drink.is_processed()
+    return ret
+
 def _form_errors(form):
     ret = {}
     for field in form:
@@ -72,24 +96,19 @@ def _form_errors(form):
 ### Endpoints
 
 def all_kegs(request):
-    return models.Keg.objects.all().order_by('-start_time')
-
-def all_drinks(request, limit=100):
-    qs = models.Drink.objects.all()
-    if 'start' in request.GET:
-        try:
-            start = int(request.GET['start'])
-            qs = qs.filter(id__lte=start)
-        except ValueError:
-            pass
-    qs = qs.order_by('-id')
-    qs = qs[:limit]
-    start = qs[0].id
+    return models.Keg.objects.all().order_by('-id')
+
+def all_drinks(request):
+    qs = models.Drink.objects.all().order_by('-id')
+    # Deprecated: use `before`.
+    start = util.get_int_param(request, 'start')
+    if start is not None:
+        qs = qs.filter(id__lte=start)
     return qs
 
 def get_drink(request, drink_id):
     drink = get_object_or_404(models.Drink, id=drink_id)
-    return protolib.ToProto(drink, full=True)
+    return _drink_detail(drink)
 
 @csrf_exempt
 @auth_required
@@ -130,7 +149,7 @@ def get_keg(request, keg_id):
 
 def get_keg_drinks(request, keg_id):
     keg = get_object_or_404(models.Keg, id=keg_id)
-    return keg.drinks.all()
+    return keg.drinks.all().order_by('-id')
 
 def get_keg_events(request, keg_id):
     keg = get_object_or_404(models.Keg, id=keg_id)
@@ -161,7 +180,7 @@ def end_keg(request, keg_id):
     return protolib.ToProto(keg, full=True)
 
 def all_sessions(request):
-    return models.DrinkingSession.objects.all()
+    return models.DrinkingSession.objects.all().order_by('-id')
 
 def current_session(request):
     try:
@@ -175,7 +194,42 @@ def all_events(request):
     events = models.SystemEvent.objects.all().order_by('-id')
     events = apply_since(request, events)
     events = events[:10]
-    return [protolib.ToProto(e, full=True) for e in events]
+    return protolib.ToDictMany(events, full=True)
+
+@no_cache
+def wait_for_events(request):
+    """Returns events newer than `since`, waiting up to `timeout` seconds.
+
+    The request blocks until such an event exists, so clients can follow new
+    events without polling.  Events are listed oldest first and paginated as
+    usual; an empty list means the timeout passed.
+
+    Blocked requests each hold a server thread.  The request returns at once
+    if the server handles a single request per process (such as gunicorn's
+    default sync workers), where it would hold the whole process, or if
+    `event_notifier.max_waiters()` requests are already waiting.
+    """
+    since = util.get_int_param(request, 'since')
+    if since is None:
+        since = models.SystemEvent.objects.aggregate(Max('id'))['id__max'] or 0
+    timeout = util.get_int_param(request, 'timeout', EVENT_WAIT_SECONDS)
+    timeout = max(0, min(timeout, EVENT_WAIT_MAX_SECONDS))
+
+    if not request.META.get('wsgi.multithread'):
+        timeout = 0
+
+    events = models.SystemEvent.objects.filter(id__gt=since).order_by('id')
+    deadline = time.time() + timeout
+    generation = event_notifier.generation()
+    while not events.exists():
+        now = time.time()
+        if now >= deadline:
+            break
+        wait_seconds = min(EVENT_RECHECK_SECONDS, deadline - now)
+        generation = event_notifier.wait(generation, wait_seconds)
+        if generation is None:
+            break
+    return events
 
 def apply_since(request, query):
     """Restricts the query to `since` events, if given."""
@@ -190,12 +244,11 @@ def apply_since(request, query):
 
 @auth_required
 def all_sound_events(request):
-    return soundserver_models.SoundEvent.objects.all()
+    return soundserver_models.SoundEvent.objects.all().order_by('-id')
 
 def get_keg_sessions(request, keg_id):
     keg = get_object_or_404(models.Keg, id=keg_id)
-    sessions = [c.session for c in keg.keg_session_chunks.all()]
-    return sessions
+    return models.DrinkingSession.objects.filter(keg_chunks__keg=keg).distinct().order_by('-id')
 
 def get_keg_stats(request, keg_id):
     keg = get_object_or_404(models.Keg, id=keg_id)
@@ -205,7 +258,10 @@ def get_system_stats(request):
     return models.KegbotSite.get().GetStats()
 
 def get_info(request):
-    return {'kegbot_server_version': core_util.get_version()}
+    return {
+        'kegbot_server_version': core_util.get_version(),
+        'last_processed_drink_id': models.KegbotSite.get().last_processed_drink_id,
+    }
 
 def all_taps(request):
     return models.KegTap.objects.all().order_by('name')
@@ -220,7 +276,7 @@ def get_user(request, username):
 
 def get_user_drinks(request, username):
     user = get_object_or_404(models.User, username=username)
-    return user.drinks.all()
+    return user.drinks.all().order_by('-id')
 
 def get_user_events(request, username):
     user = get_object_or_404(models.User, username=username)
@@ -301,19 +357,77 @@ def _thermo_sensor_get(request, sensor_name):
     }
     return res
 
+def _reading_time(cd):
+    """Returns the time of a ThermoPostForm reading, or None for now.
+
+    The client's clock may be off, so only its age is used.
+    """
+    if cd.get('when') and cd.get('now'):
+        when = datetime.datetime.fromtimestamp(cd.get('when'))
+        now = datetime.datetime.fromtimestamp(cd.get('now'))
+        return timezone.now() - (now - when)
+    return None
+
 @auth_required
 def _thermo_sensor_post(request, sensor_name):
     form = forms.ThermoPostForm(request.POST)
     if not form.is_valid():
         raise kbapi.BadRequestError, _form_errors(form)
     cd = form.cleaned_data
-    sensor, created = models.ThermoSensor.objects.get_or_create(raw_name=sensor_name)
-    # TODO(mikey): use form fields to compute `when`
-    return request.backend.log_sensor_reading(sensor.raw_name, cd['temp_c'])
+    return request.backend.log_sensor_reading(sensor_name, cd['temp_c'],
+        _reading_time(cd))
+
+@csrf_exempt
+@auth_required
+def thermo_sensors_batch(request):
+    """Records readings of several sensors at once.
+
+    The `readings` parameter is a JSON list of objects with a `sensor` name
+    and the same fields as a single reading post.  The readings are recorded
+    all together, or not at all.
+    """
+    if request.method != 'POST':
+        raise kbapi.BadRequestError('POST required')
+    try:
+        items = kbjson.loads(request.POST.get('readings', ''))
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        raise kbapi.BadRequestError('Parameter "readings" must be a JSON list.')
+
+    readings = []
+    errors = {}
+    for i, item in enumerate(items):
+        form = forms.ThermoBatchPostForm(item)
+        if form.is_valid():
+            cd = form.cleaned_data
+            readings.append((cd['sensor'], cd['temp_c'], _reading_time(cd)))
+        else:
+            errors[i] = _form_errors(form)
+    if errors:
+        raise kbapi.BadRequestError, errors
+
+    try:
+        return request.backend.log_sensor_readings(readings)
+    except ValueError, e:
+        raise kbapi.BadRequestError(str(e))
 
 def get_thermo_sensor_logs(request, sensor_name):
+    """Returns a sensor's recent readings, newest first.
+
+    With the `hours` parameter, all readings of the last `hours` hours are
+    returned, averaged over periods when the window is long; see
+    `thermo.get_history()`.
+    """
     sensor = _get_sensor_or_404(request, sensor_name)
-    return sensor.thermolog_set.all()[:60*2]
+    hours = util.get_int_param(request, 'hours')
+    if hours is None:
+        return sensor.thermolog_set.all()[:60*2]
+    if hours < 1:
+        raise kbapi.BadRequestError('Parameter "hours" must be positive')
+    start = timezone.now() - datetime.timedelta(hours=hours)
+    resolution, records = thermo.get_history(sensor, start)
+    return list(records)
 
 def get_api_key(request):
     user = request.user
@@ -375,12 +489,8 @@ def tap_activate(request, tap_id):
         raise kbapi.BadRequestError, _form_errors(form)
     return protolib.ToProto(tap, full=True)
 
-@auth_required
-def _tap_detail_post(request, tap):
-    form = forms.DrinkPostForm(request.POST)
-    if not form.is_valid():
-        raise kbapi.BadRequestError, _form_errors(form)
-    cd = form.cleaned_data
+def _pour_from_form(cd):
+    """Returns `record_drink()` keyword arguments for a DrinkPostForm."""
     if cd.get('pour_time') and cd.get('now'):
         pour_time = datetime.datetime.fromtimestamp(cd.get('pour_time'))
         pour_now = datetime.datetime.fromtimestamp(cd.get('now'))
@@ -391,21 +501,66 @@ def _tap_detail_post(request, tap):
     duration = cd.get('duration')
     if duration is None:
         duration = 0
+    return {
+        'ticks': cd['ticks'],
+        'volume_ml': cd.get('volume_ml'),
+        'username': cd.get('username'),
+        'pour_time': pour_time,
+        'duration': duration,
+        'shout': cd.get('shout'),
+        'tick_time_series': cd.get('tick_time_series'),
+    }
+
+@auth_required
+def _tap_detail_post(request, tap):
+    form = forms.DrinkPostForm(request.POST)
+    if not form.is_valid():
+        raise kbapi.BadRequestError, _form_errors(form)
     try:
         drink = request.backend.record_drink(tap_name=tap.meter_name,
-          ticks=cd['ticks'],
-          volume_ml=cd.get('volume_ml'),
-          username=cd.get('username'),
-          pour_time=pour_time,
-          duration=duration,
-          shout=cd.get('shout'),
-          tick_time_series=cd.get('tick_time_series'))
+            **_pour_from_form(form.cleaned_data))
         if 'photo' in request.FILES:
             _save_pour_pic(request, drink)
-        return protolib.ToProto(drink, full=True)
+        return _drink_detail(drink)
     except backend.BackendError, e:
         raise kbapi.ServerError(str(e))
 
+@csrf_exempt
+@auth_required
+def tap_drinks_batch(request, tap_id):
+    """Records several pours at once.
+
+    The `drinks` parameter is a JSON list of objects with the same fields as
+    a single pour post.  The pours are recorded all together, or not at all.
+    """
+    if request.method != 'POST':
+        raise kbapi.BadRequestError('POST required')
+    tap = get_object_or_404(models.KegTap, meter_name=tap_id)
+    try:
+        items = kbjson.loads(request.POST.get('drinks', ''))
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        raise kbapi.BadRequestError('Parameter "drinks" must be a JSON list.')
+
+    pours = []
+    errors = {}
+    for i, item in enumerate(items):
+        form = forms.DrinkPostForm(item)
+        if form.is_valid():
+            pours.append(_pour_from_form(form.cleaned_data))
+        else:
+            errors[i] = _form_errors(form)
+    if errors:
+        raise kbapi.BadRequestError, errors
+
+    try:
+        drinks = request.backend.record_drinks(tap.meter_name, pours)
+    except backend.BackendError, e:
+        raise kbapi.ServerError(str(e))
+
+    return [_drink_detail(drink) for drink in drinks]
+
 @csrf_exempt
 @auth_required
 def cancel_drink(request):
@@ -22,6 +22,7 @@ from django.utils import timezone
 from kegbot.util import units
 
 from pykeg.core import models
+from pykeg.core import thermo
 
 def to_pints(volume):
     return float(units.Quantity(volume).InPints())
@@ -43,21 +44,20 @@ def TemperatureSensorChart(sensor):
     hours = 6
     now = timezone.now()
     start = now - (datetime.timedelta(hours=hours))
-    start = start - (datetime.timedelta(seconds=start.second))
 
-    points = sensor.thermolog_set.filter(time__gte=start).order_by('time')
+    resolution, points = thermo.get_history(sensor, start, now)
+    step = datetime.timedelta(seconds=resolution)
 
-    curr = start
+    curr = thermo.period_start(start, resolution)
     temps = []
     have_temps = False
-    for point in points:
-        while curr <= point.time:
-            curr += datetime.timedelta(minutes=1)
-            if curr < point.time:
-                temps.append(None)
-            else:
-                temps.append(point.temp)
-                have_temps = True
+    for point in points.order_by('time'):
+        while curr < point.time:
+            temps.append(None)
+            curr += step
+        temps.append(point.temp)
+        have_temps = True
+        curr = point.time + step
 
     if not have_temps:
         raise ChartError('Not enough data')
@@ -32,6 +32,7 @@ from django.views.generic.list import ListView
 
 from kegbot.util import kbjson
 
+from pykeg.core import hotstate
 from pykeg.core import models
 from pykeg.proto import protolib
 
@@ -41,15 +42,14 @@ from pykeg.proto import protolib
 def index(request):
     context = RequestContext(request)
 
-    context['taps'] = models.KegTap.objects.all()
+    context['taps'] = hotstate.get_taps()
     context['events'] = models.SystemEvent.objects.timeline()[:20]
-    sessions = models.DrinkingSession.objects.all().order_by('-id')[:10]
-    context['sessions'] = sessions
+    context['sessions'] = models.DrinkingSession.objects.all().order_by('-id')[:10]
 
-    if sessions:
-        last_session = sessions[0]
+    last_session = hotstate.get_current_session()
+    if last_session:
         context['most_recent_session'] = last_session
-        if sessions and last_session.IsActiveNow():
+        if last_session.IsActiveNow():
             context['current_session'] = last_session
 
     return render_to_response('index.html', context_instance=context)
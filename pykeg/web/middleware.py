@@ -18,7 +18,7 @@
 
 from pykeg import EPOCH
 
-from pykeg.core import models
+from pykeg.core import hotstate
 from pykeg.core.backend import KegbotBackend
 from pykeg.core.cache import KegbotCache
 from pykeg.web.api.util import is_api_request
@@ -63,9 +63,10 @@ class KegbotSiteMiddleware:
         request.need_upgrade = False
 
         try:
-            request.kbsite = models.KegbotSite.objects.get(name='default')
-            epoch = request.kbsite.epoch
-        except (models.KegbotSite.DoesNotExist, DatabaseError), e:
+            request.kbsite = hotstate.get_site()
+            if request.kbsite:
+                epoch = request.kbsite.epoch
+        except DatabaseError, e:
             request.kbsite = None
 
         if not request.kbsite or not request.kbsite.is_setup:
@@ -77,7 +78,7 @@ class KegbotSiteMiddleware:
             request.plugins = dict((p.get_short_name(), p) for p in plugin_util.get_plugins())
 
         request.kbcache = KegbotCache()
-        request.backend = KegbotBackend()
+        request.backend = KegbotBackend(cache=request.kbcache)
         return None
 
     def process_view(self, request, view_func, view_args, view_kwargs):
@@ -98,9 +99,12 @@ class KegbotSiteMiddleware:
 
     def process_response(self, request, response):
         if request.method in ('POST', 'PUT', 'PATCH') and response.status_code < 400:
-            # Invalidate cache on any successful change.
-            # TODO(mikey): More granular cache invalidations.
-            request.kbcache.update_generation()
+            # Invalidate cache on any successful change.  Changes made through
+            # the backend only invalidate the namespaces they affect; all
+            # others invalidate everything.
+            kbcache = getattr(request, 'kbcache', None)
+            if kbcache and kbcache.updated_namespaces is None:
+                kbcache.update_generation()
         return response
 
     def _setup_required(self, request):
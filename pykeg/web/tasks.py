@@ -18,19 +18,134 @@
 
 """Tasks for the Kegbot core."""
 
+import time
+
 from kegbot.util import util
+from pykeg.core import commit_hooks
+from pykeg.core import models
 from pykeg.plugin import util as plugin_util
 from pykeg import notification
 
 from celery.decorators import task
 
+logger = plugin_util.get_logger(__name__)
+
+# Handlers taking longer than this many seconds are logged as slow.
+SLOW_HANDLER_SECONDS = 1.0
+
+# Delay before the first retry of a failed notification.
+NOTIFY_RETRY_SECONDS = 30
+
+# Handler tasks older than the plugins' staleness limit are dropped rather
+# than run, so a backlog cannot grow without bound while a handler fails.
+HANDLER_TASK_EXPIRES = int(plugin_util.MAX_TASK_AGE.total_seconds())
+
 def schedule_tasks(events):
-    """Synchronously schedules tasks related to the given events."""
-    for event in events:
-        for plugin in plugin_util.get_plugins():
-            plugin.handle_new_event(event)
-    notification.handle_new_system_events(events)
+    """Schedules plugin and notification handling of the given events.
+
+    Each event is handled by a separate task per plugin and per notification
+    backend, so a slow or failing handler cannot hold up the caller or any
+    other handler.  Tasks are queued once the caller's transaction commits,
+    so workers can read the events.
+    """
+    plugin_names = [p.get_short_name() for p in plugin_util.get_plugins()]
+    backend_names = notification.get_backend_names()
+    event_ids = [event.id for event in events]
+    def schedule():
+        for event_id in event_ids:
+            for name in plugin_names:
+                handle_plugin_event.delay(event_id, name)
+            for name in backend_names:
+                handle_notification_event.delay(event_id, name)
+    commit_hooks.on_commit(schedule)
+
+@task(max_retries=3, default_retry_delay=30, expires=HANDLER_TASK_EXPIRES)
+def handle_plugin_event(event_id, plugin_name):
+    """Passes an event to a single plugin.
+
+    A plugin may have acted on the event before failing, so failures are
+    logged rather than retried.
+    """
+    event = _get_event(handle_plugin_event, event_id)
+    for plugin in plugin_util.get_plugins():
+        if plugin.get_short_name() == plugin_name:
+            _run_handler(plugin_name, event_id,
+                lambda: plugin.handle_new_event(event))
+
+@task(max_retries=3, default_retry_delay=30, expires=HANDLER_TASK_EXPIRES)
+def handle_notification_event(event_id, backend_name):
+    """Passes an event to a single notification backend.
+
+    Each recipient is notified separately; failed notifications are retried
+    by a `notify_user` task per recipient, so no one is notified twice.
+    """
+    event = _get_event(handle_notification_event, event_id)
+    backend = notification.get_backend(backend_name)
+    for user in notification.get_recipients(event, backend):
+        if not _run_handler(backend_name, event_id,
+                lambda: backend.notify(event, user)):
+            notify_user.apply_async((event_id, backend_name, user.id),
+                countdown=NOTIFY_RETRY_SECONDS)
 
+@task(max_retries=2, default_retry_delay=30, expires=HANDLER_TASK_EXPIRES)
+def notify_user(event_id, backend_name, user_id):
+    """Retries a failed notification of a single user.
+
+    Together with the first attempt by `handle_notification_event`, the user
+    is notified at most four times.
+    """
+    event = _get_event(notify_user, event_id)
+    user = models.User.objects.get(id=user_id)
+    backend = notification.get_backend(backend_name)
+    if not _run_handler(backend_name, event_id,
+            lambda: backend.notify(event, user)):
+        raise notify_user.retry()
+
+def _get_event(handler_task, event_id):
+    """Returns the event, retrying the task if it cannot be read."""
+    try:
+        return models.SystemEvent.objects.get(id=event_id)
+    except Exception, e:
+        logger.warning('Could not read event %s: %s' % (event_id, e))
+        raise handler_task.retry(exc=e)
+
+def _run_handler(name, event_id, fn):
+    """Runs `fn()`, logging its duration and any error.
+
+    Returns:
+        True if `fn` succeeded.
+    """
+    start = time.time()
+    try:
+        fn()
+        return True
+    except Exception, e:
+        logger.warning('Handler %s failed for event %s: %s' % (name, event_id, e))
+        return False
+    finally:
+        elapsed = time.time() - start
+        if elapsed >= SLOW_HANDLER_SECONDS:
+            logger.warning('Handler %s took %.3fs for event %s' % (name, elapsed, event_id))
+        else:
+            logger.debug('Handler %s took %.3fs for event %s' % (name, elapsed, event_id))
+
+@task
+def process_drinks():
+    """Generates stats and events for any newly-recorded drinks."""
+    from pykeg.core import backend
+    backend.KegbotBackend().process_pending_drinks()
+
+@task
+def flush_sensor_readings():
+    """Writes temperature readings buffered within the last minute."""
+    from pykeg.core import thermo
+    thermo.flush_all()
+
+@task
+def prune_sensor_readings():
+    """Deletes temperature readings older than the sensor history."""
+    from pykeg.core import thermo
+    thermo.prune()
 
 @task
 def handle_new_picture(picture_id):
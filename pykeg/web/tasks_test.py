@@ -0,0 +1,99 @@
+# Copyright 2014 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for tasks.py."""
+
+import mock
+
+from django.core import mail
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from pykeg.core import backend
+from pykeg.core import defaults
+from pykeg.core import models as core_models
+from pykeg.notification import models
+from pykeg.notification.backends.base import BaseNotificationBackend
+from pykeg.web import tasks
+
+FAILING_BACKEND = 'pykeg.web.tasks_test.FailingNotificationBackend'
+EMAIL_BACKEND = 'pykeg.notification.backends.email.EmailNotificationBackend'
+
+class FailingNotificationBackend(BaseNotificationBackend):
+    calls = []
+    failing_users = None
+
+    def notify(self, event, user):
+        FailingNotificationBackend.calls.append(user.username)
+        failing = FailingNotificationBackend.failing_users
+        if failing is None or user.username in failing:
+            raise IOError('Connection refused')
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+@override_settings(EMAIL_FROM_ADDRESS='test-from@example')
+class ScheduleTasksTestCase(TransactionTestCase):
+    def setUp(self):
+        self.backend = backend.KegbotBackend()
+        defaults.set_defaults(set_is_setup=True)
+        user = core_models.User.objects.create(username='notification_user',
+            email='test@example')
+        for backend_name in (FAILING_BACKEND, EMAIL_BACKEND):
+            models.NotificationSettings.objects.create(user=user,
+                backend=backend_name, keg_tapped=True, session_started=False,
+                keg_volume_low=False, keg_ended=False)
+        FailingNotificationBackend.calls = []
+        FailingNotificationBackend.failing_users = None
+
+    def start_keg(self):
+        keg = self.backend.start_keg(defaults.METER_NAME_0, beverage_name='Unknown',
+            beverage_type='beer', producer_name='Unknown', style_name='Unknown')
+        self.assertIsNotNone(keg)
+
+    @override_settings(NOTIFICATION_BACKENDS=[FAILING_BACKEND, EMAIL_BACKEND])
+    def test_failing_handler(self):
+        """A failing handler is retried without affecting any other."""
+        self.start_keg()
+
+        # Initial attempt, plus three retries.
+        self.assertEquals(['notification_user'] * 4, FailingNotificationBackend.calls)
+        self.assertEquals(1, len(mail.outbox))
+
+    @override_settings(NOTIFICATION_BACKENDS=[FAILING_BACKEND])
+    def test_retry_per_recipient(self):
+        """Only the recipients whose notification failed are retried."""
+        user = core_models.User.objects.create(username='other_user',
+            email='other@example')
+        models.NotificationSettings.objects.create(user=user,
+            backend=FAILING_BACKEND, keg_tapped=True, session_started=False,
+            keg_volume_low=False, keg_ended=False)
+        FailingNotificationBackend.failing_users = ['other_user']
+        self.start_keg()
+
+        calls = FailingNotificationBackend.calls
+        self.assertEquals(1, calls.count('notification_user'))
+        self.assertEquals(4, calls.count('other_user'))
+
+    @override_settings(NOTIFICATION_BACKENDS=[EMAIL_BACKEND])
+    def test_scheduled_after_commit(self):
+        """Handler tasks are not queued until the events are committed."""
+        in_transaction = []
+        def delay(event_id, name):
+            in_transaction.append(connection.in_atomic_block)
+        with mock.patch.object(tasks.handle_notification_event, 'delay', delay):
+            self.start_keg()
+        self.assertEquals([False], in_transaction)